@@ -0,0 +1,267 @@
+"""
+Compact lookup table for the ids of administrative divisions, keyed by their
+country and division codes, used by the importer.
+
+The divisions form a tree, a country at the top and up to four levels of
+codes below it. Each node of the tree is numbered, and a node is found from
+its parent's number and its own code in an open addressing hash table held
+in ``array`` columns, rather than in nested dicts:
+
+  * ``parents`` (4 bytes), ``codes`` (8 bytes) and ``nodes`` (4 bytes) per
+    slot, the table being kept between a third and two thirds full, so 24
+    to 48 bytes per node depending on the last resize
+  * ``ids`` (4 bytes) per node, 0 for the nodes that are only a path to
+    other divisions, such as countries
+
+Codes made of up to 17 digits, which most third and fourth level codes are,
+are packed into an integer and take no other space. Any other code is
+interned once, in a dict shared by the whole table. The nodes of the first
+level divisions, a few thousand, are also kept in a dict by country and
+code, so that lookups start below them.
+
+Running this module measures the lookups per second and bytes per entry on
+synthetic codes.
+"""
+from array import array
+from itertools import izip
+
+# Digit codes are stored as the number '1' followed by their digits, shifted
+# left with the low bit set, which keeps leading zeros apart and never clashes
+# with the even numbers of interned codes
+MAX_DIGITS = 17
+EMPTY = -1
+
+
+class AdminCodes(object):
+
+    def __init__(self, capacity=1 << 12):
+        self.strings = {}
+        self.ids = array('i', [0])
+        # The nodes of the (country, first level code) pairs looked up
+        self.first_nodes = {}
+        self.entries = 0
+        self.resize(capacity)
+
+    def __len__(self):
+        return self.entries
+
+    def resize(self, capacity):
+        old = getattr(self, 'parents', None), getattr(self, 'codes', None), getattr(self, 'nodes', None)
+        self.mask = capacity - 1
+        self.parents = array('i', [EMPTY]) * capacity
+        self.codes = array('l', [0]) * capacity
+        self.nodes = array('i', [0]) * capacity
+        self.used = 0
+        if old[0] is not None:
+            for parent, code, node in izip(*old):
+                if parent != EMPTY:
+                    self.insert(parent, code, node)
+
+    def encode(self, code, create=False):
+        if code and len(code) <= MAX_DIGITS and code.isdigit():
+            return (int('1' + code) << 1) | 1
+        try:
+            return self.strings[code] << 1
+        except KeyError:
+            if not create:
+                return None
+            index = self.strings[code] = len(self.strings)
+            return index << 1
+
+    def slot(self, parent, code):
+        i = hash((parent, code)) & self.mask
+        parents, codes = self.parents, self.codes
+        while parents[i] != EMPTY and (parents[i] != parent or codes[i] != code):
+            i = (i + 1) & self.mask
+        return i
+
+    def insert(self, parent, code, node):
+        i = self.slot(parent, code)
+        self.parents[i] = parent
+        self.codes[i] = code
+        self.nodes[i] = node
+        self.used += 1
+
+    def child(self, parent, code, create=False):
+        """
+        Returns the number of the node below ``parent`` with ``code``, or
+        None if there isn't one and not ``create``.
+        """
+        key = self.encode(code, create)
+        if key is None:
+            return None
+        i = self.slot(parent, key)
+        if self.parents[i] != EMPTY:
+            return self.nodes[i]
+        if not create:
+            return None
+        node = len(self.ids)
+        self.ids.append(0)
+        self.insert(parent, key, node)
+        if self.used * 3 > self.mask * 2:
+            self.resize((self.mask + 1) * 2)
+        return node
+
+    def add(self, path, id):
+        """
+        Sets the id of the division found at ``path``, a tuple of its country
+        code and division codes.
+        """
+        node = 0
+        for code in path:
+            node = self.child(node, code, create=True)
+        if not self.ids[node]:
+            self.entries += 1
+        self.ids[node] = id
+
+    def get(self, path):
+        node = 0
+        for code in path:
+            node = self.child(node, code)
+            if node is None:
+                return None
+        return self.ids[node] or None
+
+    def lookup(self, country_id, *codes):
+        """
+        Returns the ids of the divisions at each level of ``codes`` below
+        ``country_id``, None where there is no such division. Blank codes
+        don't name a division, but their children can still be found.
+
+        This is called for every row of the geonames file, so the node of
+        the country and first level codes is kept in ``first_nodes`` once
+        found, and ``child`` is inlined for the levels below.
+        """
+        ids = [None] * len(codes)
+        admin1 = codes[0]
+        node = self.first_nodes.get((country_id, admin1))
+        if node is None:
+            node = self.child(0, country_id)
+            if node is None:
+                return ids
+            node = self.child(node, admin1)
+            if node is None:
+                return ids
+            self.first_nodes[(country_id, admin1)] = node
+        node_ids = self.ids
+        if admin1:
+            ids[0] = node_ids[node] or None
+        # Trailing blank codes name no division and have none below them
+        last = len(codes)
+        while last > 1 and not codes[last - 1]:
+            last -= 1
+        parents, codes_, nodes, strings, mask = \
+            self.parents, self.codes, self.nodes, self.strings, self.mask
+        for level in xrange(1, last):
+            code = codes[level]
+            if code and len(code) <= MAX_DIGITS and code.isdigit():
+                key = (int('1' + code) << 1) | 1
+            else:
+                key = strings.get(code)
+                if key is None:
+                    break
+                key <<= 1
+            i = hash((node, key)) & mask
+            while True:
+                parent = parents[i]
+                if parent == node and codes_[i] == key:
+                    break
+                if parent == EMPTY:
+                    return ids
+                i = (i + 1) & mask
+            node = nodes[i]
+            if code:
+                ids[level] = node_ids[node] or None
+        return ids
+
+    def paths(self):
+        """
+        Returns a dict of the ids of the divisions by their path, as given
+        to ``add``.
+        """
+        strings = dict((index, code) for code, index in self.strings.iteritems())
+        links = {}
+        for parent, code, node in izip(self.parents, self.codes, self.nodes):
+            if parent != EMPTY:
+                links[node] = (parent, code & 1 and str(code >> 1)[1:] or strings[code >> 1])
+        paths = {}
+        for node, id in enumerate(self.ids):
+            if id:
+                path = []
+                while node:
+                    node, code = links[node]
+                    path.append(code)
+                paths[tuple(reversed(path))] = id
+        return paths
+
+    def size(self):
+        """
+        Returns the bytes used by the arrays, not counting interned codes.
+        """
+        return sum(len(a) * a.itemsize for a in (self.parents, self.codes, self.nodes, self.ids))
+
+
+def benchmark(count=300000):
+    """
+    Compares the table with the nested dicts it replaced, on divisions laid
+    out roughly like those of the full dump: a few thousand first and second
+    level divisions, and ``count`` third and fourth level ones.
+    """
+    import random
+    import sys
+    import time
+    random.seed(0)
+    paths = set()
+    while len(paths) < count:
+        paths.add(('C%d' % random.randint(0, 250), '%02d' % random.randint(1, 20),
+                   str(random.randint(1, 30)), '%05d' % random.randint(1, 99999),
+                   random.choice(['', str(random.randint(1, 9999))])))
+    paths = [path[:random.choice((2, 3, 4, 5))] for path in paths]
+
+    table = AdminCodes()
+    nested = [{} for level in range(4)]
+    for i, path in enumerate(paths):
+        table.add(path, i + 1)
+        node = nested[len(path) - 2]
+        for code in path[:-1]:
+            node = node.setdefault(code, {})
+        node[path[-1]] = i + 1
+
+    def footprint(value):
+        if isinstance(value, dict):
+            return sys.getsizeof(value) + sum(footprint(k) + footprint(v) for k, v in value.iteritems())
+        return sys.getsizeof(value)
+    strings = sum(sys.getsizeof(code) + sys.getsizeof(0) for code in table.strings)
+    print 'AdminCodes: %d bytes for %d divisions, %.1f bytes per entry' % \
+        (table.size() + strings, len(table), (table.size() + strings) / float(len(table)))
+    size = sum(footprint(level) for level in nested)
+    print 'Nested dicts: %d bytes, %.1f bytes per entry' % (size, size / float(len(table)))
+
+    queries = [path[:1] + path[1:] + ('',) * (5 - len(path)) for path in paths]
+    def best(lookup, repeat=3):
+        elapsed = []
+        for i in range(repeat):
+            started = time.time()
+            for query in queries:
+                lookup(*query)
+            elapsed.append(time.time() - started)
+        return len(queries) / min(elapsed)
+    print 'AdminCodes: %d lookups/s' % best(table.lookup)
+
+    def nested_ids(country_id, admin1, admin2, admin3, admin4):
+        ids = [None] * 4
+        for level, code in enumerate((admin1, admin2, admin3, admin4)):
+            if code:
+                try:
+                    node = nested[level][country_id]
+                    for parent in (admin1, admin2, admin3)[:level]:
+                        node = node[parent]
+                    ids[level] = node[code]
+                except KeyError:
+                    pass
+        return ids
+    print 'Nested dicts: %d lookups/s' % best(nested_ids)
+
+
+if __name__ == '__main__':
+    benchmark()
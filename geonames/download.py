@@ -0,0 +1,346 @@
+"""
+Downloader of the GeoNames dump files.
+
+Files are fetched over a few threads at once, and each is recorded in a
+manifest kept next to them, with its size and the ``ETag`` and
+``Last-Modified`` headers it was served with:
+
+  * files in the manifest are revalidated with ``If-None-Match`` and
+    ``If-Modified-Since``, and kept when the server answers 304
+  * files are downloaded to a ``.part`` file, which an interrupted download
+    leaves behind, and which is resumed with a ``Range`` request as long as
+    the server still has the same version of the file
+  * a file is only moved in place once it has the size the server gave
+
+The base URL can point to any server speaking plain HTTP, such as a mirror
+or a local stand-in.
+
+Running this module checks the downloader against a local HTTP server, for
+revalidation, resumed and truncated downloads::
+
+    python -m geonames.download
+"""
+from __future__ import with_statement
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import urllib2
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from Queue import Queue, Empty
+
+MANIFEST_FILE = 'download.manifest'
+CHUNK_SIZE = 1024 * 1024
+THREADS = 4
+TIMEOUT = 60
+
+
+class DownloadError(IOError):
+    pass
+
+
+class Downloader(object):
+
+    def __init__(self, base_url, directory='.', threads=THREADS, verbose=False):
+        if not base_url.endswith('/'):
+            base_url += '/'
+        self.base_url = base_url
+        self.directory = directory
+        self.threads = threads
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.manifest = self.read_manifest()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def read_manifest(self):
+        try:
+            with open(self.path(MANIFEST_FILE)) as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return {}
+
+    def write_manifest(self):
+        filename = self.path(MANIFEST_FILE)
+        with open(filename + '.tmp', 'w') as fd:
+            json.dump(self.manifest, fd, indent=2, sort_keys=True)
+        os.rename(filename + '.tmp', filename)
+
+    def record(self, name, entry):
+        with self.lock:
+            if entry is None:
+                self.manifest.pop(name, None)
+            else:
+                self.manifest[name] = entry
+            self.write_manifest()
+
+    def cached(self, name):
+        """
+        Returns the manifest entry of ``name`` if the file is there with the
+        size it was downloaded with.
+        """
+        entry = self.manifest.get(name)
+        if entry and entry.get('complete') and os.path.exists(self.path(name)) and \
+                os.path.getsize(self.path(name)) == entry['size']:
+            return entry
+        return None
+
+    def request(self, name, headers):
+        request = urllib2.Request(self.base_url + name, headers=headers)
+        try:
+            return urllib2.urlopen(request, timeout=TIMEOUT)
+        except urllib2.HTTPError, e:
+            if e.code in (304, 416):
+                return e
+            raise DownloadError('Error fetching %s: HTTP %d %s' % (name, e.code, e.msg))
+        except urllib2.URLError, e:
+            raise DownloadError('Error fetching %s: %s' % (name, e.reason))
+
+    def download(self, name):
+        """
+        Brings ``name`` up to date, and returns whether it was downloaded,
+        in full or in part.
+        """
+        headers = {}
+        cached = self.cached(name)
+        part = self.path(name + '.part')
+        partial = self.manifest.get(name)
+        offset = 0
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+        elif partial and os.path.exists(part) and (partial.get('etag') or partial.get('last_modified')):
+            # Only the same version of the file can be resumed
+            offset = os.path.getsize(part)
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = partial.get('etag') or partial['last_modified']
+
+        response = self.request(name, headers)
+        try:
+            code = response.getcode()
+            if code == 304 and cached:
+                if self.verbose:
+                    print '%s is up to date' % name
+                return False
+            if code == 416:
+                # The part file is as long as the file on the server, or
+                # longer, so it's downloaded again from the start
+                os.unlink(part)
+                self.record(name, None)
+                return self.download(name)
+            info = response.info()
+            entry = {'etag': info.get('ETag'), 'last_modified': info.get('Last-Modified'),
+                     'complete': False}
+            if code == 206:
+                size = int(info['Content-Range'].rsplit('/', 1)[1])
+            else:
+                offset = 0
+                size = info.get('Content-Length') and int(info['Content-Length'])
+            entry['size'] = size
+            self.record(name, entry)
+            if self.verbose:
+                print 'Downloading %s%s' % (name, offset and ' from byte %d' % offset or '')
+            with open(part, offset and 'ab' or 'wb') as fd:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    fd.write(chunk)
+        finally:
+            response.close()
+
+        received = os.path.getsize(part)
+        if size is not None and received != size:
+            raise DownloadError('%s is truncated: %d of %d bytes received, run again to resume' %
+                                (name, received, size))
+        os.rename(part, self.path(name))
+        entry.update(size=received, complete=True)
+        self.record(name, entry)
+        if self.verbose:
+            print '%s downloaded, %.1f MB' % (name, received / 1048576.0)
+        return True
+
+    def fetch(self, names):
+        """
+        Brings the files ``names`` up to date over a pool of threads, and
+        returns the names of those that were downloaded. Raises
+        ``DownloadError`` for the first file that failed, once all the
+        others are done.
+        """
+        queue = Queue()
+        for name in names:
+            queue.put(name)
+        downloaded, errors = [], []
+
+        def work():
+            while True:
+                try:
+                    name = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    if self.download(name):
+                        downloaded.append(name)
+                except DownloadError, e:
+                    errors.append(e)
+                except Exception, e:
+                    errors.append(DownloadError('Error fetching %s: %s' % (name, e)))
+
+        threads = [threading.Thread(target=work) for i in range(min(self.threads, len(names)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return downloaded
+
+
+class CheckHandler(BaseHTTPRequestHandler):
+    """
+    Serves the files of ``server.files``, ``{name: (etag, data)}``, with
+    their ``ETag``, answering conditional and range requests, and stopping
+    after ``server.truncate`` bytes when it is set.
+    """
+
+    def do_GET(self):
+        name = self.path.lstrip('/')
+        self.server.requests.append((name, dict(self.headers.items())))
+        if name not in self.server.files:
+            self.send_error(404)
+            return
+        etag, data = self.server.files[name]
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        start = 0
+        range = self.headers.get('Range')
+        if range and self.headers.get('If-Range') == etag:
+            start = int(range.split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % len(data))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        body = data[start:]
+        if self.server.truncate is not None:
+            body = body[:self.server.truncate]
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def check():
+    """
+    Runs the downloader against a local server and returns the list of the
+    checks that failed.
+    """
+    server = HTTPServer(('127.0.0.1', 0), CheckHandler)
+    server.files, server.requests, server.truncate = {}, [], None
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    directory = tempfile.mkdtemp()
+    base_url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    failures = []
+
+    def expect(description, condition):
+        print '%s %s' % (condition and 'ok  ' or 'FAIL', description)
+        if not condition:
+            failures.append(description)
+
+    def content(name):
+        with open(os.path.join(directory, name), 'rb') as fd:
+            return fd.read()
+
+    def last_request():
+        return server.requests[-1][1]
+
+    try:
+        data = ''.join(chr(i % 251) for i in range(3 * CHUNK_SIZE + 12345))
+        server.files['a.zip'] = ('"v1"', data)
+        server.files['b.txt'] = ('"v1"', 'b' * 1000)
+
+        downloaded = Downloader(base_url, directory).fetch(['a.zip', 'b.txt'])
+        expect('files are downloaded', sorted(downloaded) == ['a.zip', 'b.txt'] and
+               content('a.zip') == data)
+        manifest = Downloader(base_url, directory).manifest
+        expect('files are recorded complete in the manifest',
+               manifest.get('a.zip', {}).get('complete') and manifest['a.zip']['size'] == len(data))
+
+        downloaded = Downloader(base_url, directory).fetch(['a.zip', 'b.txt'])
+        expect('unchanged files are revalidated with a 304', downloaded == [] and
+               last_request().get('if-none-match') == '"v1"')
+
+        server.files['a.zip'] = ('"v2"', data[::-1])
+        server.truncate = CHUNK_SIZE
+        try:
+            Downloader(base_url, directory).fetch(['a.zip'])
+            expect('a truncated download fails', False)
+        except DownloadError:
+            expect('a truncated download fails', True)
+        expect('a truncated download leaves the old file and a part file',
+               content('a.zip') == data and
+               os.path.getsize(os.path.join(directory, 'a.zip.part')) == CHUNK_SIZE)
+
+        server.truncate = None
+        downloaded = Downloader(base_url, directory).fetch(['a.zip'])
+        expect('a truncated download is resumed with a range request',
+               last_request().get('range') == 'bytes=%d-' % CHUNK_SIZE and
+               last_request().get('if-range') == '"v2"')
+        expect('a resumed download is complete', downloaded == ['a.zip'] and content('a.zip') == data[::-1] and
+               not os.path.exists(os.path.join(directory, 'a.zip.part')))
+
+        server.files['a.zip'] = ('"v3"', data)
+        server.truncate = CHUNK_SIZE
+        try:
+            Downloader(base_url, directory).fetch(['a.zip'])
+        except DownloadError:
+            pass
+        server.truncate = None
+        server.files['a.zip'] = ('"v4"', data[:-1])
+        Downloader(base_url, directory).fetch(['a.zip'])
+        expect('a part file of another version is downloaded again in full',
+               content('a.zip') == data[:-1])
+
+        server.truncate = len(data)
+        server.files['a.zip'] = ('"v5"', data)
+        try:
+            Downloader(base_url, directory).fetch(['a.zip'])
+        except DownloadError:
+            pass
+        server.truncate = None
+        with open(os.path.join(directory, 'a.zip.part'), 'ab') as fd:
+            fd.write('extra')
+        Downloader(base_url, directory).fetch(['a.zip'])
+        expect('a part file as long as the file is downloaded again after a 416',
+               content('a.zip') == data)
+
+        try:
+            Downloader(base_url, directory).fetch(['missing.zip'])
+            expect('a missing file fails', False)
+        except DownloadError:
+            expect('a missing file fails', True)
+    finally:
+        server.shutdown()
+        shutil.rmtree(directory)
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(check() and 1 or 0)
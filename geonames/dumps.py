@@ -0,0 +1,320 @@
+"""
+Parser for the tab separated files of the GeoNames dump.
+
+Lines are read in chunks and split into columns, one per field of the file,
+so that a chunk can be filtered and transformed a column at a time instead
+of a line at a time. Each column is typed by the format of its file, the
+first time it is used:
+
+  * ``str`` columns are lists of byte strings, as found in the file
+  * ``text`` columns are lists of unicode strings, decoded from UTF-8
+  * ``int`` and ``float`` columns are ``array`` columns, 0 and NaN standing
+    for blank fields
+  * ``int?`` columns are lists of integers, None standing for blank fields
+  * ``bool`` columns are ``array`` columns of 0 and 1, blank and 0 being false
+
+Running this module measures the MB/s at which dump files, or those of a
+directory, are parsed, next to a plain loop splitting each line::
+
+    python -m geonames.dumps FILE_OR_DIRECTORY
+"""
+from array import array
+from itertools import islice, izip
+
+BATCH_ROWS = 1000
+
+
+def int_column(values):
+    try:
+        return array('l', map(int, values))
+    except ValueError:
+        return array('l', [int(value) if value else 0 for value in values])
+
+
+def nullable_int_column(values):
+    return [int(value) if value else None for value in values]
+
+
+def float_column(values):
+    return array('d', [float(value or 'nan') for value in values])
+
+
+def text_column(values):
+    # Decoded at once, fields never holding a tab
+    if not values:
+        return []
+    return '\t'.join(values).decode('utf-8').split(u'\t')
+
+
+def bool_column(values):
+    return array('b', [value not in ('', '0') for value in values])
+
+
+COLUMN_TYPES = {
+    'str': list,
+    'text': text_column,
+    'int': int_column,
+    'int?': nullable_int_column,
+    'float': float_column,
+    'bool': bool_column,
+}
+
+
+class Format(object):
+    """
+    The layout of a dump file: its columns, as ``(name, type)`` pairs, whether
+    its first line is a header and the prefix of its comment lines.
+    """
+
+    def __init__(self, columns, header=False, comment=None):
+        self.names = tuple(name for name, type in columns)
+        self.index = dict((name, i) for i, name in enumerate(self.names))
+        self.types = tuple(COLUMN_TYPES[type] for name, type in columns)
+        self.header = header
+        self.comment = comment
+
+    def parse(self, lines, ends=None):
+        """
+        Returns a ``Batch`` of the fields of ``lines``, and of ``ends``, the
+        offsets in the file past each of them, if given.
+
+        The lines are joined and split at once, and the columns sliced out of
+        the fields, each line starting a field with its newline, which tells
+        whether every line had as many fields as the first. Lines with fewer
+        fields than the format, such as those of older dumps, get blank
+        fields, and the fields past those of the format are dropped.
+        """
+        width = len(self.names)
+        if self.comment:
+            kept = [not line.startswith(self.comment) for line in lines]
+            lines = [line for line, keep in izip(lines, kept) if keep]
+            if ends is not None:
+                ends = [end for end, keep in izip(ends, kept) if keep]
+        count = len(lines)
+        if not count:
+            return Batch(self, [()] * width, ends=ends)
+        text = ''.join(lines)
+        if '\r' in text:
+            text = text.replace('\r\n', '\n')
+        if not text.endswith('\n'):
+            text += '\n'
+        fields = text.replace('\n', '\t\n').split('\t')
+        found = lines[0].count('\t') + 1
+        if len(fields) == count * found + 1:
+            starts = fields[found:-1:found]
+            if ''.join(starts).count('\n') == count - 1:
+                columns = [fields[i:-1:found] for i in range(1, min(found, width))]
+                columns.insert(0, fields[:1] + [field[1:] for field in starts])
+                columns.extend([[''] * count] * (width - len(columns)))
+                return Batch(self, columns, ends=ends)
+        # Lines with different numbers of fields are split one at a time
+        rows = []
+        for line in lines:
+            fields = line.rstrip('\r\n').split('\t')
+            if len(fields) < width:
+                fields.extend([''] * (width - len(fields)))
+            rows.append(fields)
+        return Batch(self, zip(*rows)[:width], ends=ends)
+
+
+class Batch(object):
+    """
+    A chunk of a dump file held as columns, looked up by name. The fields of
+    a column are converted to its type when it is first looked up, so the
+    columns that aren't used cost no more than splitting the lines.
+
+    Batches read with a starting offset hold in ``ends`` the offset in the
+    file past each of their rows, so that a stage can record how far the
+    rows it has written go.
+    """
+
+    def __init__(self, format, fields, columns=None, ends=None):
+        self.format = format
+        self.fields = fields
+        self.columns = columns or {}
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.fields[0])
+
+    def __getitem__(self, name):
+        try:
+            return self.columns[name]
+        except KeyError:
+            i = self.format.index[name]
+            column = self.columns[name] = self.format.types[i](self.fields[i])
+            return column
+
+    def strings(self, name):
+        """
+        Returns the fields of column ``name`` as found in the file.
+        """
+        return self.fields[self.format.index[name]]
+
+    def select(self, mask):
+        """
+        Returns the batch of the rows for which ``mask``, a sequence of one
+        truth value per row, is true.
+        """
+        keep = [i for i, selected in enumerate(mask) if selected]
+        if len(keep) == len(self):
+            return self
+        fields = [[values[i] for i in keep] for values in self.fields]
+        columns = {}
+        for name, column in self.columns.iteritems():
+            values = [column[i] for i in keep]
+            if isinstance(column, array):
+                values = array(column.typecode, values)
+            columns[name] = values
+        ends = self.ends
+        if ends is not None:
+            ends = [ends[i] for i in keep]
+        return Batch(self.format, fields, columns, ends)
+
+    def rows(self, *names):
+        """
+        Returns an iterator over the rows of the batch, as tuples of the
+        columns in ``names``, or of all the columns.
+        """
+        return izip(*[self[name] for name in names or self.format.names])
+
+    def string_rows(self):
+        """
+        Returns an iterator over the rows of the batch, as tuples of all
+        their fields as found in the file.
+        """
+        return izip(*self.fields)
+
+
+GEONAME = Format((
+    ('geoname_id', 'int'), ('name', 'text'), ('ascii_name', 'str'), ('alternate_names', 'str'),
+    ('latitude', 'float'), ('longitude', 'float'), ('fclass', 'str'), ('fcode', 'str'),
+    ('country_code', 'str'), ('cc2', 'str'), ('admin1', 'str'), ('admin2', 'str'),
+    ('admin3', 'str'), ('admin4', 'str'), ('population', 'int'), ('elevation', 'int?'),
+    ('gtopo30', 'int?'), ('timezone', 'str'), ('moddate', 'str'),
+))
+
+ALTERNATE_NAME = Format((
+    ('id', 'int'), ('geoname_id', 'int'), ('language', 'str'), ('name', 'text'),
+    ('preferred', 'bool'), ('short', 'bool'), ('colloquial', 'bool'), ('historic', 'bool'),
+))
+
+# admin1CodesASCII.txt and admin2Codes.txt, whose codes are the country and
+# parent codes joined with dots
+ADMIN_CODE = Format((
+    ('code', 'str'), ('name', 'text'), ('ascii_name', 'str'), ('geoname_id', 'int?'),
+))
+
+COUNTRY_INFO = Format((
+    ('iso_alpha2', 'str'), ('iso_alpha3', 'str'), ('iso_numeric', 'str'), ('fips_code', 'str'),
+    ('name', 'text'), ('capital', 'text'), ('area', 'str'), ('population', 'str'),
+    ('continent', 'str'), ('tld', 'str'), ('currency_code', 'str'), ('currency_name', 'str'),
+    ('phone', 'str'), ('postal_code_format', 'str'), ('postal_code_regex', 'str'),
+    ('languages', 'str'), ('geoname_id', 'int?'), ('neighbours', 'str'),
+    ('equivalent_fips_code', 'str'),
+), comment='#')
+
+TIME_ZONE = Format((
+    ('name', 'str'), ('gmt_offset', 'str'), ('dst_offset', 'str'),
+), header=True)
+
+FEATURE_CODE = Format((
+    ('code', 'str'), ('name', 'str'), ('description', 'str'),
+))
+
+LANGUAGE_CODE = Format((
+    ('iso_639_3', 'str'), ('iso_639_2', 'str'), ('iso_639_1', 'str'), ('language_name', 'str'),
+), header=True)
+
+FORMATS = {
+    'allCountries.txt': GEONAME,
+    'cities1000.txt': GEONAME,
+    'cities5000.txt': GEONAME,
+    'cities15000.txt': GEONAME,
+    'alternateNames.txt': ALTERNATE_NAME,
+    'admin1CodesASCII.txt': ADMIN_CODE,
+    'admin2Codes.txt': ADMIN_CODE,
+    'countryInfo.txt': COUNTRY_INFO,
+    'timeZones.txt': TIME_ZONE,
+    'featureCodes_en.txt': FEATURE_CODE,
+    'iso-languagecodes.txt': LANGUAGE_CODE,
+}
+
+
+def read_batches(lines, format, size=BATCH_ROWS, start=None):
+    """
+    Yields the ``Batch`` objects of ``size`` lines each read from ``lines``,
+    an iterable of the lines of a file laid out as ``format``. With
+    ``start``, the offset in the file of the first line, the batches know
+    the offsets past their rows.
+    """
+    lines = iter(lines)
+    if format.header and not start:
+        header = next(lines, '')
+        if start is not None:
+            start += len(header)
+    while True:
+        chunk = list(islice(lines, size))
+        if not chunk:
+            break
+        ends = None
+        if start is not None:
+            ends = []
+            append = ends.append
+            for length in map(len, chunk):
+                start += length
+                append(start)
+        yield format.parse(chunk, ends)
+
+
+def benchmark(filename, format=None, repeat=3):
+    """
+    Compares the MB/s at which ``filename`` is parsed into batches, with the
+    offsets past their rows and their names decoded as the importer reads
+    them, with those of a loop splitting each line and decoding its name, as
+    the importer stages used to. The best of ``repeat`` runs is kept.
+    """
+    import os
+    import time
+    format = format or FORMATS[os.path.basename(filename)]
+    column = 'name' in format.index and 'name' or format.names[0]
+    index = format.index[column]
+    size = os.path.getsize(filename) / 1048576.0
+
+    def lines():
+        with open(filename) as fd:
+            if format.header:
+                next(fd, '')
+            for line in fd:
+                if format.comment and line.startswith(format.comment):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if index < len(fields):
+                    unicode(fields[index], 'utf-8')
+
+    def batches():
+        with open(filename) as fd:
+            for batch in read_batches(fd, format, start=0):
+                batch[column]
+
+    print os.path.basename(filename)
+    for label, parse in (('Line loop', lines), ('Batches', batches)):
+        best = None
+        for i in range(repeat):
+            started = time.time()
+            parse()
+            elapsed = time.time() - started
+            best = best is None and elapsed or min(best, elapsed)
+        print '  %s: %.1f MB/s' % (label, size / best)
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    for path in sys.argv[1:]:
+        if os.path.isdir(path):
+            for name in sorted(FORMATS):
+                if os.path.exists(os.path.join(path, name)):
+                    benchmark(os.path.join(path, name))
+        else:
+            benchmark(path)
@@ -1,17 +1,49 @@
 # -*- coding: utf-8 -*-
-import re
+from django.db.models import Q
 
-from geonames.models import Geoname, GeonameAlternateName, Country
+from geonames.models import Geoname, GeonameAlternateName, GeonameSearchName, Country
+from geonames.nameindex import get_index, get_regions
+from geonames.search import search_key
 
-us_state_abbrs = 'AL|AK|AZ|AR|CA|CO|CT|DE|DC|FL|GA|HI|ID|IL|IN|IA|KS|KY|LA|ME|MT|NE|NV|NH|NJ|NM|NY|NC|ND|OH|OK|OR|MD|MA|MI|MN|MS|MO|PA|RI|SC|SD|TN|TX|UT|VT|VA|WA|WV|WI|WY'
-us_states = 'Alabama|Alaska|Arizona|Arkansas|California|Colorado|Connecticut|Delaware|District of Columbia|Florida|Georgia|Hawaii|Idaho|Illinois|Indiana|Iowa|Kansas|Kentucky|Louisiana|Maine|Montana|Nebraska|Nevada|New Hampshire|New Jersey|New Mexico|New York|North Carolina|North Dakota|Ohio|Oklahoma|Oregon|Maryland|Massachusetts|Michigan|Minnesota|Mississippi|Missouri|Pennsylvania|Rhode Island|South Carolina|South Dakota|Tennessee|Texas|Utah|Vermont|Virginia|Washington|West Virginia|Wisconsin|Wyoming'
-us_address_re = re.compile(r'(?:(?P<number>\d+)\s+(?P<street>[\w\s]+),?\s+)?(?P<city>[\w\s]+),?\s+(?P<state>%s|%s)' % (us_states, us_state_abbrs), re.I)
+# The number of names looked up by each query of geocode_many
+BATCH_SIZE = 500
 
-can_prov_abbrs = 'AB|BC|MB|NB|NL|NT|NS|NU|ON|PE|QC|SK|YT'
-can_provinces = 'Alberta|British Columbia|Manitoba|New Brunswick|Newfoundland and Labrador|Northwest Territories|Nova Scotia|Nunavut|Ontario|Prince Edward Island|Quebec|Québec|Saskatchewan|Yukon'
-can_city_prov_re = re.compile(r'(?P<city>[\w\s]+),?\s+(?P<province>%s|%s)' % (can_provinces, can_prov_abbrs), re.I)
 
-city_country_re = re.compile(r'(?P<city>[\w\s]+?),?\s+(?P<country>[\w\s]+)', re.I)
+def indexed_results(ids):
+    """
+    Returns the geonames of the ids found in the name index, most populated
+    first, fetched by primary key.
+    """
+    if not ids:
+        return []
+    return Geoname.objects.filter(pk__in=ids).order_by('-population')
+
+
+def split_region(values):
+    """
+    Returns the first level divisions and the countries among the values of
+    a region of ``RegionMatcher``.
+    """
+    admin1_ids = set(value for kind, value in values if kind == 'admin1')
+    countries = set(value for kind, value in values if kind == 'country')
+    return admin1_ids, countries
+
+
+def region_ids(find, city, values):
+    """
+    Returns the ids ``find`` returns for ``city`` in the region standing for
+    ``values``: in its first level divisions if any has a place by that
+    name, in its countries otherwise.
+    """
+    admin1_ids, countries = split_region(values)
+    return admin1_ids and find(city, admin1_ids=admin1_ids) or \
+        countries and find(city, countries=countries) or []
+
+
+def fix_query(query):
+    # Quick fix for Québec
+    query = query.replace('Quebec', u'Québec')
+    return query.replace('quebec', u'Québec')
 
 
 def geocode(query, first=True):
@@ -20,96 +52,181 @@ def geocode(query, first=True):
     then look for a Geoname object to match it. By default, it returns the
     first result. If first is False, however, it returns a list of all results.
     """
-    # Quick fix for Québec
-    query = query.replace('Quebec', u'Québec')
-    query = query.replace('quebec', u'Québec')
+    query = fix_query(query)
+    index = get_index()
     
     # If the query is two or three letters, try the appropriate ISO code first
-    try:
-        if len(query) == 2:
-            country = Country.objects.select_related().get(
-                iso_alpha2__iexact=query
-            )
-            return country.geoname
-        elif len(query) == 3:
-            country = Country.objects.select_related().get(
-                iso_alpha3__iexact=query
-            )
-            return country.geoname
-    except Country.DoesNotExist:
-        pass
-    
-    # Check for a US Address or 'City, State'
-    match = us_address_re.match(query)
-    if match:
-        number = match.groupdict()['number']
-        street = match.groupdict()['street']
-        city = match.groupdict()['city']
-        state = match.groupdict()['state']
-        if city and state:
-            filters = {}
-            filters.update({'name__iexact': city})
-            if len(state) == 2:
-                filters.update({'admin1__code__iexact': state})
-            else:
-                filters.update({'admin1__name__iexact': state})
-            if number and street:
-                # The geonames database doesn't actually include street and
-                # street number, so they can be ignored.
-                pass
-            results = Geoname.objects.filter(**filters)
-            if results:
-                if first:
-                    return results[0]
-                return results
+    if index is not None:
+        found, geoname_id = index.country_geoname(query)
+        if found:
+            return geoname_id and Geoname.objects.get(pk=geoname_id)
+    else:
+        try:
+            if len(query) == 2:
+                country = Country.objects.select_related().get(
+                    iso_alpha2__iexact=query
+                )
+                return country.geoname
+            elif len(query) == 3:
+                country = Country.objects.select_related().get(
+                    iso_alpha3__iexact=query
+                )
+                return country.geoname
+        except Country.DoesNotExist:
+            pass
     
-    # Check for Canadian 'City, Province'
-    match = can_city_prov_re.match(query)
-    if match:
-        city = match.groupdict()['city']
-        province = match.groupdict()['province']
-        if city and province:
-            filters = {'name__iexact': city}
-            if len(province) == 2:
-                filters.update({'admin1__code__iexact': province})
-            else:
-                filters.update({'admin1__name__iexact': province})
-            results = Geoname.objects.filter(**filters)
-            if results:
-                if first:
-                    return results[0]
-                return results
+    # Check for 'City, Region', the region being a first level division or
+    # a country, of any country, the longest region the query ends with
+    # first. The street and number of an address are left out.
+    for city, values in get_regions().match(query):
+        if index is not None:
+            results = indexed_results(region_ids(index.find, city, values))
+        else:
+            admin1_ids, countries = split_region(values)
+            results = []
+            if admin1_ids:
+                results = Geoname.objects.filter(name__iexact=city, admin1__in=admin1_ids) \
+                    .order_by('-population')
+            if not results and countries:
+                results = Geoname.objects.filter(name__iexact=city, country__in=countries) \
+                    .order_by('-population')
+        if results:
+            if first:
+                return results[0]
+            return results
     
-    # Check for 'City, Country'
-    match = city_country_re.match(query)
-    if match:
-        city = match.groupdict()['city']
-        country = match.groupdict()['country']
-        if city and country:
-            filters = {'name__iexact': city}
-            if len(country) == 2:
-                if country.lower() == 'uk':
-                    country = 'GB'
-                filters.update({'country__iso_alpha2__iexact': country})
-            elif len(country) == 3:
-                filters.update({'country__iso_alpha3__iexact': country})
-            else:
-                filters.update({'country__name__iexact': country})
-            results = Geoname.objects.filter(**filters)
-            if results:
-                if first:
-                    return results[0]
-                return results
-    
-    # Try the name directly, and sort the results by population
-    results = Geoname.objects.filter(
-        name__icontains=query
-    ).order_by('-population')
+    # Try the query as a whole name, in any language, then as the start of
+    # one
+    for prefix in (False, True):
+        results = Geoname.objects.named(query, prefix=prefix)
+        if results:
+            if first:
+                return results[0]
+            return results
+
+    # Try the names containing the query, the closest and most populated
+    # first
+    results = Geoname.objects.search(query)
     if first and results:
         return results[0]
     return results
 
 
+def named_geonames(names, fields, **filters):
+    """
+    Returns the ``fields`` of the geonames named one of ``names``, regardless
+    of case, as lists of dicts keyed by the upper case name, most populated
+    first. The names are looked up ``BATCH_SIZE`` at a time, through the
+    index of the search names, then matched against the names here.
+    """
+    names = set(name.upper() for name in names)
+    keys = list(set(search_key(name) for name in names))
+    found = {}
+    for i in xrange(0, len(keys), BATCH_SIZE):
+        ids = GeonameSearchName.objects.filter(name__in=keys[i:i + BATCH_SIZE]).values('geoname')
+        for row in Geoname.objects.filter(pk__in=ids, **filters).values('id', 'name', 'population', *fields):
+            # A geoname is also found by the keys of its other names
+            if row['name'].upper() in names:
+                found[row['id']] = row
+    rows = sorted(found.values(), key=lambda row: -row['population'])
+    by_name = {}
+    for row in rows:
+        by_name.setdefault(row['name'].upper(), []).append(row)
+    return by_name
+
+
+def geocode_many(queries):
+    """
+    Geocodes each of ``queries`` like ``geocode`` does, and returns the list
+    of the first geoname found for each, or None, in the order of the
+    queries.
+
+    Each distinct query is looked up once, and the queries are resolved
+    together, branch by branch: the ISO codes, then the cities of the
+    regions they end with, with a few queries each or from the name index
+    when there is one, then the names in any language. The queries left
+    over are searched for one at a time, as the last resorts of
+    ``geocode``.
+    """
+    queries = [fix_query(query) for query in queries]
+    pending = set(queries)
+    found = {}
+    index = get_index()
+
+    # ISO codes, for which the geoname of the country is found, if any
+    codes = [query for query in pending if len(query) in (2, 3)]
+    if index is not None:
+        for query in codes:
+            matched, geoname_id = index.country_geoname(query)
+            if matched:
+                found[query] = geoname_id
+    elif codes:
+        countries = {}
+        for country in Country.objects.filter(
+            Q(iso_alpha2__in=[code.upper() for code in codes if len(code) == 2]) |
+            Q(iso_alpha3__in=[code.upper() for code in codes if len(code) == 3])
+        ).values('iso_alpha2', 'iso_alpha3', 'geoname'):
+            countries[country['iso_alpha2']] = countries[country['iso_alpha3']] = country['geoname']
+        for query in codes:
+            if query.upper() in countries:
+                found[query] = countries[query.upper()]
+    pending.difference_update(found)
+
+    # 'City, Region', the region being a first level division or a country
+    regions = get_regions()
+    matches = dict((query, regions.match(query)) for query in pending)
+    if index is not None:
+        find = index.find
+    else:
+        by_name = named_geonames([city for candidates in matches.values() for city, values in candidates],
+                                 ('admin1', 'country'))
+
+        def find(city, admin1_ids=None, countries=None):
+            field, values = admin1_ids is not None and ('admin1', admin1_ids) or ('country', countries)
+            return [row['id'] for row in by_name.get(city.upper(), ()) if row[field] in values]
+    for query, candidates in matches.items():
+        for city, values in candidates:
+            ids = region_ids(find, city, values)
+            if ids:
+                found[query] = ids[0]
+                break
+    pending.difference_update(found)
+
+    # Whole names, in any language
+    keys = {}
+    for query in pending:
+        keys.setdefault(search_key(query), []).append(query)
+    keys.pop(u'', None)
+    named = []
+    names = list(keys)
+    for i in xrange(0, len(names), BATCH_SIZE):
+        named.extend(GeonameSearchName.objects.filter(name__in=names[i:i + BATCH_SIZE])
+                     .values_list('geoname', 'name'))
+    populations = {}
+    ids = list(set(geoname_id for geoname_id, name in named))
+    for i in xrange(0, len(ids), BATCH_SIZE):
+        populations.update(Geoname.objects.filter(pk__in=ids[i:i + BATCH_SIZE])
+                           .values_list('id', 'population'))
+    # The most populated geoname of each name is written last
+    named.sort(key=lambda row: populations.get(row[0]))
+    for geoname_id, name in named:
+        for query in keys[name]:
+            found[query] = geoname_id
+    pending.difference_update(found)
+
+    # The start of names, then the names containing the query
+    for query in pending:
+        results = list(Geoname.objects.named(query, prefix=True, limit=1)) or \
+            list(Geoname.objects.search(query, limit=1))
+        found[query] = results and results[0].id or None
+
+    ids = filter(None, set(found.values()))
+    geonames = {}
+    for i in xrange(0, len(ids), BATCH_SIZE):
+        geonames.update(Geoname.objects.in_bulk(ids[i:i + BATCH_SIZE]))
+    return [geonames.get(found[query]) for query in queries]
+
+
 def reverse_geocode(lat, lng, cities=False):
     """
     A simple reverse geocoder that returns the Geoname closest to the given
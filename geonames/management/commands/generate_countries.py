@@ -1,9 +1,8 @@
-import sys
-
 from django.core.management.base import NoArgsCommand
 from django.db import connections
 
-from geonames.models import Country, Geoname
+from geonames import dumps
+from geonames.management.extract import GeonameExtractor, set_country_geonames
 
 """
 Generates geonames for all countries in the cities1000.zip file. To run this
@@ -23,61 +22,20 @@ class Command(NoArgsCommand):
         # Generate the list of geoname ids to import
         with open('countryInfo.txt') as fd:
             geoname_ids = {}
-            for line in fd:
-                if line.startswith('#') or line.startswith('ISO') or line.startswith('CS'):
-                    continue
-                fields = line.split('\t')
-                geoname_ids.update({fields[0]: fields[16]})
+            for batch in dumps.read_batches(fd, dumps.COUNTRY_INFO):
+                for code, geoname_id in batch.rows('iso_alpha2', 'geoname_id'):
+                    if geoname_id and not code.startswith('ISO') and code != 'CS':
+                        geoname_ids[code] = geoname_id
         
         print "Importing Geoname objects for the countries in countryInfo.txt"
         cursor = connections['default'].cursor()
-        cursor.execute('BEGIN')
-        with open('allCountries.txt') as fd:
-            i = 0
-            for line in fd:
-                i += 1
-                if i % 100000 == 0:
-                    sys.stdout.write('.')
-                    sys.stdout.flush()
-
-                fields = line.split('\t')
-                geoname_id, name, ascii_name = fields[:3]
-                latitude, longitude, fclass, fcode, country_id, cc2 = fields[4:10]
-                
-                if not geoname_id in geoname_ids.values():
-                    continue
-                
-                population, elevation, gtopo30 = fields[14:17]
-                moddate = fields[18]
-                if elevation == '':
-                    elevation = 0
-
-                timezone_id = None
-                name = unicode(name,'utf-8')
-                admin1 = fields[10]
-                admin2 = fields[11]
-                admin3 = fields[12]
-                admin4 = fields[13]
-                admin1_id, admin2_id, admin3_id, admin4_id = [None] * 4
-                
-                try:
-                    # Delete existing entries first, then insert
-                    cursor.execute(u"DELETE FROM geoname WHERE id = %s", (geoname_id,))
-                    cursor.execute(u"INSERT INTO geoname (id, name, ascii_name, point, fclass, fcode, country_id, cc2, admin1_id, admin2_id, admin3_id, admin4_id, population, elevation, gtopo30, timezone_id, moddate) VALUES (%s, %s, %s, GeomFromText(%s, 4326), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (geoname_id, name, ascii_name, 'POINT(%s %s)' % (longitude, latitude), fclass, fcode, country_id, cc2, admin1_id, admin2_id, admin3_id, admin4_id, population, elevation, gtopo30, timezone_id, moddate))
-                except Exception, e:
-                    print 'Error: %s' % e
-                    continue
-        
+        extractor = GeonameExtractor(ids=geoname_ids.values())
+        extractor.extract(cursor)
         print 'Done!'
-        cursor.execute('COMMIT')
-        
+
         print "Mapping countries to the new geonames that were created"
-        for country in Country.objects.all():
-            if country.iso_alpha2 in geoname_ids.keys():
-                try:
-                    g = Geoname.objects.get(id=geoname_ids[country.iso_alpha2])
-                    country.geoname = g
-                    country.save()
-                except Geoname.DoesNotExist:
-                    pass
+        found = dict((code, id) for code, id in geoname_ids.items() if id in extractor.found)
+        cursor.execute('BEGIN')
+        set_country_geonames(cursor, found)
+        cursor.execute('COMMIT')
         print "Complete! Countries should now be available for querying."
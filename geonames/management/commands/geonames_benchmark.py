@@ -0,0 +1,180 @@
+"""
+Measures the import offline, over a synthetic dump written by
+geonames.synthetic instead of the files of download.geonames.org.
+
+The importer is the one of the database engine of the settings, so the
+PostgreSQL and MySQL importers are compared by running the command once with
+the settings of each, against local databases whose data it flushes::
+
+    ./manage.py geonames_benchmark --scale 1000000 --settings=bench_postgis --output pg.json
+    ./manage.py geonames_benchmark --scale 1000000 --settings=bench_mysql --output mysql.json
+
+With --compare-bulk, the import is run twice over the same dump, with the
+bulk loader of the database (COPY or LOAD DATA INFILE) and with INSERTs,
+and the rows/s of each stage are printed side by side.
+"""
+
+from __future__ import with_statement
+
+import json
+import optparse
+import os
+import sys
+import tempfile
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+
+from geonames.management.commands.geonames_import import IMPORTERS
+from geonames.synthetic import DumpGenerator
+
+class Command(BaseCommand):
+    help = "Imports a synthetic geonames dump and reports the speed and memory of each stage."
+
+    option_list = BaseCommand.option_list + (
+        optparse.make_option('--scale',
+            type='int',
+            dest='scale',
+            default=100000,
+            help='The number of geonames in the synthetic dump.',
+        ),
+        optparse.make_option('--seed',
+            type='int',
+            dest='seed',
+            default=0,
+            help='The seed of the generator, the same seed giving the same dump.',
+        ),
+        optparse.make_option('--workers',
+            type='int',
+            dest='workers',
+            default=1,
+            help='The number of processes of the import, as for geonames_import.',
+        ),
+        optparse.make_option('--no-bulk',
+            action='store_false',
+            dest='bulk',
+            default=True,
+            help='Insert one row at a time instead of using the bulk loader of the database.',
+        ),
+        optparse.make_option('--compare-bulk',
+            action='store_true',
+            dest='compare_bulk',
+            default=False,
+            help='Import the dump with the bulk loader, then with INSERTs, and compare the rows/s '
+                 'of each stage.',
+        ),
+        optparse.make_option('--output',
+            dest='output',
+            metavar='FILE',
+            help='Write the metrics of each stage to FILE, as JSON.',
+        ),
+        optparse.make_option('--check-code-maps',
+            action='store_true',
+            dest='check_code_maps',
+            default=False,
+            help='Check that the admin code maps rebuilt from the database, as a resumed '
+                 'or incremental import does, match the ones the import built.',
+        ),
+        optparse.make_option('--noinput',
+            action='store_false',
+            dest='interactive',
+            default=True,
+            help='Do not ask before flushing the database.',
+        ),
+    )
+
+    def handle(self, *args, **options):
+        database = settings.DATABASES['default']
+        try:
+            importer = IMPORTERS[database['ENGINE']]
+        except KeyError:
+            sys.stderr.write('Sorry, database engine "%s" is not supported' % database['ENGINE'])
+            sys.exit(1)
+        output = options['output'] and os.path.abspath(options['output'])
+
+        modes = options['compare_bulk'] and [True, False] or [options['bulk']]
+        summaries = []
+        for bulk in modes:
+            summary, mismatches = self.run_import(importer, database, bulk, options)
+            summaries.append(summary)
+            self.print_summary(summary)
+
+            if options['check_code_maps']:
+                print '%d divisions filed differently by the maps rebuilt from the database' % len(mismatches)
+                for path, built, loaded in mismatches[:20]:
+                    print '  %s: %s in this run, %s rebuilt' % ('.'.join(path), built, loaded)
+                if mismatches:
+                    sys.exit(1)
+
+        if options['compare_bulk']:
+            self.print_comparison(*summaries)
+
+        if output:
+            with open(output, 'w') as fd:
+                if options['compare_bulk']:
+                    json.dump({'bulk': summaries[0], 'insert': summaries[1]}, fd, indent=2)
+                else:
+                    json.dump(summaries[0], fd, indent=2)
+
+    def run_import(self, importer, database, bulk, options):
+        """
+        Imports a synthetic dump into the flushed database, and returns the
+        metrics of the import and the mismatches of the code maps, if checked.
+        """
+        call_command('flush', interactive=options['interactive'])
+
+        # The dump is written again for each import, which removes it once done
+        tmpdir = tempfile.mkdtemp(prefix='geonames_benchmark')
+        print 'Writing a synthetic dump of %d geonames to %s' % (options['scale'], tmpdir)
+        geonames, alternate_names = DumpGenerator(options['scale'], options['seed']).write(tmpdir)
+        size = sum(os.path.getsize(os.path.join(tmpdir, name)) for name in os.listdir(tmpdir))
+        print '%d geonames, %d alternate names, %.1f MB' % (geonames, alternate_names,
+                                                            size / 1048576.0)
+
+        imp = importer(
+            host=database.get('HOST', None),
+            user=database['USER'],
+            password=database['PASSWORD'],
+            db=database['NAME'],
+            tmpdir=tmpdir,
+            verbose=int(options['verbosity']) > 1,
+            bulk=bulk,
+            workers=options['workers'],
+        )
+        # The import runs from within the directory of the dump, which is
+        # used as it is instead of being fetched
+        os.chdir(tmpdir)
+        imp.get_db_conn()
+        imp.import_all()
+        mismatches = options['check_code_maps'] and imp.check_code_maps() or []
+        imp.cleanup()
+
+        summary = imp.metrics_summary()
+        summary.update({'importer': importer.__name__, 'scale': options['scale'],
+                        'seed': options['seed'], 'workers': options['workers'],
+                        'bulk': bulk, 'dump_bytes': size})
+        return summary, mismatches
+
+    def print_summary(self, summary):
+        print '%-24s %10s %10s %8s %10s' % ('Stage', 'Rows', 'Rows/s', 'Seconds', 'Memory MB')
+        for stats in summary['stages']:
+            print '%-24s %10d %10d %8.1f %10d' % (stats['stage'], stats['rows_written'],
+                stats['rows_per_second'], stats['seconds'], stats['peak_memory_mb'])
+        print '%-24s %10d %10d %8.1f' % ('Total', summary['rows_written'],
+            summary['rows_written'] / max(summary['seconds'], 0.001), summary['seconds'])
+
+    def print_comparison(self, bulk, insert):
+        """
+        Prints the rows/s of the stages of the import with the bulk loader
+        next to those of the import with INSERTs.
+        """
+        print '%-24s %10s %10s %8s' % ('Stage', 'Bulk', 'INSERT', 'Speedup')
+        inserted = dict((stats['stage'], stats) for stats in insert['stages'])
+        for stats in bulk['stages']:
+            other = inserted.get(stats['stage'])
+            if not other or not stats['rows_written']:
+                continue
+            print '%-24s %10d %10d %7.1fx' % (stats['stage'], stats['rows_per_second'],
+                other['rows_per_second'], stats['rows_per_second'] / max(other['rows_per_second'], 0.001))
+        rates = [summary['rows_written'] / max(summary['seconds'], 0.001) for summary in (bulk, insert)]
+        print '%-24s %10d %10d %7.1fx' % ('Total', rates[0], rates[1], rates[0] / max(rates[1], 0.001))
@@ -1,8 +1,20 @@
 from __future__ import with_statement
 
+import multiprocessing
+import io
+import itertools
+import json
 import optparse
 import os
+import re
+import resource
+import shutil
+import struct
 import sys
+import threading
+import time
+import zipfile
+from binascii import hexlify
 from warnings import filterwarnings
 from getpass import getpass
 from datetime import date
@@ -10,6 +22,11 @@ from django.conf import settings
 from django.core.management import call_command
 from django.core.management.base import BaseCommand
 from django.db import connections, DEFAULT_DB_ALIAS
+from geonames import dumps, snapshot
+from geonames.download import Downloader, DownloadError, MANIFEST_FILE
+from geonames.search import TRIGRAM_TABLE, TRIGRAM_COLUMNS, SEARCH_NAME_TABLE, SEARCH_NAME_COLUMNS, \
+    NOT_NAMES, search_key, trigrams
+from geonames.admincodes import AdminCodes
 
 PREFIX = 'http://download.geonames.org/export/dump/'
 
@@ -33,10 +50,65 @@ CONTINENT_CODES = [
     ['AN', 'Antarctica', 6255152],
 ]
 
+FCODE_COLUMNS = ('code', 'fclass', 'name', 'description')
+LANGUAGE_COLUMNS = ('iso_639_3', 'iso_639_2', 'iso_639_1', 'language_name')
+ALTERNATE_NAME_COLUMNS = ('id', 'geoname_id', 'language', 'name', 'preferred', 'short')
+TIME_ZONE_COLUMNS = ('id', 'name', 'gmt_offset', 'dst_offset')
+CONTINENT_COLUMNS = ('code', 'name', 'geoname_id')
+COUNTRY_COLUMNS = ('iso_alpha2', 'iso_alpha3', 'iso_numeric', 'fips_code',
+    'name', 'capital', 'area', 'population', 'continent_id', 'tld',
+    'currency_code', 'currency_name', 'phone_prefix', 'postal_code_fmt',
+    'postal_code_re', 'languages', 'geoname_id')
+ADMIN1_COLUMNS = ('id', 'country_id', 'geoname_id', 'code', 'name', 'ascii_name')
+ADMIN2_COLUMNS = ('id', 'country_id', 'admin1_id', 'geoname_id', 'code', 'name',
+    'ascii_name', 'full_code')
+ADMIN3_COLUMNS = ('id', 'country_id', 'admin1_id', 'admin2_id', 'geoname_id',
+    'code', 'name', 'ascii_name', 'full_code')
+ADMIN4_COLUMNS = ('id', 'country_id', 'admin1_id', 'admin2_id', 'admin3_id',
+    'geoname_id', 'code', 'name', 'ascii_name', 'full_code')
+
+GEONAME_COLUMNS = ('id', 'name', 'ascii_name', 'point', 'fclass', 'fcode',
+    'country_id', 'cc2', 'admin1_id', 'admin2_id', 'admin3_id', 'admin4_id',
+    'population', 'elevation', 'gtopo30', 'timezone_id', 'moddate')
+
+# Tables whose surrogate keys are allocated by the importer
+SERIAL_TABLES = ('time_zone', 'admin1_code', 'admin2_code', 'admin3_code',
+    'admin4_code', SEARCH_NAME_TABLE)
+
+# Columns added to the models after their tables were first created, added
+# to the tables of older databases with these definitions
+ADDED_COLUMNS = (
+    ('admin2_code', 'full_code', "VARCHAR(200) NOT NULL DEFAULT ''"),
+    ('admin3_code', 'full_code', "VARCHAR(200) NOT NULL DEFAULT ''"),
+    ('admin4_code', 'full_code', "VARCHAR(200) NOT NULL DEFAULT ''"),
+)
+
+# Progress of an interrupted import, and the geonames it held back, kept in
+# the temporary directory next to the downloaded files
+CHECKPOINT_FILE = 'import.checkpoint'
+DEFERRED_FILE = 'deferred_geonames.txt'
+
 class GeonamesImporter(object):
+
+    # Rows committed at a time by the stages that can be resumed halfway
+    batch_size = 100000
+
+    # Whether index builds on the same table can run at the same time
+    concurrent_index_builds = True
+
+    # Selects the longitude and latitude of the point of a geoname
+    point_columns = 'ST_X(point), ST_Y(point)'
+    # The value of the point column of an INSERT, given as WKT
+    point_value = 'ST_GeomFromText(%s, 4326)'
+    # The schema the unqualified table names of the import resolve to
+    current_schema = 'current_schema()'
     
     def __init__(self, host=None, user=None, password=None, db=None,
-                 tmpdir='tmp', verbose=False, skip_altnames=False, cities=None):
+                 tmpdir='tmp', verbose=False, skip_altnames=False, cities=None,
+                 bulk=True, workers=1, resume=False, callback=None, countries=None,
+                 fclasses=None, fcodes=None, min_population=None, maintenance_memory=512,
+                 staging=False, altname_languages=None, preferred_only=False, base_url=PREFIX,
+                 keep_downloads=False):
         self.user = user
         self.password = password
         self.db = db
@@ -44,32 +116,59 @@ class GeonamesImporter(object):
         self.conn = None
         self.tmpdir = tmpdir
         self.curdir = os.getcwd()
+        self.base_url = base_url
+        self.keep_downloads = keep_downloads
+        self.next_ids = {}
+        # The first id allocated to each table in this run
+        self.first_ids = {}
+        self.fresh_tables = {}
         self.time_zones = {}
-        self.admin1_codes = {}
-        self.admin2_codes = {}
-        self.admin3_codes = {}
-        self.admin4_codes = {}
+        self.admin_codes = AdminCodes()
         self.verbose = verbose
         self.skip_altnames = bool(cities) or skip_altnames
         self.cities = cities
-        self.geonames_file = 'allCountries.zip'
+        self.bulk = bulk
+        self.workers = workers
+        self.maintenance_memory = maintenance_memory
+        self.staging = staging
+        self.staged_tables = []
+        self.countries = countries and frozenset(countries)
+        self.fclasses = fclasses and frozenset(fclasses)
+        self.fcodes = fcodes and frozenset(fcodes)
+        self.min_population = min_population
+        self.subset = bool(countries or fclasses or fcodes or min_population)
+        # Compared regardless of case, since the file has codes such as zh-CN
+        self.altname_languages = altname_languages and \
+            frozenset(code.lower() for code in altname_languages)
+        self.preferred_only = preferred_only
+        # The geonames kept by a subset import, to which alternate names are
+        # restricted
+        self.geoname_ids = None
+        self.resume = resume
+        self.progress = {'completed': [], 'stage': None, 'offset': 0, 'last_id': None,
+                         'deferred': 0, 'shards': [], 'divisions': False, 'rebuilt': []}
+        self.offset = 0
+        self.last_id = None
+        self.callback = callback
+        self.metrics = []
+        self.start_stage(None)
+        self.geonames_file = 'allCountries.txt'
         
-        self.zip_files = [self.geonames_file, 'alternateNames.zip']
+        self.zip_files = ['allCountries.zip', 'alternateNames.zip']
+        # The names of the files to download from base_url
+        self.files = [os.path.basename(f) for f in FILES]
         
         if self.skip_altnames or self.cities:
-            FILES.remove(PREFIX + 'alternateNames.zip')
+            self.files.remove('alternateNames.zip')
             self.zip_files.remove('alternateNames.zip')
-            FILES.append(PREFIX + 'iso-languagecodes.txt',)
+            self.files.append('iso-languagecodes.txt')
         if self.cities:
-            FILES.remove(PREFIX + self.geonames_file)
-            self.zip_files.remove(self.geonames_file)
+            self.files.remove('allCountries.zip')
+            self.zip_files.remove('allCountries.zip')
             
-            FILES.append(PREFIX + 'cities%s.zip' % self.cities)
+            self.files.append('cities%s.zip' % self.cities)
             self.zip_files.append('cities%s.zip' % self.cities)
             self.geonames_file = 'cities%s.txt' % self.cities
-        
-        import ipdb
-        ipdb.set_trace()
     
     def pre_import(self):
         pass
@@ -83,461 +182,1599 @@ class GeonamesImporter(object):
     def commit(self):
         pass
 
-    def last_row_id(self, table=None, pk=None):
+    def reset_sequence(self, table, next_id):
         raise NotImplementedError('This is a generic importer, use one of the subclasses')
 
     def get_db_conn(self):
         raise NotImplementedError('This is a generic importer, use one of the subclasses')
 
-    def set_import_date(self):
+    def connect(self):
+        raise NotImplementedError('This is a generic importer, use one of the subclasses')
+
+    def maintenance_settings(self):
+        return []
+
+    def swap_staging(self):
+        raise NotImplementedError('This is a generic importer, use one of the subclasses')
+
+    def stream(self, sql, params=()):
+        """
+        Yields the rows of ``sql``, read a batch at a time over a connection
+        of its own, so that they can be loaded as they are read. Only what
+        the previous stages committed is seen.
+        """
+        raise NotImplementedError('This is a generic importer, use one of the subclasses')
+
+    def index_names(self, ids=None):
+        """
+        Updates the index of the substring search of geoname names for the
+        geonames ``ids``, or builds it for all of them. Backends indexing
+        the names themselves have nothing to do.
+        """
+        pass
+
+    def search_name_rows(self, names, alternate_names):
+        """
+        Yields the ``search_name`` rows of ``names``, ``(geoname_id, name,
+        ascii_name)`` rows of geonames, and of ``alternate_names``,
+        ``(geoname_id, language, name, preferred, geoname_name,
+        geoname_ascii_name)`` rows. An alternate name is left out if it is
+        the name of its geoname, unless preferred.
+        """
+        for geoname_id, name, ascii_name in names:
+            for key in set([search_key(name), search_key(ascii_name)]):
+                if key:
+                    yield (self.next_id(SEARCH_NAME_TABLE), geoname_id, key, '', False)
+        for geoname_id, language, name, preferred, geoname_name, geoname_ascii_name in alternate_names:
+            if language in NOT_NAMES:
+                continue
+            key = search_key(name)
+            if not key:
+                continue
+            if not preferred and key in (search_key(geoname_name), search_key(geoname_ascii_name)):
+                continue
+            yield (self.next_id(SEARCH_NAME_TABLE), geoname_id, key, language, bool(preferred))
+
+    def index_search_names(self, ids=None):
+        """
+        Writes the ``search_name`` rows of the geonames ``ids``, or rebuilds
+        the table for all of them, from the names and alternate names in the
+        database. The full build streams them from the tables.
+        """
+        names_sql = 'SELECT id, name, ascii_name FROM geoname'
+        alternates_sql = 'SELECT a.geoname_id, a.language, a.name, a.preferred, g.name, g.ascii_name ' \
+                         'FROM alternate_name a JOIN geoname g ON g.id = a.geoname_id'
+        if ids is None:
+            if self.verbose:
+                print 'Indexing the names and alternate names'
+            self.cursor.execute('TRUNCATE TABLE %s' % SEARCH_NAME_TABLE)
+            self.fresh_tables.pop(SEARCH_NAME_TABLE, None)
+            # Set before the load, which the cursor is busy with
+            self.next_ids[SEARCH_NAME_TABLE] = self.first_ids[SEARCH_NAME_TABLE] = 1
+            self.load(SEARCH_NAME_TABLE, SEARCH_NAME_COLUMNS, itertools.chain(
+                self.search_name_rows(self.stream(names_sql), ()),
+                self.search_name_rows((), self.stream(alternates_sql))))
+            return
+        self.delete_rows(SEARCH_NAME_TABLE, 'geoname_id', ids)
+        for batch in batches(list(ids)):
+            values = ', '.join(['%s'] * len(batch))
+            self.cursor.execute('%s WHERE id IN (%s)' % (names_sql, values), batch)
+            names = self.cursor.fetchall()
+            self.cursor.execute('%s WHERE a.geoname_id IN (%s)' % (alternates_sql, values), batch)
+            rows = list(self.search_name_rows(names, self.cursor.fetchall()))
+            if rows:
+                self.load_rows(SEARCH_NAME_TABLE, SEARCH_NAME_COLUMNS, rows)
+
+    def alternate_name_geonames(self, ids):
+        """
+        Returns the set of the geonames the alternate names ``ids`` belong to.
+        """
+        geoname_ids = set()
+        for batch in batches(list(ids)):
+            self.cursor.execute('SELECT geoname_id FROM alternate_name WHERE id IN (%s)' % \
+                                ', '.join(['%s'] * len(batch)), batch)
+            geoname_ids.update(row[0] for row in self.cursor.fetchall())
+        return geoname_ids
+
+    def create_staging_tables(self, sql):
+        """
+        Creates the tables of a staging import from the statements of
+        ``sql``, leaving out the indexes and constraints, which are returned
+        to be added once the tables are loaded. ``geonames_update`` is left
+        out, since it keeps the history of the live tables.
+        """
+        deferred = []
+        for stmt in sql:
+            match = CREATE_TABLE_RE.match(stmt)
+            tables = match and set([match.group(1)]) or statement_tables(stmt)[0]
+            if 'geonames_update' in tables:
+                continue
+            if match:
+                self.staged_tables.append(match.group(1))
+            if INDEX_STMT_RE.match(stmt) or ADD_CONSTRAINT_RE.match(stmt):
+                deferred.append(stmt)
+            elif self.done('pre_import'):
+                continue
+            elif match or TABLE_STMT_RE.match(stmt) or 'AddGeometryColumn' in stmt:
+                # Functions and other custom SQL are already in the database
+                self.cursor.execute(stmt)
+        return deferred
+
+    def set_import_date(self, updated=None):
         raise NotImplementedError('This is a generic importer, use one of the subclasses')
 
+    def write_snapshot(self, filename):
+        """
+        Writes a snapshot of the imported geonames to ``filename``, to be read
+        with ``geonames.snapshot.Snapshot``.
+        """
+        if self.verbose:
+            print 'Writing a snapshot to %s' % filename
+        self.start_stage('snapshot')
+        self.stats['rows_written'] = snapshot.build(self.cursor, filename, self.point_columns, self.stream)
+        self.report(final=True)
+
     def fetch(self):
-        try:
+        """
+        Downloads the dump files into the temporary directory, revalidating
+        those already there and resuming those partly downloaded. A resumed
+        import keeps the files it started with.
+
+        The files extracted from the archives, which ``open_dump`` reads
+        instead of them, are removed unless resuming, along with those of
+        the archives downloaded again, so that an interrupted import can't
+        leave older data behind for the next one.
+        """
+        if not os.path.isdir(self.tmpdir):
             os.mkdir(self.tmpdir)
-            os.chdir(self.tmpdir)
-        except OSError:
-            os.chdir(self.tmpdir)
+        os.chdir(self.tmpdir)
+        if self.resume and all(os.path.exists(f) for f in self.files):
             if self.verbose:
-                print 'Temporary directory %s exists, using already downloaded data'%self.tmpdir
+                print 'Resuming, using the files already downloaded to %s' % self.tmpdir
             return
+        if not self.resume:
+            keep = set(self.files + [MANIFEST_FILE])
+            for f in os.listdir('.'):
+                # Part files are resumed by the downloader
+                if f not in keep and not (f.endswith('.part') and f[:-len('.part')] in keep):
+                    os.unlink(f)
+        try:
+            downloaded = Downloader(self.base_url, verbose=self.verbose).fetch(self.files)
+        except DownloadError, e:
+            sys.stderr.write('%s\n' % e)
+            sys.exit(1)
+        for archive in downloaded:
+            if archive in self.zip_files:
+                zf = zipfile.ZipFile(archive)
+                for name in zf.namelist():
+                    if os.path.exists(name):
+                        os.unlink(name)
+                zf.close()
 
-        for f in FILES:
-            if os.system('wget %s' % f) != 0:
-                sys.stderr.write('Error fetching %s' % os.path.basename(f))
-                sys.exit(1)
+    def open_dump(self, name):
+        """
+        Opens one of the dump files. Files that haven't been extracted are
+        read straight from the archive they came in, decompressing as they
+        are read, so the archives never need to be inflated on disk.
+        """
+        if os.path.exists(name):
+            return open(name)
+        for archive in self.zip_files:
+            if not os.path.exists(archive):
+                continue
+            zf = zipfile.ZipFile(archive)
+            if name in zf.namelist():
+                # ZipExtFile reads lines a few bytes at a time, so buffer it
+                return io.BufferedReader(zf.open(name), 1 << 20)
+            zf.close()
+        raise IOError('%s was not found, nor in any of %s' % (name, ', '.join(self.zip_files)))
 
-        for f in self.zip_files:
-            if os.system('unzip %s' % f) != 0:
-                sys.stderr.write('Error unzipping %s' % f)
-                sys.exit(1)
+    def dump_path(self, name):
+        """
+        Returns the path of a dump file on disk, extracting it from its
+        archive first if needed, for the uses that have to seek in it or hand
+        it to the database server.
+        """
+        if not os.path.exists(name):
+            with self.open_dump(name) as src:
+                with open(name, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+        return name
+
+    def dump_size(self, name):
+        if os.path.exists(name):
+            return os.path.getsize(name)
+        for archive in self.zip_files:
+            if os.path.exists(archive):
+                zf = zipfile.ZipFile(archive)
+                try:
+                    return zf.getinfo(name).file_size
+                except KeyError:
+                    pass
+                finally:
+                    zf.close()
+        return 0
+
+    def dump_lines(self, name, start=0, end=None):
+        """
+        Yields the lines of a dump file, or of a byte range of it, keeping
+        the position past the last line yielded in ``offset``. The lines and
+        bytes read are added to the metrics of the current stage.
+        """
+        self.offset = start
+        lines = self.open_lines(name, start, end)
+        stats = self.stats
+        count, counted = 0, start
+        try:
+            for line in lines:
+                self.offset += len(line)
+                count += 1
+                if count == METRICS_INTERVAL:
+                    stats['rows_read'] += count
+                    stats['bytes_read'] += self.offset - counted
+                    count, counted = 0, self.offset
+                    self.report()
+                yield line
+        finally:
+            lines.close()
+            stats['rows_read'] += count
+            stats['bytes_read'] += self.offset - counted
+
+    def open_lines(self, name, start=0, end=None):
+        """
+        Returns an iterator over the lines of a dump file, or of a byte range
+        of it, adding its size to the metrics of the current stage.
+        """
+        if start or end is not None:
+            path = self.dump_path(name)
+            size = (end is None and os.path.getsize(path) or end) - start
+            lines = read_lines(path, start, end)
+        else:
+            size = self.dump_size(name)
+            lines = self.open_dump(name)
+        self.stats['bytes_total'] += size
+        return lines
+
+    def dump_batches(self, name, format, start=0, end=None):
+        """
+        Yields the ``dumps.Batch`` objects of a dump file, or of a byte range
+        of it, with the offsets past their rows. The lines are read a chunk
+        at a time, and the metrics updated once per batch.
+        """
+        self.offset = start
+        lines = self.open_lines(name, start, end)
+        stats = self.stats
+        counted = start
+        try:
+            for batch in dumps.read_batches(lines, format, start=start):
+                if len(batch):
+                    stats['rows_read'] += len(batch)
+                    stats['bytes_read'] += batch.ends[-1] - counted
+                    counted = batch.ends[-1]
+                    self.report()
+                yield batch
+        finally:
+            lines.close()
+
+    def batch_fields(self, batches):
+        """
+        Returns an iterator over ``(end, fields)`` for the rows of
+        ``batches``, ``end`` being the offset past the row. The stages that
+        load in batches keep the ``end`` of the row they last yielded in
+        ``offset``, so that their commits are checkpointed where that row
+        ends rather than where the parser stopped reading.
+        """
+        return itertools.chain.from_iterable(itertools.izip(batch.ends, batch.string_rows())
+                                             for batch in batches)
 
     def cleanup(self):
         os.chdir(self.curdir)
+        keep = self.keep_downloads and set(self.files + [MANIFEST_FILE]) or set()
         for f in os.listdir(self.tmpdir):
-            os.unlink('%s/%s' % (self.tmpdir, f))
-        os.rmdir(self.tmpdir)
+            if f not in keep:
+                os.unlink('%s/%s' % (self.tmpdir, f))
+        if not keep:
+            os.rmdir(self.tmpdir)
 
     def handle_exception(self, e, line=None):
         if line:
             sys.stderr.write("Encountered an error trying to import this line:\n%s\n\n" % line)
         raise e
 
-    def table_count(self, table):
-        self.cursor.execute(u'SELECT COUNT(*) FROM %s' % table)
-        return self.cursor.fetchone()[0]
+    def decode(self, value, line=None):
+        try:
+            return unicode(value, 'utf-8')
+        except Exception, e:
+            self.handle_exception(e, line)
 
-    def import_fcodes(self):
+    def load_rows(self, table, columns, rows):
+        """
+        Inserts ``rows``, an iterable of tuples ordered like ``columns``, into
+        ``table`` and returns the number of rows written. The ``point`` column
+        is given as a ``(longitude, latitude)`` pair. Rows whose key, the first
+        column, is already in the table replace the existing ones, and are
+        counted as conflicts.
+
+        This is the generic path, issuing one INSERT per row. Subclasses
+        override it with a bulk loader where the backend has one.
+        """
+        values = []
+        for column in columns:
+            if column == 'point':
+                values.append(self.point_value)
+            else:
+                values.append('%s')
+        stmt = u'INSERT INTO %s (%s) VALUES (%s) %s' % (table, ', '.join(columns), ', '.join(values),
+                                                        self.upsert_clause(columns, returning=True))
+        try:
+            point = columns.index('point')
+        except ValueError:
+            point = None
+        count = conflicts = 0
+        for row in rows:
+            if point is not None:
+                row = list(row)
+                row[point] = 'POINT(%s %s)' % row[point]
+            self.cursor.execute(stmt, row)
+            count += 1
+            conflicts += self.conflicted()
+        self.stats['conflicts'] += conflicts
+        return count
+
+    def upsert_clause(self, columns, returning=False):
+        """
+        Returns the clause of an INSERT into ``columns`` updating the row
+        already there with the same key instead of failing. With
+        ``returning``, the statement tells ``conflicted`` whether it did.
+        """
+        return ''
+
+    def conflicted(self):
+        return False
+
+    def is_fresh(self, table):
+        """
+        Tells whether ``table`` was empty when this run first loaded it, in
+        which case the rows the run writes to it can't conflict and can be
+        bulk loaded straight into it.
+        """
+        if table not in self.fresh_tables:
+            self.cursor.execute('SELECT 1 FROM %s LIMIT 1' % table)
+            self.fresh_tables[table] = self.cursor.fetchone() is None
+        return self.fresh_tables[table]
+
+    def merge_rows(self, table, columns, rows):
+        """
+        Bulk loads ``rows`` into a temporary copy of ``table``, then merges it
+        into the table, replacing the rows with the same key, which are
+        counted as conflicts. Returns the number of rows loaded.
+        """
+        temp = '%s_load' % table
+        self.create_temp_table(temp, table)
+        count = self.bulk_load(temp, columns, rows)
+        key = columns[0]
+        self.cursor.execute('SELECT COUNT(*) FROM %s JOIN %s ON %s.%s = %s.%s' % \
+            (table, temp, table, key, temp, key))
+        self.stats['conflicts'] += self.cursor.fetchone()[0]
+        self.cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s %s' % \
+            (table, ', '.join(columns), ', '.join(columns), temp, self.upsert_clause(columns)))
+        self.drop_temp_table(temp)
+        return count
+
+    def load(self, table, columns, rows, batches=False, flush=None):
+        """
+        Loads ``rows`` into ``table`` and returns the number of rows written,
+        updating the rows already there with the same key.
+
+        With ``batches``, the rows are committed ``batch_size`` at a time,
+        calling ``flush`` before each commit, and the position reached in the
+        dump file is checkpointed after it.
+        """
+        stats = self.stats
+        started, parsed, conflicts = time.time(), stats['parse_seconds'], stats['conflicts']
+        try:
+            if batches:
+                count = self.load_batches(table, columns, rows, flush)
+            else:
+                count = self.load_rows(table, columns, self.timed_rows(rows))
+        except Exception, e:
+            self.handle_exception(e)
+        elapsed = time.time() - started
+        stats['db_seconds'] += elapsed - (stats['parse_seconds'] - parsed)
+        stats['rows_written'] += count
+        stats['tables'][table] = stats['tables'].get(table, 0) + count
+        self.report()
         if self.verbose:
-            print 'Importing feature codes'
-        with open('featureCodes_en.txt') as fd:
-            for line in fd:
-                codes, name, desc = line.split('\t')
+            print '%d rows imported into %s in %.1f seconds (%d rows/s)' % \
+                (count, table, elapsed, count / max(elapsed, 0.001))
+            if stats['conflicts'] > conflicts:
+                print '  %d of them replaced rows already there' % (stats['conflicts'] - conflicts)
+        return count
+
+    def timed_rows(self, rows):
+        """
+        Yields ``rows``, adding the time spent reading and parsing them to
+        the metrics of the current stage. The time a load takes besides that
+        is counted as database time.
+        """
+        stats = self.stats
+        rows = iter(rows)
+        while True:
+            started = time.time()
+            chunk = list(itertools.islice(rows, 1000))
+            stats['parse_seconds'] += time.time() - started
+            if not chunk:
+                return
+            for row in chunk:
+                yield row
+
+    def load_batches(self, table, columns, rows, flush=None):
+        count = 0
+        while True:
+            batch = self.track_last_id(self.timed_rows(itertools.islice(rows, self.batch_size)))
+            loaded = self.load_rows(table, columns, batch)
+            count += loaded
+            if flush is not None:
+                flush()
+            self.commit()
+            self.checkpoint(offset=self.offset, last_id=self.last_id)
+            self.begin()
+            if loaded < self.batch_size:
+                return count
+
+    def track_last_id(self, rows):
+        for row in rows:
+            self.last_id = row[0]
+            yield row
+
+    def next_id(self, table):
+        """
+        Allocates the next primary key of one of the ``SERIAL_TABLES``. Keys
+        are handed out by the importer rather than the database, so the rows
+        can be bulk loaded with their ids already known, and the sequences
+        are brought up to date once in ``reset_sequences``.
+        """
+        try:
+            id = self.next_ids[table]
+        except KeyError:
+            id = self.first_ids[table] = self.first_free_id(table)
+        self.next_ids[table] = id + 1
+        return id
+
+    def division_id(self, table, path):
+        """
+        Returns the id of the division of ``table`` at ``path``, keeping the
+        one it has in the database if any, and files it under ``path``. A
+        division found twice in the same dump gets a new id the second time,
+        like the rows of the dump that come after it.
+        """
+        id = self.admin_codes.get(path)
+        if id is None or id >= self.first_ids.get(table, id + 1):
+            id = self.next_id(table)
+        self.admin_codes.add(path, id)
+        return id
+
+    def add_missing_columns(self):
+        """
+        Adds the ``ADDED_COLUMNS`` missing from the tables, as in databases
+        created before they were added to the models.
+        """
+        for table, column, definition in ADDED_COLUMNS:
+            self.cursor.execute('SELECT COUNT(*) FROM information_schema.columns WHERE table_schema = %s '
+                                'AND table_name = %%s AND column_name = %%s' % self.current_schema,
+                                (table, column))
+            if not self.cursor.fetchone()[0]:
+                if self.verbose:
+                    print 'Adding the %s column to %s' % (column, table)
+                self.cursor.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, definition))
+
+    def first_free_id(self, table):
+        self.cursor.execute(u'SELECT MAX(id) FROM %s' % table)
+        return (self.cursor.fetchone()[0] or 0) + 1
+
+    def reset_sequences(self):
+        for table in SERIAL_TABLES:
+            if table in self.next_ids:
+                self.reset_sequence(table, self.next_ids[table])
+
+    def keep_geoname(self, fields):
+        """
+        Tells whether the geoname with ``fields`` is part of the subset of the
+        dump being imported.
+        """
+        if self.countries and fields[8] not in self.countries:
+            return False
+        if self.fclasses and fields[6] not in self.fclasses:
+            return False
+        if self.fcodes and fields[7] not in self.fcodes:
+            return False
+        if self.min_population and int(fields[14] or 0) < self.min_population:
+            return False
+        return True
+
+    def kept_geonames(self, batch):
+        """
+        Returns the batch of the geonames of ``batch`` that are part of the
+        subset of the dump being imported, filtered a column at a time.
+        """
+        filters = ((self.countries, 'country_code'), (self.fclasses, 'fclass'), (self.fcodes, 'fcode'))
+        for values, column in filters:
+            if values:
+                batch = batch.select([value in values for value in batch.strings(column)])
+        if self.min_population:
+            minimum = self.min_population
+            batch = batch.select([population >= minimum for population in batch['population']])
+        return batch
+
+    def geoname_batches(self, start=0, end=None, filename=None):
+        for batch in self.dump_batches(filename or self.geonames_file, dumps.GEONAME, start, end):
+            if self.subset:
+                batch = self.kept_geonames(batch)
+            yield batch
+
+    def geoname_fields(self, start=0, end=None):
+        """
+        Returns an iterator over ``(end, fields)`` for the geonames of the
+        dump being imported, as ``batch_fields`` does.
+        """
+        return self.batch_fields(self.geoname_batches(start, end))
+
+    def load_geoname_ids(self):
+        """
+        Reads the ids of the geonames in the database into ``geoname_ids``.
+        """
+        self.geoname_ids = GeonameIds()
+        self.cursor.execute('SELECT id FROM geoname')
+        while True:
+            rows = self.cursor.fetchmany(10000)
+            if not rows:
+                break
+            for row in rows:
+                self.geoname_ids.add(row[0])
+
+    def fcode_rows(self):
+        for batch in dumps.read_batches(self.dump_lines('featureCodes_en.txt'), dumps.FEATURE_CODE):
+            for codes, name, desc in batch.rows():
                 try:
                     fclass, code = codes.split('.')
                 except ValueError:
                     continue
-                try:
-                    self.cursor.execute(u'INSERT INTO feature_code (code, fclass, name, description) VALUES (%s, %s, %s, %s)', (code, fclass, name, desc))
-                except Exception, e:
-                    if 'duplicate' in str(e).lower():
-                        if self.verbose:
-                            print "Skipping - data already populated"
-                        return True
-                    self.handle_exception(e, line)
+                yield (code, fclass, name, desc)
+
+    def import_fcodes(self):
         if self.verbose:
-            print '%d feature codes imported' % self.table_count('feature_code')
+            print 'Importing feature codes'
+        self.load('feature_code', FCODE_COLUMNS, self.fcode_rows())
+
+    def language_code_rows(self):
+        for batch in dumps.read_batches(self.dump_lines('iso-languagecodes.txt'), dumps.LANGUAGE_CODE):
+            # Skip lines with no ISO 639-3 definition, since it is the primary
+            # key
+            batch = batch.select(batch['iso_639_3'])
+            for row in batch.rows():
+                yield row
 
     def import_language_codes(self):
         if self.verbose:
             print 'Importing language codes'
-        with open('iso-languagecodes.txt') as fd:
-            fd.readline()
-            for line in fd:
-                fields = line.split('\t')
-                if not fields[0]:
-                    # Skip lines with no ISO 639-3 definition, since it is the
-                    # primary key
-                    continue
-                try:
-                    self.cursor.execute(u'INSERT INTO iso_language (iso_639_3, iso_639_2, iso_639_1, language_name) VALUES (%s, %s, %s, %s)', fields)
-                except Exception, e:
-                    if 'duplicate' in str(e).lower():
-                        if self.verbose:
-                            print "Skipping - data already populated"
-                        return True
-                    self.handle_exception(e)
-        if self.verbose:
-            print '%d language codes imported' % self.table_count('iso_language')
+        self.load('iso_language', LANGUAGE_COLUMNS, self.language_code_rows())
+
+    def alternate_name_rows(self, start=0, end=None, filename='alternateNames.txt'):
+        """
+        Yields the alternate names of ``filename`` in the languages imported,
+        and only the preferred and short ones with ``preferred_only``.
+        """
+        ids, languages, preferred_only = self.geoname_ids, self.altname_languages, self.preferred_only
+        for batch in self.dump_batches(filename, dumps.ALTERNATE_NAME, start, end):
+            if languages:
+                batch = batch.select([lang.lower() in languages for lang in batch.strings('language')])
+            if preferred_only:
+                batch = batch.select([preferred or short for preferred, short in
+                                      batch.rows('preferred', 'short')])
+            if ids is not None:
+                batch = batch.select([geoname_id in ids for geoname_id in batch['geoname_id']])
+            rows = itertools.izip(batch.ends, batch.strings('id'), batch.strings('geoname_id'),
+                                  batch.strings('language'), batch['name'], batch['preferred'],
+                                  batch['short'])
+            for end, id, geoname_id, lang, name, preferred, short in rows:
+                self.offset = end
+                yield (id, geoname_id, lang, name, bool(preferred), bool(short))
 
     def import_alternate_names(self):
         if self.verbose:
             print 'Importing alternate names (this is going to take a while)'
-        if hasattr(self,'import_file'):
-            return self.import_file('alternate_name','alternateNames.txt')
-        with open('alternateNames.txt') as fd:
-            i = 0
-            for line in fd:
-                i += 1
-                if i % 100000 == 0:
-                    sys.stdout.write('.')
-                    sys.stdout.flush()
-                id, geoname_id, lang, name, preferred, short = line.split('\t')
-                if preferred in ('', '0'):
-                    preferred = False
-                else:
-                    preferred = True 
-                if short in ('', '0'):
-                    short = False
-                else:
-                    short = True
-                try:
-                    self.cursor.execute(u'INSERT INTO alternate_name (id, geoname_id, language, name, preferred, short) VALUES (%s, %s, %s, %s, %s, %s)', (id, geoname_id, lang, name, preferred, short))
-                except Exception, e:
-                    if 'duplicate' in str(e).lower():
-                        if self.verbose:
-                            print "Skipping - data already populated"
-                        return True
-                    self.handle_exception(e, line)
-        if self.verbose:
-            print '\n%d alternate names imported' % self.table_count('alternate_name')
-    
+        if self.subset:
+            self.load_geoname_ids()
+        if self.workers > 1:
+            # Checked before the workers fork, as they see each other's rows
+            self.is_fresh('alternate_name')
+            self.map_shards('load_alternate_name_shard', 'alternateNames.txt', checkpoint=True)
+        else:
+            self.load('alternate_name', ALTERNATE_NAME_COLUMNS,
+                      self.alternate_name_rows(self.progress['offset']), batches=True)
+
+    def load_alternate_name_shard(self, start, end):
+        return self.load('alternate_name', ALTERNATE_NAME_COLUMNS,
+                         self.alternate_name_rows(start, end))
+
     def import_time_zones(self):
         if self.verbose:
             print 'Importing time zones'
-        with open('timeZones.txt') as fd:
-            fd.readline()
-            for line in fd:
-                name, gmt, dst = line.split('\t')
-                try:
-                    self.cursor.execute(u'INSERT INTO time_zone (name, gmt_offset, dst_offset) VALUES (%s, %s, %s)', (name, gmt, dst))
-                except Exception, e:
-                    if 'duplicate' in str(e).lower():
-                        if self.verbose:
-                            print "Skipping - data already populated"
-                        return True
-                    self.handle_exception(e, line)
-
-                self.time_zones[name] = self.last_row_id('time_zone', 'id')
-        if self.verbose:
-            print '%d time zones imported' % self.table_count('time_zone')
+        rows = []
+        for batch in dumps.read_batches(self.dump_lines('timeZones.txt'), dumps.TIME_ZONE):
+            for name, gmt, dst in batch.rows():
+                id = self.time_zones.get(name) or self.next_id('time_zone')
+                self.time_zones[name] = id
+                rows.append((id, name, gmt, dst))
+        self.load('time_zone', TIME_ZONE_COLUMNS, rows)
+
+    def continent_rows(self):
+        for code, name, geoname_id in CONTINENT_CODES:
+            if self.cities:
+                geoname_id = None
+            yield (code, name, geoname_id)
 
     def import_continent_codes(self):
-        for continent in CONTINENT_CODES:
+        self.load('continent', CONTINENT_COLUMNS, self.continent_rows())
+
+    def country_rows(self):
+        names = dumps.COUNTRY_INFO.names[:len(COUNTRY_COLUMNS)]
+        for batch in dumps.read_batches(self.dump_lines('countryInfo.txt'), dumps.COUNTRY_INFO):
+            batch = batch.select([not code.startswith('ISO') and code != 'CS'
+                                  for code in batch['iso_alpha2']])
+            columns = [batch.strings(name) for name in names]
+            columns[6] = [area.replace(',', '') or 0 for area in columns[6]]
+            columns[7] = [population.replace(',', '') for population in columns[7]]
             if self.cities:
-                continent[2] = None
-            try:
-                self.cursor.execute(u'INSERT INTO continent (code, name, geoname_id) VALUES (%s, %s, %s)', continent)
-            except Exception, e:
-                if 'duplicate' in str(e).lower():
-                    if self.verbose:
-                        print "Skipping - data already populated"
-                    return True
-                self.handle_exception(e)
-        if self.verbose:
-            print '%d continent codes imported' % self.table_count('continent')
+                columns[16] = [None] * len(batch)
+            for row in itertools.izip(*columns):
+                yield row
 
     def import_countries(self):
         if self.verbose:
             print 'Importing countries'
-        with open('countryInfo.txt') as fd:
-            for line in fd:
-                if line[0] == '#' or line.startswith('ISO') or line.startswith('CS'):
-                    continue
-                fields = line.split('\t')
-                #if len(fields) == 18:
-                #    fields.append('')
-                fields[6] = fields[6].replace(',', '')
-                fields[7] = fields[7].replace(',', '')
-                if fields[6] == '':
-                    fields[6] = 0
-                if self.cities:
-                    fields[16] = None
-                try:
-                    self.cursor.execute(u'INSERT INTO country (iso_alpha2, iso_alpha3, iso_numeric, fips_code, name, capital, area, population, continent_id, tld, currency_code, currency_name, phone_prefix, postal_code_fmt, postal_code_re, languages, geoname_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)', fields[:17])
-                except Exception, e:
-                    if 'duplicate' in str(e).lower():
-                        if self.verbose:
-                            print "Skipping - data already populated"
-                        return True
-                    self.handle_exception(e, line)
-        if self.verbose:
-            print '%d countries imported' % self.table_count('country')
+        self.load('country', COUNTRY_COLUMNS, self.country_rows())
 
     def import_first_level_adm(self):
         if self.verbose:
             print 'Importing first level administrative divisions'
-        with open('admin1CodesASCII.txt') as fd:
-            for line in fd:
-                country_and_code, name, ascii_name, geoname_id = line.split('\t')
+        rows = []
+        for batch in dumps.read_batches(self.dump_lines('admin1CodesASCII.txt'), dumps.ADMIN_CODE):
+            for country_and_code, name, ascii_name, geoname_id in batch.rows():
                 country_id, code = country_and_code.split('.')
                 if len(code) > 5:
                     # Skip this division, the code is longer than it should be
                     continue
-                try:
-                    name = unicode(name,'utf-8')
-                except Exception, e:
-                    self.handle_exception(e, line)
+                if self.countries and country_id not in self.countries:
+                    continue
                 if self.cities:
                     geoname_id = None
-                try:
-                    self.cursor.execute(u'INSERT INTO admin1_code (country_id, geoname_id, code, name, ascii_name) VALUES (%s, %s, %s, %s, %s)', (country_id, geoname_id, code, name, ascii_name))
-                except Exception, e:
-                    if 'duplicate' in str(e).lower():
-                        if self.verbose:
-                            print "Skipping - data already populated"
-                        return True
-                    self.handle_exception(e, line)
-
-                self.admin1_codes.setdefault(country_id, {})
-                self.admin1_codes[country_id][code] = self.last_row_id('admin1_code', 'id')
-        if self.verbose:
-            print '%d first level administrative divisions imported' % self.table_count('admin1_code')
+                id = self.division_id('admin1_code', (country_id, code))
+                rows.append((id, country_id, geoname_id, code, name, ascii_name))
+        self.load('admin1_code', ADMIN1_COLUMNS, rows)
 
     def import_second_level_adm(self):
         if self.verbose:
             print 'Importing second level administrative divisions'
-        with open('admin2Codes.txt') as fd:
-            for line in fd:
-                codes, name, ascii_name, geoname_id = line.split('\t')
+        rows = []
+        for batch in dumps.read_batches(self.dump_lines('admin2Codes.txt'), dumps.ADMIN_CODE):
+            for codes, name, ascii_name, geoname_id in batch.rows():
                 country_id, adm1, code = codes.split('.', 2)
-                try:
-                    name = unicode(name,'utf-8')
-                except Exception, e:
-                    self.handle_exception(e, line)
-                try:
-                    admin1 = self.admin1_codes[country_id][adm1]
-                except KeyError:
-                    admin1 = None
+                if self.countries and country_id not in self.countries:
+                    continue
+                admin1 = self.admin_codes.get((country_id, adm1))
                 if self.cities:
                     geoname_id = None
-                try:
-                    self.cursor.execute(u'INSERT INTO admin2_code (country_id, admin1_id, geoname_id, code, name, ascii_name) VALUES (%s, %s, %s, %s, %s, %s)', (country_id, admin1, geoname_id, code, name, ascii_name))
-                except Exception, e:
-                    if 'duplicate' in str(e).lower():
-                        if self.verbose:
-                            print "Skipping - data already populated"
-                        return True
-                    self.handle_exception(e, line)
-
-                self.admin2_codes.setdefault(country_id, {})
-                self.admin2_codes[country_id].setdefault(adm1, {})
-                self.admin2_codes[country_id][adm1][code] = self.last_row_id('admin2_code', 'id') 
-        if self.verbose:
-            print '%d second level administrative divisions imported' % self.table_count('admin2_code')
+                id = self.division_id('admin2_code', (country_id, adm1, code))
+                rows.append((id, country_id, admin1, geoname_id, code, name, ascii_name, codes))
+        self.load('admin2_code', ADMIN2_COLUMNS, rows)
 
-    def import_third_level_adm(self):
-        if self.verbose:
-            print 'Importing third level administrative divisions'
-        with open(self.geonames_file) as fd:
-            for line in fd:
-                fields = line.split('\t')
-                fcode = fields[7]
-                if fcode != 'ADM3':
-                    continue
-                geoname_id = fields[0]
-                name = fields[1]
-                try:
-                    name = unicode(name,'utf-8')
-                except Exception, e:
-                    self.handle_exception(e, line)
-                ascii_name = fields[2]
-                country_id = fields[8]
-                admin1 = fields[10]
-                admin2 = fields[11]
-                admin3 = fields[12]
-                admin1_id, admin2_id = [None] * 2
-                if admin1:
-                    try:
-                        admin1_id = self.admin1_codes[country_id][admin1]
-                    except KeyError:
-                        pass
-                    if admin2:
-                        try:
-                            admin2_id = self.admin2_codes[country_id][admin1][admin2]
-                        except KeyError:
-                            pass
-                try:
-                    self.cursor.execute(u'INSERT INTO admin3_code (country_id, admin1_id, admin2_id, geoname_id, code, name, ascii_name) VALUES (%s, %s, %s, %s, %s, %s, %s)', (country_id, admin1_id, admin2_id, geoname_id, admin3, name, ascii_name))
-                except Exception, e:
-                    if 'duplicate' in str(e).lower():
-                        if self.verbose:
-                            print "Skipping - data already populated"
-                        return True
-                    self.handle_exception(e, line)
-
-                self.admin3_codes.setdefault(country_id, {})
-                self.admin3_codes[country_id].setdefault(admin1, {})
-                self.admin3_codes[country_id][admin1].setdefault(admin2, {})
-                self.admin3_codes[country_id][admin1][admin2][admin3] = self.last_row_id('admin3_code', 'id')
-        if self.verbose:
-            print '%d third level administrative divisions imported' % self.table_count('admin3_code')
+    def admin_ids(self, country_id, admin1, admin2, admin3='', admin4=''):
+        """
+        Resolves admin division codes to the ids of the admin tables. Returns
+        a tuple of four ids, None for any code that is blank or unknown.
+        """
+        return tuple(self.admin_codes.lookup(country_id, admin1, admin2, admin3, admin4))
 
-    def import_fourth_level_adm(self):
-        if self.verbose:
-            print 'Importing fourth level administrative divisions'
-        with open(self.geonames_file) as fd:
-            for line in fd:
-                fields = line.split('\t')
-                fcode = fields[7]
-                if fcode != 'ADM4':
-                    continue
-                geoname_id = fields[0]
-                name = fields[1]
-                try:
-                    name = unicode(name,'utf-8')
-                except Exception, e:
-                    self.handle_exception(e, line)
-                ascii_name = fields[2]
-                country_id = fields[8]
-                admin1 = fields[10]
-                admin2 = fields[11]
-                admin3 = fields[12]
-                admin4 = fields[13]
-                admin1_id, admin2_id, admin3_id = [None] * 3
-                if admin1:
-                    try:
-                        admin1_id = self.admin1_codes[country_id][admin1]
-                    except KeyError:
-                        pass
-                    if admin2:
-                        try:
-                            admin2_id = self.admin2_codes[country_id][admin1][admin2]
-                        except KeyError:
-                            pass
-                        if admin3:
-                            try:
-                                admin3_id = self.admin3_codes[country_id][admin1][admin2][admin3]
-                            except KeyError:
-                                pass
-                try:
-                    self.cursor.execute(u'INSERT INTO admin4_code (country_id, admin1_id, admin2_id, admin3_id, geoname_id, code, name, ascii_name) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)', (country_id, admin1_id, admin2_id, admin3_id, geoname_id, admin4, name, ascii_name))
-                except Exception, e:
-                    if 'duplicate' in str(e).lower():
-                        if self.verbose:
-                            print "Skipping - data already populated"
-                        return True
-                    self.handle_exception(e, line)
-
-                self.admin4_codes.setdefault(country_id, {})
-                self.admin4_codes[country_id].setdefault(admin1, {})
-                self.admin4_codes[country_id][admin1].setdefault(admin2, {})
-                self.admin4_codes[country_id][admin1][admin2].setdefault(admin3, {})
-                self.admin4_codes[country_id][admin1][admin2][admin3][admin4] = self.last_row_id('admin4_code', 'id')
-        if self.verbose:
-            print '%d fourth level administrative divisions imported' % self.table_count('admin4_code')
+    def add_third_level_adm(self, fields):
+        geoname_id, name, ascii_name = fields[:3]
+        country_id = fields[8]
+        admin1, admin2, admin3 = fields[10:13]
+        admin1_id, admin2_id = self.admin_ids(country_id, admin1, admin2)[:2]
+        path = (country_id, admin1, admin2, admin3)
+        id = self.division_id('admin3_code', path)
+        self.admin3_rows.append((id, country_id, admin1_id, admin2_id, geoname_id, admin3,
+                                 self.decode(name, '\t'.join(fields)), ascii_name, '.'.join(path)))
+
+    def add_fourth_level_adm(self, fields):
+        geoname_id, name, ascii_name = fields[:3]
+        country_id = fields[8]
+        admin1, admin2, admin3, admin4 = fields[10:14]
+        id = self.division_id('admin4_code', (country_id, admin1, admin2, admin3, admin4))
+        # The admin3 id is resolved once the whole file has been read, since
+        # the third level division may come later in the file
+        self.admin4_rows.append((id, fields, self.decode(name, '\t'.join(fields))))
+
+    def fourth_level_adm_rows(self):
+        for id, fields, name in self.admin4_rows:
+            country_id = fields[8]
+            admin1_id, admin2_id, admin3_id = self.admin_ids(country_id, *fields[10:13])[:3]
+            yield (id, country_id, admin1_id, admin2_id, admin3_id, fields[0], fields[13],
+                   name, fields[2], '.'.join((country_id,) + tuple(fields[10:14])))
+
+    def geoname_row(self, fields, defer=False):
+        """
+        Builds a geoname row from the fields of a dump line. With ``defer``,
+        returns None instead if the row belongs to a third or fourth level
+        division that has not been read yet.
+        """
+        id, name, ascii_name = fields[:3]
+        latitude, longitude, fclass, fcode, country_id, cc2 = fields[4:10]
+        if not fcode:
+            # Force blank fcodes to None so that they will be null
+            fcode = None
+        if not country_id:
+            # Same for country
+            country_id = None
+        admin1_id, admin2_id, admin3_id, admin4_id = self.admin_ids(country_id, *fields[10:14])
+        if defer and (fields[12] and admin3_id is None or fields[13] and admin4_id is None):
+            return None
+        population, elevation, gtopo30 = fields[14:17]
+        moddate = fields[18]
+        if elevation == '':
+            elevation = 0
+        timezone_id = self.time_zones.get(fields[17])
+        name = self.decode(name, '\t'.join(fields))
+        return (id, name, ascii_name, (longitude, latitude), fclass, fcode,
+                country_id, cc2, admin1_id, admin2_id, admin3_id, admin4_id,
+                population, elevation, gtopo30, timezone_id, moddate)
+
+    def geoname_rows(self, start=0):
+        """
+        Reads the geonames file once, yielding geoname rows and collecting the
+        third and fourth level divisions on the way. Rows that refer to a
+        division further down the file are written to ``DEFERRED_FILE``, to
+        be loaded once the whole file has been read.
+        """
+        for end, fields in self.geoname_fields(start):
+            if not self.cities:
+                if fields[7] == 'ADM3':
+                    self.add_third_level_adm(fields)
+                elif fields[7] == 'ADM4':
+                    self.add_fourth_level_adm(fields)
+            row = self.geoname_row(fields, defer=not self.cities)
+            if row is None:
+                self.deferred.write('\t'.join(fields) + '\n')
+                self.deferred_count += 1
+            else:
+                self.offset = end
+                yield row
+
+    def load_divisions(self):
+        """
+        Writes out the third and fourth level divisions collected so far.
+        """
+        tables = self.stats['tables']
+        for table, columns, rows in (('admin3_code', ADMIN3_COLUMNS, self.admin3_rows),
+                                     ('admin4_code', ADMIN4_COLUMNS, self.fourth_level_adm_rows())):
+            tables[table] = tables.get(table, 0) + self.load_rows(table, columns, rows)
+        self.admin3_rows, self.admin4_rows = [], []
+
+    def flush_divisions(self):
+        """
+        Writes out the divisions collected by ``geoname_rows`` and the rows it
+        deferred, so that they are committed along with the current batch.
+        """
+        self.load_divisions()
+        self.deferred.flush()
+        self.progress['deferred'] = self.deferred.tell()
+
+    def scan_divisions(self, start, end):
+        """
+        Returns the fields of the third and fourth level divisions found in a
+        shard of the geonames file.
+        """
+        fields = []
+        for line in self.dump_lines(self.geonames_file, start, end):
+            if '\tADM3\t' in line or '\tADM4\t' in line:
+                fields.append(line.rstrip('\n').split('\t'))
+        if self.subset:
+            fields = filter(self.keep_geoname, fields)
+        return fields
+
+    def load_geoname_shard(self, start, end):
+        rows = (self.geoname_row(fields) for offset, fields in self.geoname_fields(start, end))
+        return self.load('geoname', GEONAME_COLUMNS, rows)
 
     def import_geonames(self):
+        """
+        Imports geonames, and the third and fourth level administrative
+        divisions defined among them, in a single scan of the geonames file.
+
+        With several workers, the divisions are collected from all the shards
+        first, so that the geonames can then be loaded in parallel without
+        holding any rows back.
+        """
         if self.verbose:
             print 'Importing geonames (this is going to take a while)'
-        with open(self.geonames_file) as fd:
-            i = 0
-            for line in fd:
-                i += 1
-                if i % (self.cities and 10000 or 100000) == 0:
-                    sys.stdout.write('.')
-                    sys.stdout.flush()
-                fields = line.split('\t')
-                id, name, ascii_name = fields[:3]
-                latitude, longitude, fclass, fcode, country_id, cc2 = fields[4:10]
-                if not fcode:
-                    # Force blank fcodes to None so that they will be null
-                    fcode = None
-                if not country_id:
-                    # Same for country
-                    country_id = None
-                population, elevation, gtopo30 = fields[14:17]
-                moddate = fields[18]
-                if elevation == '':
-                    elevation = 0
-                try:
-                    timezone_id = self.time_zones[fields[17]]
-                except KeyError:
-                    timezone_id = None
-                try:
-                    name = unicode(name,'utf-8')
-                except Exception, e:
-                    self.handle_exception(e, line)
-                admin1 = fields[10]
-                admin2 = fields[11]
-                admin3 = fields[12]
-                admin4 = fields[13]
-                admin1_id, admin2_id, admin3_id, admin4_id = [None] * 4
-
-                if admin1:
-                    try:
-                        admin1_id = self.admin1_codes[country_id][admin1]
-                    except KeyError:
-                        pass
+        started = time.time()
+        self.admin3_rows, self.admin4_rows = [], []
+        # The divisions are allocated their ids while the geonames are being
+        # loaded, when the connection can't be used for queries
+        for table in ('admin3_code', 'admin4_code'):
+            if table not in self.next_ids:
+                self.next_ids[table] = self.first_ids[table] = self.first_free_id(table)
+        self.deferred_count = 0
+        if self.workers > 1:
+            if not self.cities and not self.progress['divisions']:
+                for shard in self.map_shards('scan_divisions', self.geonames_file):
+                    for fields in shard:
+                        if fields[7] == 'ADM3':
+                            self.add_third_level_adm(fields)
+                        elif fields[7] == 'ADM4':
+                            self.add_fourth_level_adm(fields)
+                self.load_divisions()
+                self.commit()
+                self.checkpoint(divisions=True)
+                self.begin()
+            self.is_fresh('geoname')
+            self.map_shards('load_geoname_shard', self.geonames_file, checkpoint=True)
+            return
 
-                if admin2:
-                    try:
-                        admin2_id = self.admin2_codes[country_id][admin1][admin2]
-                    except KeyError:
-                        pass
+        # Resume writing deferred rows where the last committed batch left off
+        size = self.progress['deferred']
+        self.deferred = open(DEFERRED_FILE, size and 'r+b' or 'wb')
+        self.deferred.truncate(size)
+        self.deferred.seek(size)
+        try:
+            self.load('geoname', GEONAME_COLUMNS, self.geoname_rows(self.progress['offset']),
+                      batches=True, flush=self.flush_divisions)
+        finally:
+            self.deferred.close()
+        if self.verbose:
+            print 'Geonames scanned in %.1f seconds, %d rows deferred, peak memory %d MB' % \
+                (time.time() - started, self.deferred_count,
+                 resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
 
-                if admin3:
-                    try:
-                        admin3_id = self.admin3_codes[country_id][admin1][admin2][admin3]
-                    except KeyError:
-                        pass
+    def deferred_rows(self, start=0):
+        batches = self.dump_batches(DEFERRED_FILE, dumps.GEONAME, start)
+        for end, fields in self.batch_fields(batches):
+            self.offset = end
+            yield self.geoname_row(fields)
 
-                if admin4:
-                    try:
-                        admin4_id = self.admin4_codes[country_id][admin1][admin2][admin3][admin4]
-                    except KeyError:
-                        pass
-                try:
-                    self.cursor.execute(u"INSERT INTO geoname (id, name, ascii_name, point, fclass, fcode, country_id, cc2, admin1_id, admin2_id, admin3_id, admin4_id, population, elevation, gtopo30, timezone_id, moddate) VALUES (%s, %s, %s, GeomFromText(%s, 4326), %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)", (id, name, ascii_name, 'POINT(%s %s)' % (longitude, latitude), fclass, fcode, country_id, cc2, admin1_id, admin2_id, admin3_id, admin4_id, population, elevation, gtopo30, timezone_id, moddate))
-                except Exception, e:
-                    if 'duplicate' in str(e).lower():
-                        if self.verbose:
-                            print "Skipping - data already populated"
-                        return True
-                    self.handle_exception(e, line)
-        if self.verbose:
-            print '\n%d geonames imported' % self.table_count('geoname')
+    def import_deferred_geonames(self):
+        """
+        Loads the geonames held back by ``import_geonames``, now that all the
+        divisions they refer to are known.
+        """
+        if os.path.exists(DEFERRED_FILE):
+            if self.verbose:
+                print 'Importing deferred geonames'
+            self.load('geoname', GEONAME_COLUMNS, self.deferred_rows(self.progress['offset']),
+                      batches=True)
+        if self.subset:
+            # Countries, continents and the divisions read from their own
+            # files may refer to geonames left out
+            for table in ('continent', 'country', 'admin1_code', 'admin2_code'):
+                self.cursor.execute('UPDATE %s SET geoname_id = NULL WHERE geoname_id IS NOT NULL '
+                                    'AND geoname_id NOT IN (SELECT id FROM geoname)' % table)
+        if not self.cities:
+            # Fourth level divisions read before their third level one were
+            # written without it, but their own geoname has it by now
+            self.cursor.execute('UPDATE admin4_code SET admin3_id = (SELECT admin3_id FROM geoname '
+                                'WHERE geoname.id = admin4_code.geoname_id) WHERE admin3_id IS NULL')
 
-    def import_all(self):
-        self.pre_import()
+    def map_shards(self, method, filename, checkpoint=False):
+        """
+        Splits ``filename`` into byte ranges and runs ``method`` over each of
+        them in a pool of worker processes, returning the list of results.
+
+        The workers are forked from this process, so they share the lookup
+        maps built so far without copying them. Each worker opens its own
+        database connection and commits every shard it loads. Archived files
+        are extracted first, since shards need to seek. With ``checkpoint``,
+        finished shards are recorded and skipped when resuming.
+        """
+        global _shard_importer
+        _shard_importer = self
+        size = os.path.getsize(self.dump_path(filename))
+        # A few shards per worker keeps them all busy until the end
+        step = size // (self.workers * 4) + 1
+        done = checkpoint and set(self.progress['shards']) or set()
+        shards = [(method, start, min(start + step, size))
+                  for start in xrange(0, size, step) if start not in done]
+        results = []
+        self.stats['bytes_total'] += sum(end - start for method, start, end in shards)
+        pool = multiprocessing.Pool(self.workers, connect_shard_worker)
+        try:
+            for start, result, stats in pool.imap_unordered(run_shard, shards):
+                results.append((start, result))
+                self.merge_stats(stats)
+                if checkpoint:
+                    self.progress['shards'].append(start)
+                    self.checkpoint()
+        finally:
+            pool.close()
+            pool.join()
+            _shard_importer = None
+        return [result for start, result in sorted(results)]
+
+    def start_stage(self, stage):
+        """
+        Starts collecting the metrics of ``stage``, which are kept in
+        ``metrics`` and passed to ``callback`` as the stage goes.
+        """
+        self.stats = {'stage': stage, 'started': time.time(), 'seconds': 0.0,
+                      'rows_read': 0, 'rows_written': 0, 'bytes_read': 0, 'bytes_total': 0,
+                      'conflicts': 0, 'parse_seconds': 0.0, 'db_seconds': 0.0, 'rows_per_second': 0,
+                      'eta_seconds': None, 'peak_memory_mb': memory_mb(), 'tables': {}}
+        self.reported = self.stats['started']
+        if stage is not None:
+            self.metrics.append(self.stats)
+
+    def merge_stats(self, stats):
+        """
+        Adds the metrics of a shard loaded by a worker process to the current
+        stage. Parse and database times are summed over the workers, and the
+        peak memory is that of the largest process.
+        """
+        for key in ('rows_read', 'rows_written', 'bytes_read', 'conflicts', 'parse_seconds',
+                    'db_seconds'):
+            self.stats[key] += stats[key]
+        for table, count in stats['tables'].items():
+            self.stats['tables'][table] = self.stats['tables'].get(table, 0) + count
+        self.stats['peak_memory_mb'] = max(self.stats['peak_memory_mb'], stats['peak_memory_mb'])
+        self.report()
+
+    def report(self, final=False):
+        stats = self.stats
+        stats['peak_memory_mb'] = max(stats['peak_memory_mb'], memory_mb())
+        if stats['stage'] is None:
+            return
+        now = time.time()
+        elapsed = stats['seconds'] = now - stats['started']
+        rows = stats['rows_read'] or stats['rows_written']
+        stats['rows_per_second'] = int(rows / max(elapsed, 0.001))
+        if final:
+            stats['eta_seconds'] = 0
+        elif stats['bytes_read'] and stats['bytes_total'] > stats['bytes_read']:
+            stats['eta_seconds'] = int(elapsed * (stats['bytes_total'] - stats['bytes_read']) /
+                                       stats['bytes_read'])
+        if self.callback is not None:
+            self.callback(stats)
+        if self.verbose and final:
+            print '%(stage)s: %(rows_read)d rows read, %(rows_written)d written in %(seconds).1f ' \
+                'seconds (parsing %(parse_seconds).1f, database %(db_seconds).1f), ' \
+                '%(rows_per_second)d rows/s, peak memory %(peak_memory_mb)d MB' % stats
+            if stats['conflicts']:
+                print '  %(conflicts)d rows replaced existing ones' % stats
+        elif self.verbose and now - self.reported >= 10 and stats['eta_seconds'] is not None:
+            print '  %d rows read, %.1f of %.1f MB, %d rows/s, %d seconds left' % \
+                (stats['rows_read'], stats['bytes_read'] / 1048576.0,
+                 stats['bytes_total'] / 1048576.0, stats['rows_per_second'], stats['eta_seconds'])
+            self.reported = now
+
+    def metrics_summary(self):
+        """
+        Returns the metrics of all the stages run, in a form that can be
+        written out as JSON.
+        """
+        return {
+            'stages': self.metrics,
+            'seconds': sum(stats['seconds'] for stats in self.metrics),
+            'rows_read': sum(stats['rows_read'] for stats in self.metrics),
+            'rows_written': sum(stats['rows_written'] for stats in self.metrics),
+        }
+
+    def checkpoint(self, **state):
+        """
+        Records the progress of the import in ``CHECKPOINT_FILE``, after a
+        commit, so that an interrupted import can continue from there.
+        """
+        self.progress.update(state)
+        with open(CHECKPOINT_FILE + '.tmp', 'w') as fd:
+            json.dump(self.progress, fd)
+        os.rename(CHECKPOINT_FILE + '.tmp', CHECKPOINT_FILE)
+
+    def load_checkpoint(self):
+        if self.resume and os.path.exists(CHECKPOINT_FILE):
+            with open(CHECKPOINT_FILE) as fd:
+                self.progress.update(json.load(fd))
+            if self.verbose:
+                print 'Resuming import after %s' % ', '.join(self.progress['completed'])
+        else:
+            self.resume = False
+
+    def done(self, stage):
+        return stage in self.progress['completed']
+
+    def run_stage(self, stage, method):
+        if self.done(stage):
+            return
+        if self.progress['stage'] != stage:
+            self.checkpoint(stage=stage, offset=0, last_id=None, deferred=0,
+                            shards=[], divisions=False, rebuilt=[])
+        self.start_stage(stage)
         self.begin()
-        self.import_fcodes()
+        method()
         self.commit()
+        self.report(final=True)
+        self.progress['completed'].append(stage)
+        self.checkpoint(stage=None)
+
+    def import_all(self):
+        self.load_checkpoint()
+        self.pre_import()
+        if not self.done('pre_import'):
+            self.progress['completed'].append('pre_import')
+            self.checkpoint()
         self.begin()
-        self.import_language_codes()
+        self.add_missing_columns()
         self.commit()
+        # The stages already imported when resuming are skipped, so the maps
+        # they would have built come from the database instead. Otherwise,
+        # divisions already in the database keep their ids
+        self.load_code_maps()
+        self.run_stage('fcodes', self.import_fcodes)
+        self.run_stage('language_codes', self.import_language_codes)
+        self.run_stage('time_zones', self.import_time_zones)
+        self.run_stage('continent_codes', self.import_continent_codes)
+        self.run_stage('countries', self.import_countries)
+        self.run_stage('first_level_adm', self.import_first_level_adm)
+        self.run_stage('second_level_adm', self.import_second_level_adm)
+        self.run_stage('geonames', self.import_geonames)
+        self.run_stage('deferred_geonames', self.import_deferred_geonames)
         if not self.skip_altnames:
-            self.begin()
-            self.import_alternate_names()
-            self.commit()
-        self.begin()
-        self.import_time_zones()
-        self.commit()
-        self.begin()
-        self.import_continent_codes()
-        self.commit()
-        self.begin()
-        self.import_countries()
-        self.commit()
-        self.begin()
-        self.import_first_level_adm()
-        self.commit()
+            # Loaded last, so that a subset import knows which geonames it kept
+            self.run_stage('alternate_names', self.import_alternate_names)
+        self.run_stage('search_names', self.index_search_names)
+        self.run_stage('name_search', self.index_names)
+        self.run_stage('sequences', self.reset_sequences)
+        self.run_stage('post_import', self.post_import)
+        if self.staging:
+            self.run_stage('swap', self.swap_staging)
+
+    def rebuild(self, stmts):
+        """
+        Runs the statements restoring the indexes and constraints dropped by
+        ``pre_import`` over a pool of ``workers`` connections, each with
+        ``maintenance_memory`` MB for the builds.
+
+        Indexes are built first, so that the constraints can use them. Two
+        statements never run at the same time on a table if either of them
+        locks it against the other, which only index builds don't. Each
+        statement is committed and checkpointed on its own, and timed.
+        """
+        pending = [(i, stmt) for i, stmt in enumerate(stmts) if i not in self.progress['rebuilt']]
+        running, errors = [], []
+        condition = threading.Condition()
+        timings = self.stats.setdefault('statements', [])
+
+        def phase(stmt):
+            return not INDEX_STMT_RE.match(stmt)
+
+        def next_statement():
+            first = min([phase(stmt) for i, stmt in pending] + [phase(stmt) for stmt in running])
+            for item in pending:
+                if phase(item[1]) == first and not any(self.conflict(item[1], stmt) for stmt in running):
+                    return item
+
+        def work():
+            conn = self.connect()
+            try:
+                cursor = conn.cursor()
+                for setting in self.maintenance_settings():
+                    cursor.execute(setting)
+                while True:
+                    with condition:
+                        item = None
+                        while pending and not errors:
+                            item = next_statement()
+                            if item is not None:
+                                break
+                            condition.wait()
+                        if item is None:
+                            return
+                        pending.remove(item)
+                        running.append(item[1])
+                    started = time.time()
+                    try:
+                        cursor.execute(item[1])
+                        conn.commit()
+                    except Exception, e:
+                        errors.append((item[1], e))
+                    elapsed = time.time() - started
+                    with condition:
+                        running.remove(item[1])
+                        if not errors:
+                            timings.append({'statement': item[1], 'seconds': elapsed})
+                            self.progress['rebuilt'].append(item[0])
+                            self.checkpoint()
+                            if self.verbose:
+                                print '  %.1f seconds: %s' % (elapsed, item[1])
+                        condition.notify_all()
+            finally:
+                conn.close()
+
+        threads = [threading.Thread(target=work) for i in range(min(self.workers, len(pending)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            stmt, e = errors[0]
+            self.handle_exception(e, stmt)
+
+    def conflict(self, stmt, other):
+        """
+        Tells whether two of the statements run by ``rebuild`` would block
+        each other.
+        """
+        tables, shared = statement_tables(stmt)
+        other_tables, other_shared = statement_tables(other)
+        if not tables & other_tables:
+            return False
+        return not (shared and other_shared and self.concurrent_index_builds)
+
+    def last_import_date(self):
+        self.cursor.execute('SELECT MAX(updated_date) FROM geonames_update')
+        return self.cursor.fetchone()[0]
+
+    def load_code_maps(self):
+        """
+        Rebuilds the time zone and admin code maps from the database, for
+        runs that don't go through the stages that build them.
+
+        Divisions are keyed by the codes their rows were read with, kept in
+        ``full_code``, so that those whose parent is blank or unknown are
+        found as in a run that read them. The rows written before the column
+        was added are keyed by the codes of their parents, blank where there
+        is none. A division found twice keeps the id of its last row.
+        """
+        self.cursor.execute('SELECT id, name FROM time_zone')
+        for id, name in self.cursor.fetchall():
+            self.time_zones[name] = id
+        self.cursor.execute('SELECT id, country_id, code FROM admin1_code ORDER BY id')
+        for id, country_id, code in self.cursor.fetchall():
+            self.admin_codes.add((country_id, code), id)
+        self.cursor.execute('SELECT a2.id, a2.full_code, a2.country_id, a1.code, a2.code FROM admin2_code a2 '
+                            'LEFT JOIN admin1_code a1 ON a1.id = a2.admin1_id ORDER BY a2.id')
+        self.add_code_paths(self.cursor.fetchall())
+        self.cursor.execute('SELECT a3.id, a3.full_code, a3.country_id, a1.code, a2.code, a3.code '
+                            'FROM admin3_code a3 '
+                            'LEFT JOIN admin1_code a1 ON a1.id = a3.admin1_id '
+                            'LEFT JOIN admin2_code a2 ON a2.id = a3.admin2_id ORDER BY a3.id')
+        self.add_code_paths(self.cursor.fetchall())
+        self.cursor.execute('SELECT a4.id, a4.full_code, a4.country_id, a1.code, a2.code, a3.code, a4.code '
+                            'FROM admin4_code a4 '
+                            'LEFT JOIN admin1_code a1 ON a1.id = a4.admin1_id '
+                            'LEFT JOIN admin2_code a2 ON a2.id = a4.admin2_id '
+                            'LEFT JOIN admin3_code a3 ON a3.id = a4.admin3_id ORDER BY a4.id')
+        self.add_code_paths(self.cursor.fetchall())
+
+    def add_code_paths(self, rows):
+        for row in rows:
+            id, full_code, codes = row[0], row[1], row[2:]
+            if full_code:
+                # Only the last code may hold dots, as in admin2Codes.txt
+                path = tuple(full_code.split('.', len(codes) - 1))
+            else:
+                path = tuple(code or '' for code in codes)
+            self.admin_codes.add(path, id)
+
+    def check_code_maps(self):
+        """
+        Rebuilds the admin code maps from the database, as resumed and
+        incremental runs do, and returns the divisions they file differently
+        from the maps built by this run, as ``(path, id, id in the rebuilt
+        maps)`` tuples.
+        """
+        built, time_zones = self.admin_codes, dict(self.time_zones)
+        self.admin_codes = AdminCodes()
+        try:
+            self.load_code_maps()
+            loaded = self.admin_codes.paths()
+        finally:
+            self.admin_codes, self.time_zones = built, time_zones
+        built = built.paths()
+        return sorted((path, built.get(path), loaded.get(path))
+                      for path in set(built) | set(loaded) if built.get(path) != loaded.get(path))
+
+    def delete_rows(self, table, column, ids):
+        count = 0
+        for batch in batches(list(ids)):
+            self.cursor.execute(u'DELETE FROM %s WHERE %s IN (%s)' % \
+                (table, column, ', '.join(['%s'] * len(batch))), batch)
+            count += self.cursor.rowcount
+        return count
+
+    def replace_rows(self, table, columns, rows):
+        """
+        Writes ``rows`` to ``table`` in batches, replacing any existing rows
+        with the same primary key, which must be the first column, as the
+        upserts of ``load_rows`` do.
+        """
+        count = 0
+        for batch in batches(list(rows)):
+            count += self.load_rows(table, columns, batch)
+        return count
+
+    def pending_updates(self, directory):
+        """
+        Returns a sorted list of ``(date, files)`` for the daily GeoNames
+        modification and deletion files in ``directory`` that are more recent
+        than the last recorded import, ``files`` mapping each kind of file to
+        its path.
+        """
+        last = self.last_import_date()
+        if last is None:
+            raise ValueError('No previous import recorded, a full import is needed first')
+        updates = {}
+        for filename in os.listdir(directory):
+            match = UPDATE_FILE_RE.match(filename)
+            if not match:
+                continue
+            updated = date(*map(int, match.groups()[1:]))
+            if updated > last:
+                updates.setdefault(updated, {})[match.group(1)] = os.path.join(directory, filename)
+        return sorted(updates.items())
+
+    def apply_geoname_modifications(self, filename):
+        fields_list = [line.rstrip('\n').split('\t') for line in read_lines(filename)]
+        if self.subset:
+            # Geonames that no longer belong to the subset are removed
+            self.delete_geonames([fields[0] for fields in fields_list
+                                  if not self.keep_geoname(fields)])
+            fields_list = filter(self.keep_geoname, fields_list)
+        admin3_rows, admin4_rows = [], []
+        for fields in fields_list:
+            country_id = fields[8]
+            admin1, admin2, admin3, admin4 = fields[10:14]
+            name = self.decode(fields[1], '\t'.join(fields))
+            if fields[7] in DIVISION_TABLES:
+                self.cursor.execute(u'UPDATE %s SET name = %%s, ascii_name = %%s WHERE geoname_id = %%s' % \
+                    DIVISION_TABLES[fields[7]], (name, fields[2], fields[0]))
+            elif fields[7] == 'ADM3':
+                id = self.admin_ids(country_id, admin1, admin2, admin3)[2]
+                if id is None:
+                    id = self.next_id('admin3_code')
+                    self.admin_codes.add((country_id, admin1, admin2, admin3), id)
+                admin1_id, admin2_id = self.admin_ids(country_id, admin1, admin2)[:2]
+                admin3_rows.append((id, country_id, admin1_id, admin2_id, fields[0], admin3,
+                                    name, fields[2], '.'.join((country_id, admin1, admin2, admin3))))
+            elif fields[7] == 'ADM4':
+                id = self.admin_ids(country_id, admin1, admin2, admin3, admin4)[3]
+                if id is None:
+                    id = self.next_id('admin4_code')
+                    self.admin_codes.add((country_id, admin1, admin2, admin3, admin4), id)
+                admin4_rows.append((id, fields, name))
+        self.replace_rows('admin3_code', ADMIN3_COLUMNS, admin3_rows)
+        self.move_divisions('admin3_code', [(row[0], row[4]) for row in admin3_rows])
+        self.admin4_rows = admin4_rows
+        admin4_rows = list(self.fourth_level_adm_rows())
+        self.admin4_rows = []
+        self.replace_rows('admin4_code', ADMIN4_COLUMNS, admin4_rows)
+        self.move_divisions('admin4_code', [(row[0], row[5]) for row in admin4_rows])
+        count = self.replace_rows('geoname', GEONAME_COLUMNS,
+                                  [self.geoname_row(fields) for fields in fields_list])
+        self.index_names([fields[0] for fields in fields_list])
+        self.index_search_names([fields[0] for fields in fields_list])
+        return count
+
+    def move_divisions(self, table, rows):
+        """
+        Removes the rows of ``table`` left by divisions that moved to other
+        parent codes, ``rows`` being the ``(id, geoname_id)`` of the rows just
+        written for them. The geonames and divisions within an old row are
+        pointed at the new one, which its codes now map to as well.
+        """
+        ids = dict((geoname_id, id) for id, geoname_id in rows)
+        depth = DIVISION_DEPTHS[table]
+        for batch in batches(ids.keys()):
+            self.cursor.execute(u'SELECT id, geoname_id, full_code FROM %s WHERE geoname_id IN (%s)' % \
+                (table, ', '.join(['%s'] * len(batch))), batch)
+            for old_id, geoname_id, full_code in self.cursor.fetchall():
+                id = ids[str(geoname_id)]
+                if old_id == id:
+                    continue
+                for referring, column in DIVISION_REFERENCES[table]:
+                    self.cursor.execute(u'UPDATE %s SET %s = %%s WHERE %s = %%s' % (referring, column, column),
+                                        (id, old_id))
+                if full_code:
+                    self.admin_codes.add(tuple(full_code.split('.', depth)), id)
+                self.cursor.execute(u'DELETE FROM %s WHERE id = %%s' % table, (old_id,))
+
+    def clear_divisions(self, table, geoname_ids):
+        """
+        Deletes the rows of ``table`` of the divisions of ``geoname_ids``,
+        leaving the geonames and divisions within them without one.
+        """
+        for batch in batches(list(geoname_ids)):
+            params = ', '.join(['%s'] * len(batch))
+            for referring, column in DIVISION_REFERENCES[table]:
+                self.cursor.execute(u'UPDATE %s SET %s = NULL WHERE %s IN (SELECT id FROM %s WHERE geoname_id IN (%s))' % \
+                    (referring, column, column, table, params), batch)
+        return self.delete_rows(table, 'geoname_id', geoname_ids)
+
+    def apply_geoname_deletes(self, filename):
+        return self.delete_geonames([line.split('\t', 1)[0] for line in read_lines(filename)])
+
+    def delete_geonames(self, ids):
+        self.delete_rows(SEARCH_NAME_TABLE, 'geoname_id', ids)
+        self.delete_rows('alternate_name', 'geoname_id', ids)
+        self.clear_divisions('admin4_code', ids)
+        self.clear_divisions('admin3_code', ids)
+        count = self.delete_rows('geoname', 'id', ids)
+        self.index_names(ids)
+        return count
+
+    def import_updates(self, directory):
+        """
+        Applies the daily GeoNames modification and deletion files found in
+        ``directory`` that are newer than the last import, one day at a time,
+        recording each day in ``geonames_update`` as it is committed.
+        """
         self.begin()
-        self.import_second_level_adm()
+        self.add_missing_columns()
         self.commit()
-        if not self.cities:
-            self.begin()
-            self.import_third_level_adm()
-            self.commit()
+        self.load_code_maps()
+        updates = self.pending_updates(directory)
+        if self.verbose and not updates:
+            print 'No pending updates in %s' % directory
+        for updated, files in updates:
+            if self.verbose:
+                print 'Applying updates for %s' % updated
+            self.start_stage('updates %s' % updated)
             self.begin()
-            self.import_fourth_level_adm()
+            counts = {}
+            if 'deletes' in files:
+                counts['deleted geonames'] = self.apply_geoname_deletes(files['deletes'])
+            if 'modifications' in files:
+                counts['modified geonames'] = self.apply_geoname_modifications(files['modifications'])
+            if 'alternateNamesDeletes' in files:
+                ids = [line.split('\t', 1)[0] for line in read_lines(files['alternateNamesDeletes'])]
+                geoname_ids = self.alternate_name_geonames(ids)
+                counts['deleted alternate names'] = self.delete_rows('alternate_name', 'id', ids)
+                self.index_search_names(geoname_ids)
+            if 'alternateNamesModifications' in files and not self.skip_altnames:
+                if self.subset:
+                    self.load_geoname_ids()
+                rows = list(self.alternate_name_rows(filename=files['alternateNamesModifications']))
+                # A name moved to another geoname leaves its old one too
+                geoname_ids = self.alternate_name_geonames([row[0] for row in rows])
+                counts['modified alternate names'] = self.replace_rows('alternate_name',
+                    ALTERNATE_NAME_COLUMNS, rows)
+                self.index_search_names(geoname_ids | set(int(row[1]) for row in rows))
+            self.reset_sequences()
+            self.set_import_date(updated)
             self.commit()
-        self.begin()
-        self.import_geonames()
-        self.commit()
-        self.post_import()
+            self.stats['rows_written'] = sum(counts.values())
+            self.report(final=True)
+            if self.verbose:
+                for item in sorted(counts.items()):
+                    print '  %s: %d' % item
+
+# The tables of the divisions renamed in place by the incremental updates,
+# by feature code
+DIVISION_TABLES = {'ADM1': 'admin1_code', 'ADM2': 'admin2_code'}
+
+# The columns referring to the rows of the divisions read from the geonames,
+# and the number of dots in their full codes
+DIVISION_REFERENCES = {
+    'admin3_code': (('geoname', 'admin3_id'), ('admin4_code', 'admin3_id')),
+    'admin4_code': (('geoname', 'admin4_id'),),
+}
+DIVISION_DEPTHS = {'admin3_code': 3, 'admin4_code': 4}
+
+UPDATE_FILE_RE = re.compile(r'^(modifications|deletes|alternateNamesModifications|'
+                            r'alternateNamesDeletes)-(\d{4})-(\d{2})-(\d{2})\.txt$')
+
+# Number of rows deleted or replaced per statement by the incremental updates
+UPDATE_BATCH_SIZE = 10000
+
+# Lines read between two updates of the metrics of a stage
+METRICS_INTERVAL = 100000
+
+# Where a staging import loads the tables on PostgreSQL, and where the
+# tables it replaces are moved to, before being dropped
+STAGING_SCHEMA = 'geonames_staging'
+PREVIOUS_SCHEMA = 'geonames_previous'
+
+# The oldest servers the PostgreSQL importer runs on: the upserts need ON
+# CONFLICT, and the geometries are written with the ST_ functions
+MIN_POSTGRESQL_VERSION = (9, 5)
+MIN_POSTGIS_VERSION = (2, 0)
+
+CREATE_TABLE_RE = re.compile(r'^CREATE TABLE ["`]?(\w+)', re.I)
+INDEX_STMT_RE = re.compile(r'^CREATE (?:UNIQUE )?INDEX ["`]?\w+["`]? ON ["`]?(\w+)', re.I)
+TABLE_STMT_RE = re.compile(r'^ALTER TABLE ["`]?(\w+)', re.I)
+ADD_CONSTRAINT_RE = re.compile(r'^ALTER TABLE ["`]?\w+["`]? ADD CONSTRAINT', re.I)
+REFERENCES_RE = re.compile(r'REFERENCES ["`]?(\w+)', re.I)
+
+def statement_tables(stmt):
+    """
+    Returns the tables an index or constraint statement locks, and whether
+    it only needs a lock that other index builds can share.
+    """
+    match = INDEX_STMT_RE.match(stmt)
+    if match:
+        return set([match.group(1)]), True
+    tables = set(REFERENCES_RE.findall(stmt))
+    match = TABLE_STMT_RE.match(stmt)
+    if match:
+        tables.add(match.group(1))
+    return tables, False
+
+def read_lines(filename, start=0, end=None):
+    """
+    Yields the lines of ``filename`` that start within the byte range from
+    ``start`` to ``end``, so that adjoining ranges split the file on line
+    boundaries.
+    """
+    with open(filename) as fd:
+        if start:
+            fd.seek(start - 1)
+            fd.readline()
+        if end is None:
+            for line in fd:
+                yield line
+            return
+        pos = fd.tell()
+        while pos < end:
+            line = fd.readline()
+            if not line:
+                break
+            pos += len(line)
+            yield line
+
+# The importer run by the worker processes of GeonamesImporter.map_shards
+_shard_importer = None
+
+def connect_shard_worker():
+    # Keep a reference to the connection inherited from the parent process,
+    # so that it is never closed, and the parent's session ended, from here
+    _shard_importer.parent_conn = _shard_importer.conn
+    _shard_importer.get_db_conn()
+
+def memory_mb():
+    """
+    Returns the resident memory of this process in MB, or its peak where
+    /proc isn't available.
+    """
+    try:
+        with open('/proc/self/statm') as fd:
+            return int(fd.read().split()[1]) * resource.getpagesize() / 1048576
+    except (IOError, IndexError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def batches(items, size=UPDATE_BATCH_SIZE):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+def run_shard(args):
+    method, start, end = args
+    _shard_importer.start_stage(None)
+    _shard_importer.begin()
+    result = getattr(_shard_importer, method)(start, end)
+    _shard_importer.commit()
+    _shard_importer.report()
+    return start, result, _shard_importer.stats
+
+def copy_value(value):
+    """
+    Encodes a single value in the text format read by PostgreSQL's COPY,
+    which MySQL's LOAD DATA reads as well with its default options.
+    """
+    if value is None:
+        return '\\N'
+    if value is True:
+        return '1'
+    if value is False:
+        return '0'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    elif not isinstance(value, str):
+        return str(value)
+    if '\\' in value:
+        value = value.replace('\\', '\\\\')
+    return value.replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+def copy_line(row):
+    """
+    Encodes a row as one line of COPY text. Byte strings are passed through
+    as they are, and the whole row is only escaped value by value when the
+    line shows it needs it, which is rare for fields split out of the dumps.
+    """
+    line = '\t'.join([v.__class__ is str and v or copy_value(v) for v in row])
+    if line.count('\\') != row.count(None) or line.count('\t') != len(row) - 1 \
+            or '\n' in line or '\r' in line:
+        line = '\t'.join([copy_value(v) for v in row])
+    return line + '\n'
+
+def ewkb_point(longitude, latitude, srid=4326):
+    """
+    Returns the hex encoded EWKB of a point, which PostGIS accepts as text
+    input for a geometry column without going through a WKT parser.
+    """
+    return hexlify(struct.pack('<BIIdd', 1, 0x20000001, srid,
+                               float(longitude), float(latitude)))
+
+def wkb_point(longitude, latitude):
+    """
+    Returns the hex encoded WKB of a point, for MySQL's GeomFromWKB.
+    """
+    return hexlify(struct.pack('<BIdd', 1, 1, float(longitude), float(latitude)))
+
+class GeonameIds(object):
+    """
+    A set of geoname ids kept as a bitmap, one bit per possible id, which
+    takes under 2 MB for the whole range of the dump.
+    """
+
+    def __init__(self):
+        self.bits = bytearray()
+
+    def add(self, id):
+        byte = id >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytearray(max(byte + 1 - len(self.bits), len(self.bits))))
+        self.bits[byte] |= 1 << (id & 7)
+
+    def __contains__(self, id):
+        byte = id >> 3
+        return byte < len(self.bits) and bool(self.bits[byte] & (1 << (id & 7)))
+
+class CopyStream(object):
+    """
+    A read-only file-like object feeding ``cursor.copy_from`` from an iterable
+    of rows. Rows are encoded as they are read, so a table is streamed to the
+    server without ever being held in memory.
+    """
+
+    def __init__(self, rows, point=None, encode_point=ewkb_point):
+        self.rows = iter(rows)
+        self.point = point
+        self.encode_point = encode_point
+        self.buffer = ''
+        self.count = 0
+
+    def encode(self, row):
+        if self.point is not None:
+            row = list(row)
+            row[self.point] = self.encode_point(*row[self.point])
+        self.count += 1
+        return copy_line(row)
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        while size < 0 or length < size:
+            try:
+                line = self.encode(self.rows.next())
+            except StopIteration:
+                break
+            chunks.append(line)
+            length += len(line)
+        data = ''.join(chunks)
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    def readline(self, size=-1):
+        if self.buffer:
+            line, sep, self.buffer = self.buffer.partition('\n')
+            return line + sep
+        try:
+            return self.encode(self.rows.next())
+        except StopIteration:
+            return ''
 
 class PsycoPg2Importer(GeonamesImporter):
+
+    # The schema of the tables served to the application
+    live_schema = 'public'
     
     def __init__(self, *args, **kwargs):
         super(PsycoPg2Importer, self).__init__(*args, **kwargs)
@@ -552,34 +1789,55 @@ class PsycoPg2Importer(GeonamesImporter):
         sys.path.append('../')
         sys.path.append('../../')
 
-        alter_re = re.compile('^ALTER TABLE "(\w+)" ADD CONSTRAINT (\w+).*', re.I)
+        alter_re = re.compile('^ALTER TABLE "(\w+)" ADD CONSTRAINT "?(\w+)"?.*', re.I)
         alter_action = 'ALTER TABLE "\g<1>" DROP CONSTRAINT "\g<2>"'
+        # Indexes added to the app after the tables were created, such as
+        # the trigram index of the names, may not be there yet
         index_re = re.compile('^CREATE INDEX "(\w+)".*', re.I)
-        index_action = 'DROP INDEX "\g<1>"'
+        index_action = 'DROP INDEX IF EXISTS "\g<1>"'
+        extension_re = re.compile('^CREATE EXTENSION', re.I)
         table_re = re.compile('^CREATE TABLE "(\w+)".*', re.I)
         references_re = re.compile('"(\w+)".*?REFERENCES "(\w+)" \("(\w+)"\) DEFERRABLE INITIALLY DEFERRED')
         references_action = 'ALTER TABLE "%(table)s" DROP CONSTRAINT "%(table)s_%(field)s_fkey"'
         references_stmt = 'ALTER TABLE "%(table)s" ADD CONSTRAINT "%(table)s_%(field)s_fkey" FOREIGN KEY ("%(field)s") ' \
                 'REFERENCES "%(reftable)s" ("%(reffield)s") DEFERRABLE INITIALLY DEFERRED'
         sql = sql_all(models.get_app('geonames'), no_style(), connections[DEFAULT_DB_ALIAS])
+        # A resumed import only needs the statements restoring them
+        drop = not self.done('pre_import')
+        if self.staging:
+            if drop:
+                self.cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % STAGING_SCHEMA)
+                self.cursor.execute('CREATE SCHEMA %s' % STAGING_SCHEMA)
+            # The new tables get their foreign keys inline, dropped below
+            self.create_staging_tables(sql)
+            sql = [stmt for stmt in sql if 'geonames_update' not in statement_tables(stmt)[0]]
         for stmt in sql:
             if alter_re.search(stmt):
-                self.cursor.execute(alter_re.sub(alter_action, stmt))
+                if drop and not self.staging:
+                    self.cursor.execute(alter_re.sub(alter_action, stmt))
                 self.end_stmts.append(stmt)
             elif index_re.search(stmt):
-                self.cursor.execute(index_re.sub(index_action, stmt))
+                if drop and not self.staging:
+                    self.cursor.execute(index_re.sub(index_action, stmt))
                 self.end_stmts.append(stmt)
+            elif extension_re.search(stmt):
+                # Created in public, as the staging schema is dropped
+                # once swapped in, along with everything created in it
+                self.cursor.execute(stmt)
             elif table_re.search(stmt): 
                 table = table_re.search(stmt).group(1)
+                if table == 'geonames_update' and self.staging:
+                    continue
                 for m in  references_re.findall(stmt):
                     try:
-                        self.cursor.execute(references_action % \
-                            { 
-                                'table': table,
-                                'field': m[0],
-                                'reftable': m[1],
-                                'reffield': m[2],
-                            })
+                        if drop:
+                            self.cursor.execute(references_action % \
+                                { 
+                                    'table': table,
+                                    'field': m[0],
+                                    'reftable': m[1],
+                                    'reffield': m[2],
+                                })
                     except psycopg2.ProgrammingError, e:
                         if 'constraint' in e and 'does not exist' in e:
                             # The constraint has already been removed
@@ -598,17 +1856,18 @@ class PsycoPg2Importer(GeonamesImporter):
         if self.verbose:
             print 'Enabling constraints and generating indexes (be patient, this is the last step)'
         self.insert_dummy_records()
-        for stmt in self.end_stmts:
-            self.cursor.execute(stmt)
-            self.commit()
+        self.commit()
+        self.rebuild(self.end_stmts)
+        self.begin()
 
     def insert_dummy_records(self):
         self.cursor.execute("UPDATE geoname SET country_id='' WHERE country_id IN (' ', '  ')")
         if not self.cities:
             self.cursor.execute("DELETE FROM country WHERE geoname_id=6295630 or iso_numeric=-1")
             self.cursor.execute("DELETE FROM continent WHERE geoname_id=6295630")
-            self.cursor.execute("INSERT INTO country (iso_alpha2, iso_alpha3, iso_numeric, fips_code, name, capital, area, population, continent_id, tld, currency_code, currency_name, phone_prefix, postal_code_fmt, postal_code_re, languages, geoname_id) VALUES ('', '', -1, '', 'No country', 'No capital', 0, 0, '', '', '', '', '', '', '', '', 6295630)")
-            self.cursor.execute("INSERT INTO continent VALUES('', 'No continent', 6295630)")
+            # The Earth geoname is left out of some subsets of the dump
+            self.cursor.execute("INSERT INTO country (iso_alpha2, iso_alpha3, iso_numeric, fips_code, name, capital, area, population, continent_id, tld, currency_code, currency_name, phone_prefix, postal_code_fmt, postal_code_re, languages, geoname_id) VALUES ('', '', -1, '', 'No country', 'No capital', 0, 0, '', '', '', '', '', '', '', '', (SELECT id FROM geoname WHERE id=6295630))")
+            self.cursor.execute("INSERT INTO continent VALUES('', 'No continent', (SELECT id FROM geoname WHERE id=6295630))")
 
     def begin(self):
         self.cursor.execute('BEGIN')
@@ -616,7 +1875,7 @@ class PsycoPg2Importer(GeonamesImporter):
     def commit(self):
         self.cursor.execute('COMMIT')
 
-    def get_db_conn(self):
+    def connect(self):
         import psycopg2
         conn_params = 'dbname=%s ' % self.db
         if self.host:
@@ -624,38 +1883,209 @@ class PsycoPg2Importer(GeonamesImporter):
         if self.user:
             conn_params += 'user=%s ' % self.user
         if self.password:
-            conn_params += 'password=%s' % self.password
+            conn_params += 'password=%s ' % self.password
+        if self.staging:
+            # Every connection of the import, including those of the worker
+            # processes and threads, works on the staging tables
+            conn_params += "options='-c search_path=%s,public'" % STAGING_SCHEMA
+
+        return psycopg2.connect(conn_params)
+
+    def stream(self, sql, params=()):
+        conn = self.connect()
+        try:
+            # A named cursor is read from the server itersize rows at a time
+            cursor = conn.cursor('geonames_stream')
+            cursor.itersize = 10000
+            cursor.execute(sql, params)
+            for row in cursor:
+                yield row
+        finally:
+            conn.close()
+
+    def swap_staging(self):
+        """
+        Replaces the live tables with the staging ones, in a single
+        transaction, so that readers see either the old or the new tables,
+        always with their indexes. Foreign keys from other tables to the old
+        ones are dropped with them. Tables the live schema doesn't have yet,
+        such as those added to the app since the last import, are just moved
+        in.
+        """
+        if self.verbose:
+            print 'Swapping the staging tables in'
+        self.cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE' % PREVIOUS_SCHEMA)
+        self.cursor.execute('CREATE SCHEMA %s' % PREVIOUS_SCHEMA)
+        for table in self.staged_tables:
+            self.cursor.execute('ALTER TABLE IF EXISTS %s."%s" SET SCHEMA %s' % \
+                (self.live_schema, table, PREVIOUS_SCHEMA))
+            self.cursor.execute('ALTER TABLE %s."%s" SET SCHEMA %s' % (STAGING_SCHEMA, table, self.live_schema))
+        self.commit()
+        self.begin()
+        self.cursor.execute('DROP SCHEMA %s CASCADE' % PREVIOUS_SCHEMA)
+        self.cursor.execute('DROP SCHEMA %s CASCADE' % STAGING_SCHEMA)
 
-        self.conn = psycopg2.connect(conn_params)
+    def get_db_conn(self):
+        self.conn = self.connect()
         self.cursor = self.conn.cursor()
+        self.check_versions()
+
+    def check_versions(self):
+        """
+        Exits with an error if the server is older than PostgreSQL
+        ``MIN_POSTGRESQL_VERSION`` or PostGIS ``MIN_POSTGIS_VERSION``.
+        """
+        self.cursor.execute('SHOW server_version_num')
+        version = int(self.cursor.fetchone()[0])
+        postgresql = (version // 10000, version // 100 % 100)
+        self.cursor.execute('SELECT postgis_lib_version()')
+        postgis = tuple(int(n) for n in self.cursor.fetchone()[0].split('.')[:2])
+        self.conn.rollback()
+        for name, found, needed in (('PostgreSQL', postgresql, MIN_POSTGRESQL_VERSION),
+                                    ('PostGIS', postgis, MIN_POSTGIS_VERSION)):
+            if found < needed:
+                sys.stderr.write('The import needs %s %s or later, the server has %s\n' %
+                                 (name, '.'.join(map(str, needed)), '.'.join(map(str, found))))
+                sys.exit(1)
+
+    def maintenance_settings(self):
+        return ["SET maintenance_work_mem = '%dMB'" % self.maintenance_memory]
     
-    def last_row_id(self, table=None, pk=None):
-        self.cursor.execute("SELECT CURRVAL('\"%s_%s_seq\"')" % (table, pk))
+    def reset_sequence(self, table, next_id):
+        self.cursor.execute("SELECT SETVAL('\"%s_id_seq\"', %%s, false)" % table, (next_id,))
+
+    def load_rows(self, table, columns, rows):
+        if not self.bulk:
+            return super(PsycoPg2Importer, self).load_rows(table, columns, rows)
+        if self.is_fresh(table):
+            return self.bulk_load(table, columns, rows)
+        return self.merge_rows(table, columns, rows)
+
+    def bulk_load(self, table, columns, rows):
+        try:
+            point = columns.index('point')
+        except ValueError:
+            point = None
+        stream = CopyStream(rows, point)
+        self.cursor.copy_from(stream, table, columns=columns)
+        return stream.count
+
+    def upsert_clause(self, columns, returning=False):
+        clause = 'ON CONFLICT (%s) DO UPDATE SET %s' % \
+            (columns[0], ', '.join('%s = EXCLUDED.%s' % (c, c) for c in columns[1:]))
+        if returning:
+            # xmax is only set on the rows an upsert updated
+            clause += ' RETURNING xmax <> 0'
+        return clause
+
+    def conflicted(self):
         return self.cursor.fetchone()[0]
+
+    def create_temp_table(self, temp, table):
+        self.cursor.execute('CREATE TEMP TABLE %s (LIKE %s INCLUDING DEFAULTS)' % (temp, table))
+
+    def drop_temp_table(self, temp):
+        self.cursor.execute('DROP TABLE %s' % temp)
     
-    def set_import_date(self):
-        self.cursor.execute('INSERT INTO geonames_update (updated_date) VALUES ( CURRENT_DATE AT TIME ZONE \'UTC\')')
+    def set_import_date(self, updated=None):
+        if updated:
+            self.cursor.execute('INSERT INTO geonames_update (updated_date) VALUES (%s)', (updated,))
+        else:
+            self.cursor.execute('INSERT INTO geonames_update (updated_date) VALUES ( CURRENT_DATE AT TIME ZONE \'UTC\')')
 
 
 class MySQLImporter(GeonamesImporter):
+
+    # ALTER TABLE locks the whole table, even to add an index
+    concurrent_index_builds = False
+
+    point_columns = 'X(point), Y(point)'
+    point_value = 'GeomFromText(%s, 4326)'
+    current_schema = 'DATABASE()'
     
     def __init__(self, *args, **kwargs):
         super(MySQLImporter, self).__init__(*args, **kwargs)
         self.end_stmts = []
 
-    def import_file(self, tablename, filename):
-        import re
-        if re.search(r'[^\w\.]',tablename):
-            raise Exception("Illegal tablename: %s" % tablename)
+    def load_rows(self, table, columns, rows):
+        """
+        Writes ``rows`` out as a load-ready TSV file, with the ids already
+        resolved and the points encoded as WKB, and bulk loads it with
+        ``LOAD DATA LOCAL INFILE``. The rows are encoded as they are read,
+        and the batched stages load a batch per file, so neither the rows nor
+        the file grow past what a batch holds.
+        """
+        if not self.bulk:
+            return super(MySQLImporter, self).load_rows(table, columns, rows)
+        if self.is_fresh(table):
+            return self.bulk_load(table, columns, rows)
+        return self.merge_rows(table, columns, rows)
+
+    def bulk_load(self, table, columns, rows):
         try:
-            fd = open(filename)
-        except:
-            raise Exception("Bad file.")
-        fd.close()
-        fullpath = "%s/%s" % (os.getcwd(),filename)
-        if self.verbose:
-            print "LOAD DATA INFILE '%(filename)s' IGNORE INTO TABLE `%(tablename)s` CHARACTER SET utf8" % {'tablename':tablename, 'filename':fullpath}
-        self.cursor.execute("LOAD DATA INFILE '%(filename)s' IGNORE INTO TABLE `%(tablename)s`" % {'tablename':tablename, 'filename':fullpath})
+            point = columns.index('point')
+        except ValueError:
+            point = None
+        stream = CopyStream(rows, point, wkb_point)
+        filename = os.path.abspath('%s.%d.load.txt' % (table, os.getpid()))
+        try:
+            with open(filename, 'wb') as fd:
+                shutil.copyfileobj(stream, fd, 1 << 20)
+            targets = [column == 'point' and '@point' or '`%s`' % column for column in columns]
+            stmt = "LOAD DATA LOCAL INFILE '%s' INTO TABLE `%s` CHARACTER SET utf8 (%s)" % \
+                (filename, table, ', '.join(targets))
+            if point is not None:
+                stmt += ' SET point = GeomFromWKB(UNHEX(@point), 4326)'
+            self.cursor.execute(stmt)
+        finally:
+            if os.path.exists(filename):
+                os.unlink(filename)
+        return stream.count
+
+    def upsert_clause(self, columns, returning=False):
+        return 'ON DUPLICATE KEY UPDATE %s' % \
+            ', '.join('`%s` = VALUES(`%s`)' % (c, c) for c in columns[1:])
+
+    def conflicted(self):
+        # An update counts as two affected rows, or none if nothing changed
+        return self.cursor.rowcount != 1
+
+    def create_temp_table(self, temp, table):
+        self.cursor.execute('CREATE TEMPORARY TABLE `%s` LIKE `%s`' % (temp, table))
+
+    def create_trigram_table(self, table, key=True):
+        # Binary, so that the accented and plain forms of a trigram, which
+        # the default collation takes as equal, stay different keys
+        self.cursor.execute('CREATE TABLE IF NOT EXISTS %s (`trigram` CHAR(3) CHARACTER SET utf8 '
+                            'COLLATE utf8_bin NOT NULL, `geoname_id` INT NOT NULL%s)' % \
+                            (table, key and ', PRIMARY KEY (`trigram`, `geoname_id`)' or ''))
+
+    def index_names(self, ids=None):
+        """
+        Writes the trigrams of the names of the geonames ``ids`` to the
+        ``geoname_trigram`` table, or rebuilds it for all of them. The full
+        build loads the table before adding its key, reading the names over
+        a connection of its own.
+        """
+        if ids is None:
+            self.cursor.execute('DROP TABLE IF EXISTS `%s`' % TRIGRAM_TABLE)
+            self.create_trigram_table('`%s`' % TRIGRAM_TABLE, key=False)
+            self.load(TRIGRAM_TABLE, TRIGRAM_COLUMNS, ((trigram, id) for id, name in
+                self.stream('SELECT id, name FROM geoname') for trigram in trigrams(name)))
+            self.cursor.execute('ALTER TABLE `%s` ADD PRIMARY KEY (`trigram`, `geoname_id`)' % \
+                                TRIGRAM_TABLE)
+            return
+        self.delete_rows(TRIGRAM_TABLE, 'geoname_id', ids)
+        for batch in batches(list(ids)):
+            self.cursor.execute('SELECT id, name FROM geoname WHERE id IN (%s)' % \
+                                ', '.join(['%s'] * len(batch)), batch)
+            rows = [(trigram, id) for id, name in self.cursor.fetchall() for trigram in trigrams(name)]
+            if rows:
+                self.cursor.executemany('INSERT IGNORE INTO `%s` (`trigram`, `geoname_id`) '
+                                        'VALUES (%%s, %%s)' % TRIGRAM_TABLE, rows)
+
+    def drop_temp_table(self, temp):
+        self.cursor.execute('DROP TEMPORARY TABLE `%s`' % temp)
 
     def pre_import(self):
         import re
@@ -675,23 +2105,39 @@ class MySQLImporter(GeonamesImporter):
         references_stmt = 'ALTER TABLE "%(table)s" ADD CONSTRAINT "%(table)s_%(field)s_fkey" FOREIGN KEY ("%(field)s") ' \
                 'REFERENCES "%(reftable)s" ("%(reffield)s")'
         sql = sql_all(models.get_app('geonames'), no_style(), connections[DEFAULT_DB_ALIAS])
+        # A resumed import only needs the statements restoring them
+        drop = not self.done('pre_import')
+        if self.staging:
+            if drop:
+                self.cursor.execute('DROP DATABASE IF EXISTS `%s`' % self.staging_db)
+                self.cursor.execute('CREATE DATABASE `%s`' % self.staging_db)
+                self.cursor.execute('USE `%s`' % self.staging_db)
+            self.end_stmts.extend(self.create_staging_tables(sql))
+            # The trigram table is built by the import, and may not be in
+            # the live database yet for the swap to move aside
+            self.create_trigram_table('`%s`.`%s`' % (self.db, TRIGRAM_TABLE))
+            self.staged_tables.append(TRIGRAM_TABLE)
+            sql = []
         for stmt in sql:
             if alter_re.search(stmt):
-                self.cursor.execute(alter_re.sub(alter_action, stmt))
+                if drop:
+                    self.cursor.execute(alter_re.sub(alter_action, stmt))
                 self.end_stmts.append(stmt)
             elif index_re.search(stmt):
-                self.cursor.execute(index_re.sub(index_action, stmt))
+                if drop:
+                    self.cursor.execute(index_re.sub(index_action, stmt))
                 self.end_stmts.append(stmt)
             elif table_re.search(stmt): 
                 table = table_re.search(stmt).group(1)
                 for m in  references_re.findall(stmt):
-                    self.cursor.execute(references_action % \
-                        { 
-                            'table': table,
-                            'field': m[0],
-                            'reftable': m[1],
-                            'reffield': m[2],
-                        })
+                    if drop:
+                        self.cursor.execute(references_action % \
+                            { 
+                                'table': table,
+                                'field': m[0],
+                                'reftable': m[1],
+                                'reffield': m[2],
+                            })
                     self.end_stmts.append(references_stmt % \
                         {
                             'table': table,
@@ -706,16 +2152,17 @@ class MySQLImporter(GeonamesImporter):
         if self.verbose:
             print 'Enabling constraints and generating indexes (be patient, this is the last step)'
         self.insert_dummy_records()
-        for stmt in self.end_stmts:
-            self.cursor.execute(stmt)
-            self.commit()
+        self.commit()
+        self.rebuild(self.end_stmts)
+        self.begin()
 
     def insert_dummy_records(self):
         self.cursor.execute("DELETE FROM country WHERE geoname_id=6295630 or iso_numeric=-1")
         self.cursor.execute("DELETE FROM continent WHERE geoname_id=6295630")
         self.cursor.execute("UPDATE geoname SET country_id='' WHERE country_id IN (' ', '  ')")
-        self.cursor.execute("INSERT INTO country VALUES ('', '', -1, '', 'No country', 'No capital', 0, 0, '', '', '', '', '', '', '', '', 6295630)")
-        self.cursor.execute("INSERT INTO continent VALUES('', 'No continent', 6295630)")
+        # The Earth geoname is left out of some subsets of the dump
+        self.cursor.execute("INSERT INTO country VALUES ('', '', -1, '', 'No country', 'No capital', 0, 0, '', '', '', '', '', '', '', '', (SELECT id FROM geoname WHERE id=6295630))")
+        self.cursor.execute("INSERT INTO continent VALUES('', 'No continent', (SELECT id FROM geoname WHERE id=6295630))")
 
     def begin(self):
         self.cursor.execute('BEGIN')
@@ -723,7 +2170,7 @@ class MySQLImporter(GeonamesImporter):
     def commit(self):
         self.cursor.execute('COMMIT')
 
-    def get_db_conn(self):
+    def connect(self):
         import MySQLdb
         conn_params = {}
         conn_params['db'] = self.db
@@ -735,20 +2182,79 @@ class MySQLImporter(GeonamesImporter):
             conn_params['passwd'] = self.password
             
         conn_params['use_unicode'] = True
+        # Needed by the LOAD DATA LOCAL INFILE statements of load_rows
+        conn_params['local_infile'] = 1
 
-        self.conn = MySQLdb.connect(**conn_params)
-        self.conn.set_character_set('utf8')
+        conn = MySQLdb.connect(**conn_params)
+        conn.set_character_set('utf8')
+        cursor = conn.cursor()
+        cursor.execute('SET NAMES utf8;')
+        cursor.execute('SET CHARACTER SET utf8;')
+        cursor.execute('SET character_set_connection=utf8;')
+        if self.staging:
+            # Every connection of the import, including those of the worker
+            # processes and threads, works on the staging tables
+            cursor.execute('CREATE DATABASE IF NOT EXISTS `%s`' % self.staging_db)
+            cursor.execute('USE `%s`' % self.staging_db)
+        return conn
+
+    def stream(self, sql, params=()):
+        import MySQLdb.cursors
+        conn = self.connect()
+        try:
+            cursor = conn.cursor(MySQLdb.cursors.SSCursor)
+            cursor.execute(sql, params)
+            for row in cursor:
+                yield row
+        finally:
+            conn.close()
+
+    @property
+    def staging_db(self):
+        return '%s_staging' % self.db
+
+    def swap_staging(self):
+        """
+        Replaces the live tables with the staging ones in a single RENAME
+        TABLE, which MySQL runs atomically, so that readers see either the
+        old or the new tables, always with their indexes. Tables the live
+        database doesn't have yet, such as ``geoname_trigram`` before the
+        first import, are just moved in.
+        """
+        if self.verbose:
+            print 'Swapping the staging tables in'
+        previous = '%s_previous' % self.db
+        self.cursor.execute('DROP DATABASE IF EXISTS `%s`' % previous)
+        self.cursor.execute('CREATE DATABASE `%s`' % previous)
+        self.cursor.execute('SELECT table_name FROM information_schema.tables WHERE table_schema = %s',
+                            (self.db,))
+        live = set(row[0] for row in self.cursor.fetchall())
+        renames = []
+        for table in self.staged_tables:
+            if table in live:
+                renames.append('`%s`.`%s` TO `%s`.`%s`' % (self.db, table, previous, table))
+            renames.append('`%s`.`%s` TO `%s`.`%s`' % (self.staging_db, table, self.db, table))
+        self.cursor.execute('RENAME TABLE %s' % ', '.join(renames))
+        self.cursor.execute('USE `%s`' % self.db)
+        self.cursor.execute('DROP DATABASE `%s`' % previous)
+        self.cursor.execute('DROP DATABASE `%s`' % self.staging_db)
+
+    def get_db_conn(self):
+        self.conn = self.connect()
         self.cursor = self.conn.cursor()
-        self.cursor.execute('SET NAMES utf8;')
-        self.cursor.execute('SET CHARACTER SET utf8;')
-        self.cursor.execute('SET character_set_connection=utf8;')
+
+    def maintenance_settings(self):
+        # The spatial indexes are built on MyISAM tables
+        return ['SET SESSION myisam_sort_buffer_size = %d' % (self.maintenance_memory << 20)]
     
-    def last_row_id(self, table=None, pk=None):
-        self.cursor.execute("SELECT MAX(%s) from %s" % (pk,table))
-        return self.cursor.fetchone()[0]
+    def reset_sequence(self, table, next_id):
+        self.cursor.execute("ALTER TABLE %s AUTO_INCREMENT = %d" % (table, next_id))
     
-    def set_import_date(self):
-        self.cursor.execute('INSERT INTO geonames_update (updated_date) VALUES ( Now() )')
+    def set_import_date(self, updated=None):
+        if updated:
+            self.cursor.execute('INSERT INTO geonames_update (updated_date) VALUES (%s)', (updated,))
+        else:
+            self.cursor.execute('INSERT INTO geonames_update (updated_date) VALUES ( Now() )')
 
 IMPORTERS = {
     'django.contrib.gis.db.backends.postgis': PsycoPg2Importer,
@@ -765,6 +2271,19 @@ class Command(BaseCommand):
             default='/tmp/geonames_temp',
             help='The temporary directory for the geonames file.'
         ),
+        optparse.make_option('--base-url',
+            dest='base_url',
+            default=PREFIX,
+            metavar='URL',
+            help='Download the dump files from this URL instead of %s.' % PREFIX,
+        ),
+        optparse.make_option('--keep-downloads',
+            action='store_true',
+            dest='keep_downloads',
+            default=False,
+            help='Leave the downloaded files in the temporary directory, so that the next '
+                 'import only downloads the files that changed.',
+        ),
         optparse.make_option('--flush',
             action='store_true',
             dest='flush',
@@ -783,6 +2302,92 @@ class Command(BaseCommand):
             dest='cities',
             help='Choose one of the much smaller "cities" files. Implies --skip-altnames.',
         ),
+        optparse.make_option('--workers',
+            type='int',
+            dest='workers',
+            default=1,
+            help='Parse and load the geonames and alternate names files in this many processes, '
+                 'and rebuild indexes and constraints over as many connections.',
+        ),
+        optparse.make_option('--maintenance-memory',
+            type='int',
+            dest='maintenance_memory',
+            default=512,
+            metavar='MB',
+            help='Memory for each connection rebuilding indexes at the end of the import.',
+        ),
+        optparse.make_option('--incremental',
+            dest='incremental',
+            metavar='DIR',
+            help='Apply the daily modification and deletion files found in DIR '
+                 'that are newer than the last import, instead of importing everything.',
+        ),
+        optparse.make_option('--no-bulk',
+            action='store_false',
+            dest='bulk',
+            default=True,
+            help='Insert one row at a time instead of using the bulk loader of the database.',
+        ),
+        optparse.make_option('--resume',
+            action='store_true',
+            dest='resume',
+            default=False,
+            help='Continue an interrupted import from its last checkpoint, reusing the '
+                 'files already in the temporary directory.',
+        ),
+        optparse.make_option('--countries',
+            dest='countries',
+            metavar='CODES',
+            help='Only import the geonames of these countries, a comma separated list '
+                 'of ISO codes. Give the same filters to later --incremental runs.',
+        ),
+        optparse.make_option('--fclasses',
+            dest='fclasses',
+            metavar='CLASSES',
+            help='Only import geonames of these feature classes, such as A,P.',
+        ),
+        optparse.make_option('--fcodes',
+            dest='fcodes',
+            metavar='CODES',
+            help='Only import geonames with these feature codes, such as PPLC,PPLA.',
+        ),
+        optparse.make_option('--min-population',
+            type='int',
+            dest='min_population',
+            help='Only import geonames with at least this population.',
+        ),
+        optparse.make_option('--altname-languages',
+            dest='altname_languages',
+            metavar='LANGUAGES',
+            help='Only import the alternate names in these languages, a comma separated list '
+                 'of codes as found in alternateNames.txt, such as en,fr,zh-CN, in any case. An '
+                 'empty code keeps the names with no language.',
+        ),
+        optparse.make_option('--preferred-only',
+            action='store_true',
+            dest='preferred_only',
+            default=False,
+            help='Only import the alternate names marked as preferred or short.',
+        ),
+        optparse.make_option('--staging',
+            action='store_true',
+            dest='staging',
+            default=False,
+            help='Load and index the new data in a staging schema, then swap it with the '
+                 'live tables at once, so that they can be queried throughout the import. '
+                 'Foreign keys from other tables to the geonames tables are dropped.',
+        ),
+        optparse.make_option('--metrics',
+            dest='metrics',
+            metavar='FILE',
+            help='Write the rows, bytes and time of each stage of the import to FILE, as JSON.',
+        ),
+        optparse.make_option('--snapshot',
+            dest='snapshot',
+            metavar='FILE',
+            help='Once the import is done, write the geonames to FILE as a binary snapshot '
+                 'that geonames.snapshot can query without the database.',
+        ),
     )
 
     def handle(self, *args, **options):
@@ -793,6 +2398,17 @@ class Command(BaseCommand):
                              settings.DATABASE_ENGINE)
             sys.exit(1)
         
+        if options['flush'] and options['resume']:
+            sys.stderr.write('--flush would discard the data of the import being resumed\n')
+            sys.exit(1)
+        if options['staging'] and (options['flush'] or options['incremental']):
+            sys.stderr.write('--staging leaves the live tables alone until the swap, '
+                             'it cannot be used with --flush or --incremental\n')
+            sys.exit(1)
+        if options['flush'] and options['incremental']:
+            sys.stderr.write('--flush would discard the data the updates of --incremental apply to\n')
+            sys.exit(1)
+
         if options['flush']:
             call_command('flush')
         
@@ -801,6 +2417,18 @@ class Command(BaseCommand):
         else:
             verbose = False
         
+        kwargs = {'min_population': options['min_population'],
+                   'maintenance_memory': options['maintenance_memory'],
+                   'staging': options['staging'],
+                   'preferred_only': options['preferred_only'],
+                   'base_url': options['base_url'],
+                   'keep_downloads': options['keep_downloads']}
+        for option in ('countries', 'fclasses', 'fcodes'):
+            if options[option]:
+                kwargs[option] = [code.strip().upper() for code in options[option].split(',')]
+        if options['altname_languages'] is not None:
+            kwargs['altname_languages'] = [code.strip() for code in options['altname_languages'].split(',')]
+
         try:
             imp = importer(
                 host=settings.DATABASES['default'].get('HOST',None),
@@ -811,6 +2439,10 @@ class Command(BaseCommand):
                 verbose=verbose,
                 skip_altnames=options['skip_altnames'],
                 cities=options.get('cities', None),
+                bulk=options['bulk'],
+                workers=options['workers'],
+                resume=options['resume'],
+                **kwargs
             )
         except AttributeError:
             imp = importer(
@@ -822,10 +2454,35 @@ class Command(BaseCommand):
                 verbose=verbose,
                 skip_altnames=options['skip_altnames'],
                 cities=options.get('cities', None),
+                bulk=options['bulk'],
+                workers=options['workers'],
+                resume=options['resume'],
+                **kwargs
             )
 
-        imp.fetch()
-        imp.get_db_conn()
-        imp.import_all()
-        imp.set_import_date()
-        imp.cleanup()
+        # The import runs from within the temporary directory
+        metrics = options['metrics'] and os.path.abspath(options['metrics'])
+        snapshot_file = options['snapshot'] and os.path.abspath(options['snapshot'])
+
+        if options['incremental']:
+            imp.get_db_conn()
+            try:
+                imp.import_updates(options['incremental'])
+            except ValueError, e:
+                sys.stderr.write('%s\n' % e)
+                sys.exit(1)
+        else:
+            imp.fetch()
+            imp.get_db_conn()
+            imp.import_all()
+            imp.begin()
+            imp.set_import_date()
+            imp.commit()
+            imp.cleanup()
+
+        if snapshot_file:
+            imp.write_snapshot(snapshot_file)
+
+        if metrics:
+            with open(metrics, 'w') as fd:
+                json.dump(imp.metrics_summary(), fd, indent=2)
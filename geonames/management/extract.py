@@ -0,0 +1,146 @@
+"""
+Shared engine of the generate_countries and generate_states commands, which
+copy a handful of geonames out of the allCountries.txt dump into the database
+without a full import.
+
+The dump is read once, each line being matched against sets of geoname ids
+and feature codes, and the matching rows are written in batches, replacing
+the rows already there with the same ids. A batch the database rejects is
+written again a row at a time, the rows it rejects being skipped.
+"""
+
+import sys
+from itertools import izip
+
+from django.db import connections, DatabaseError
+
+from geonames import dumps
+
+GEONAME_COLUMNS = ('id', 'name', 'ascii_name', 'point', 'fclass', 'fcode', 'country_id', 'cc2',
+                   'admin1_id', 'admin2_id', 'admin3_id', 'admin4_id', 'population', 'elevation',
+                   'gtopo30', 'timezone_id', 'moddate')
+BATCH_SIZE = 1000
+
+
+class GeonameExtractor(object):
+
+    def __init__(self, ids=(), fcodes=(), batch_size=BATCH_SIZE):
+        self.ids = set(str(id) for id in ids)
+        self.fcodes = set(fcodes)
+        self.batch_size = batch_size
+        self.found = set()
+
+    def rows(self, filename):
+        """
+        Yields the rows of the geonames in ``filename`` whose id or feature
+        code is one of those extracted, ordered like ``GEONAME_COLUMNS``.
+
+        The admin divisions and time zone aren't resolved, these commands
+        being run on databases that may not have them.
+        """
+        ids, fcodes = self.ids, self.fcodes
+        with open(filename) as fd:
+            for i, batch in enumerate(dumps.read_batches(fd, dumps.GEONAME)):
+                if (i + 1) % 10 == 0:
+                    sys.stdout.write('.')
+                    sys.stdout.flush()
+                batch = batch.select([id in ids or fcode in fcodes for id, fcode in
+                                      izip(batch.strings('geoname_id'), batch['fcode'])])
+                if not len(batch):
+                    continue
+                geoname_ids = batch.strings('geoname_id')
+                self.found.update(batch['geoname_id'])
+                points = ['POINT(%s %s)' % point for point in
+                          izip(batch.strings('longitude'), batch.strings('latitude'))]
+                elevations = [elevation or 0 for elevation in batch.strings('elevation')]
+                blanks = [None] * len(batch)
+                for row in izip(geoname_ids, batch['name'], batch['ascii_name'], points,
+                                batch['fclass'], batch['fcode'], batch['country_code'], batch['cc2'],
+                                blanks, blanks, blanks, blanks, batch.strings('population'),
+                                elevations, batch.strings('gtopo30'), blanks, batch['moddate']):
+                    yield row
+
+    def replace(self, cursor, rows):
+        """
+        Writes ``rows`` to the geoname table in batches, deleting the rows
+        with the same ids first, and returns the number of rows written.
+        """
+        values = ['%s'] * len(GEONAME_COLUMNS)
+        values[GEONAME_COLUMNS.index('point')] = point_value()
+        insert = u'INSERT INTO geoname (%s) VALUES (%s)' % (', '.join(GEONAME_COLUMNS), ', '.join(values))
+        count = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == self.batch_size:
+                count += self.write_batch(cursor, insert, batch)
+                batch = []
+        if batch:
+            count += self.write_batch(cursor, insert, batch)
+        return count
+
+    def write_batch(self, cursor, insert, batch):
+        """
+        Writes a batch of rows, falling back to one row at a time if the
+        database rejects it, and returns the number of rows written. Only the
+        failed statements are rolled back, within the transaction.
+        """
+        cursor.execute('SAVEPOINT geoname_batch')
+        try:
+            write_rows(cursor, insert, batch)
+        except DatabaseError:
+            cursor.execute('ROLLBACK TO SAVEPOINT geoname_batch')
+        else:
+            return len(batch)
+        count = 0
+        for row in batch:
+            cursor.execute('SAVEPOINT geoname_row')
+            try:
+                write_rows(cursor, insert, [row])
+            except DatabaseError, e:
+                cursor.execute('ROLLBACK TO SAVEPOINT geoname_row')
+                sys.stderr.write('Skipping geoname %s: %s\n' % (row[0], e))
+            else:
+                count += 1
+        return count
+
+    def extract(self, cursor, filename='allCountries.txt'):
+        """
+        Copies the matching geonames of ``filename`` into the database, in a
+        single transaction, and returns the number of rows written.
+        """
+        cursor.execute('BEGIN')
+        count = self.replace(cursor, self.rows(filename))
+        cursor.execute('COMMIT')
+        return count
+
+
+def write_rows(cursor, insert, rows):
+    cursor.execute(u'DELETE FROM geoname WHERE id IN (%s)' % ', '.join(['%s'] * len(rows)),
+                   [row[0] for row in rows])
+    cursor.executemany(insert, rows)
+
+
+def point_value():
+    # Older MySQL versions only have the names without the ST_ prefix, which
+    # PostGIS dropped in 2.0
+    if connections['default'].vendor == 'mysql':
+        return 'GeomFromText(%s, 4326)'
+    return 'ST_GeomFromText(%s, 4326)'
+
+
+def set_country_geonames(cursor, geoname_ids):
+    """
+    Points each country to its geoname with a single UPDATE, ``geoname_ids``
+    mapping ISO codes to geoname ids. Returns the number of countries updated.
+    """
+    if not geoname_ids:
+        return 0
+    codes = sorted(geoname_ids)
+    params = []
+    for code in codes:
+        params.extend((code, int(geoname_ids[code])))
+    params.extend(codes)
+    cursor.execute(u'UPDATE country SET geoname_id = CASE iso_alpha2 %s END WHERE iso_alpha2 IN (%s)' % \
+        (' '.join(['WHEN %s THEN %s'] * len(codes)), ', '.join(['%s'] * len(codes))), params)
+    return cursor.rowcount
@@ -5,7 +5,7 @@ import re
 from math import sin, cos, acos, radians
 
 from django.core.cache import cache
-from django.db import connection
+from django.db import connection, DatabaseError
 from django.contrib.gis.db import models
 from django.contrib.gis.geos import Point
 from django.contrib.gis.measure import D
@@ -13,6 +13,8 @@ from django.utils.translation import ugettext, get_language
 from django.conf import settings
 
 from geonames.decorators import stored_property, cache_set
+from geonames.search import SEARCH_LIMIT, SEARCH_NAME_LENGTH, SEARCH_NAME_TABLE, \
+    like_pattern, search_key, trigrams
 
 GLOBE_GEONAME_ID = 6295630
 
@@ -94,11 +96,33 @@ class GeonameManager(models.GeoManager):
             fcode__in=('PCLI', 'PCL', 'PCLD', 'CONT')
         )
 
+    def search(self, query, limit=SEARCH_LIMIT):
+        """
+        Returns the first ``limit`` geonames whose name contains ``query``,
+        most populated first.
+        """
+        return self.get_query_set().filter(name__icontains=query).order_by('-population')[:limit]
+
+    def named(self, query, prefix=False, limit=SEARCH_LIMIT):
+        """
+        Returns the first ``limit`` geonames having ``query`` as their name
+        or one of their alternate names, regardless of case and accents, or
+        a name starting with it with ``prefix``, most populated first.
+        """
+        key = search_key(query)
+        if not key:
+            return self.get_query_set().none()
+        lookup = prefix and 'name__startswith' or 'name'
+        # A subquery, so that all the geonames having the name are ordered
+        # by population before the first ``limit`` are kept
+        ids = GeonameSearchName.objects.filter(**{lookup: key}).values('geoname')
+        return self.get_query_set().filter(pk__in=ids).order_by('-population')[:limit]
+
 
 class PgSQLGeonameManager(GeonameManager):
     
     def box(self, minlat, maxlat, minlng, maxlng):
-        return 'SetSRID(MakeBox2D(MakePoint(%s, %s), MakePoint(%s, %s)), 4326)' % \
+        return 'ST_SetSRID(ST_MakeBox2D(ST_MakePoint(%s, %s), ST_MakePoint(%s, %s)), 4326)' % \
             (minlng, minlat, maxlng, maxlat)
 
     def box_tz(self, cursor, minlat, maxlat, minlng, maxlng):
@@ -120,6 +144,28 @@ class PgSQLGeonameManager(GeonameManager):
 
         return None
     
+    def search(self, query, limit=SEARCH_LIMIT):
+        """
+        Returns the first ``limit`` geonames whose name contains ``query``,
+        found with the trigram index of the names, ranked by their similarity
+        to the query and by population.
+        """
+        if len(query) < 3:
+            # Too short for the trigram index
+            return super(PgSQLGeonameManager, self).search(query, limit)
+        cursor = connection.cursor()
+        # All the matching names are ranked before the first ``limit`` are
+        # kept, so that a capped candidate list can't drop the best ones
+        cursor.execute('SELECT id FROM geoname WHERE name ILIKE %s '
+                       'ORDER BY similarity(name, %s) DESC, population DESC LIMIT %s',
+                       [like_pattern(query), query, limit])
+        ids = [row[0] for row in cursor.fetchall()]
+        return self.get_query_set().filter(pk__in=ids).extra(
+            select={'similarity': 'similarity(name, %s)'},
+            select_params=(query,),
+            order_by=['-similarity', '-population']
+        )
+    
     def near_point(self, lat, lng, kms=5, order=True):
         qs = self.exclude_political_entities()
         point = Point(float(lng), float(lat))
@@ -162,6 +208,35 @@ class MySQLGeonameManager(GeonameManager):
             )
         return near_objects
 
+    def search(self, query, limit=SEARCH_LIMIT):
+        """
+        Returns the first ``limit`` geonames whose name contains ``query``,
+        found through the ``geoname_trigram`` table written by the importer.
+        All the geonames having the trigrams of the query are ranked by the
+        length of their name, the share of it the query matches standing for
+        its trigram similarity, and by population, before the first ``limit``
+        are kept.
+        """
+        query_trigrams = list(trigrams(query))
+        if not query_trigrams:
+            return super(MySQLGeonameManager, self).search(query, limit)
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SELECT geoname.id FROM geoname JOIN (SELECT geoname_id FROM geoname_trigram '
+                           'WHERE trigram IN (%s) GROUP BY geoname_id HAVING COUNT(*) = %%s) '
+                           'AS candidates ON candidates.geoname_id = geoname.id WHERE geoname.name LIKE %%s '
+                           'ORDER BY CHAR_LENGTH(geoname.name), geoname.population DESC LIMIT %%s' % \
+                           ', '.join(['%s'] * len(query_trigrams)),
+                           query_trigrams + [len(query_trigrams), like_pattern(query), limit])
+        except DatabaseError:
+            # The names haven't been indexed by an import yet
+            return super(MySQLGeonameManager, self).search(query, limit)
+        ids = [row[0] for row in cursor.fetchall()]
+        return self.get_query_set().filter(pk__in=ids).extra(
+            select={'name_length': 'CHAR_LENGTH(name)'},
+            order_by=['name_length', '-population']
+        )
+
 
 GEONAME_MANAGERS = {
     'django.contrib.gis.db.backends.mysql': MySQLGeonameManager,
@@ -397,6 +472,22 @@ class GeonameAlternateName(models.Model):
     def __unicode__(self):
         return "%s -> %s" % (self.name,self.geoname.name)
 
+class GeonameSearchName(models.Model):
+    """
+    A name a geoname is found by, lower case and without accents: its name,
+    ASCII name, or one of its alternate names, written by the importer.
+    """
+    geoname = models.ForeignKey(Geoname, related_name='search_names', db_index=True)
+    name = models.CharField(max_length=SEARCH_NAME_LENGTH, db_index=True)
+    language = models.CharField(max_length=7)
+    preferred = models.BooleanField()
+
+    class Meta:
+        db_table = SEARCH_NAME_TABLE
+
+    def __unicode__(self):
+        return "%s -> %s" % (self.name, self.geoname_id)
+
 class Continent(models.Model):
     code = models.CharField(max_length=2, primary_key=True)
     name = models.CharField(max_length=20)
@@ -464,6 +555,9 @@ class Admin2Code(models.Model):
     code = models.CharField(max_length=30)
     name = models.TextField()
     ascii_name = models.TextField()
+    # The country and division codes of the division, separated by dots,
+    # as in admin2Codes.txt
+    full_code = models.CharField(max_length=200, blank=True)
     geom = models.GeometryField(null=True, blank=True)
     class Meta:
         db_table = 'admin2_code'    
@@ -479,6 +573,9 @@ class Admin3Code(models.Model):
     code = models.CharField(max_length=30)
     name = models.TextField()
     ascii_name = models.TextField()
+    # The country and division codes of the division, separated by dots,
+    # as in admin2Codes.txt
+    full_code = models.CharField(max_length=200, blank=True)
     geom = models.GeometryField(null=True, blank=True)
     class Meta:
         db_table = 'admin3_code'    
@@ -495,6 +592,9 @@ class Admin4Code(models.Model):
     code = models.CharField(max_length=30)
     name = models.TextField()
     ascii_name = models.TextField()
+    # The country and division codes of the division, separated by dots,
+    # as in admin2Codes.txt
+    full_code = models.CharField(max_length=200, blank=True)
     geom = models.GeometryField(null=True, blank=True)
     class Meta:
         db_table = 'admin4_code'    
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+"""
+In-process index of geoname names, which lets ``geocoder.geocode`` find the
+candidates of a query without asking the database.
+
+It is enabled with the ``GEONAMES_NAME_INDEX`` setting, and loaded the first
+time it is used, or at startup by calling ``get_index()``. Names are keyed by
+their normalized form, lower case and without accents, so that "quebec" finds
+"Québec". Rather than a dict of names, the index is a few arrays, one entry
+per geoname, sorted by the hash of the name and by population, so that the
+whole of allCountries fits in a few hundred MB and a lookup is a binary
+search:
+
+  * the hash of the normalized name, and a CRC of it telling apart the rare
+    names whose hashes collide
+  * the geoname id, population, country and first level division
+
+along with the ISO codes of the countries.
+
+``get_regions()`` returns the ``RegionMatcher`` of the names and codes of the
+countries and first level divisions, which the geocoder uses whether or not
+the name index is enabled.
+
+Both are reloaded when a newer ``GeonamesUpdate`` is found, which is checked
+at most every ``GEONAMES_NAME_INDEX_CHECK_INTERVAL`` seconds (60 by default),
+and at once when one is saved in this process.
+"""
+from __future__ import with_statement
+
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.signals import post_save
+
+from geonames.models import GeonamesUpdate
+from geonames.regions import RegionMatcher
+from geonames.snapshot import normalize
+
+CHECK_INTERVAL = 60
+
+
+def name_key(name):
+    name = normalize(name)
+    return hash(name), zlib.crc32(name.encode('utf-8'))
+
+
+class NameIndex(object):
+
+    def __init__(self, cursor):
+        self.load_countries(cursor)
+        self.load_geonames(cursor)
+
+    def load_countries(self, cursor):
+        # Countries stand for their index in self.country_codes, which is
+        # what the geoname rows hold
+        cursor.execute('SELECT iso_alpha2, iso_alpha3, geoname_id FROM country')
+        self.country_codes = []
+        self.country_geonames = {}
+        for iso_alpha2, iso_alpha3, geoname_id in cursor.fetchall():
+            self.country_codes.append(iso_alpha2)
+            self.country_geonames[iso_alpha2.lower()] = self.country_geonames[iso_alpha3.lower()] = \
+                geoname_id
+        self.country_indexes = dict((code, i) for i, code in enumerate(self.country_codes))
+
+    def load_geonames(self, cursor):
+        countries = self.country_indexes
+        no_country = len(self.country_codes)
+        hashes, checks = array('l'), array('l')
+        ids, populations, country_ids, admin1_ids = array('i'), array('l'), array('H'), array('i')
+        # Read in population order, which the sort by hash keeps
+        cursor.execute('SELECT id, name, population, country_id, admin1_id FROM geoname '
+                       'ORDER BY population DESC')
+        while True:
+            rows = cursor.fetchmany(10000)
+            if not rows:
+                break
+            for id, name, population, country_id, admin1_id in rows:
+                name_hash, check = name_key(name)
+                hashes.append(name_hash)
+                checks.append(check)
+                ids.append(id)
+                populations.append(population or 0)
+                country_ids.append(countries.get(country_id, no_country))
+                admin1_ids.append(admin1_id or 0)
+        order = sorted(xrange(len(hashes)), key=hashes.__getitem__)
+        self.hashes = array('l', [hashes[i] for i in order])
+        self.checks = array('l', [checks[i] for i in order])
+        self.ids = array('i', [ids[i] for i in order])
+        self.populations = array('l', [populations[i] for i in order])
+        self.country_ids = array('H', [country_ids[i] for i in order])
+        self.admin1_ids = array('i', [admin1_ids[i] for i in order])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def country_geoname(self, code):
+        """
+        Returns whether ``code`` is the ISO alpha2 or alpha3 code of a
+        country, and the id of its geoname.
+        """
+        code = code.lower()
+        return code in self.country_geonames, self.country_geonames.get(code)
+
+    def find(self, name, countries=None, admin1_ids=None):
+        """
+        Returns the ids of the geonames named ``name``, most populated first,
+        optionally restricted to some countries, by ISO code, or first level
+        divisions.
+        """
+        if countries is not None:
+            countries = set(self.country_indexes[code] for code in countries
+                            if code in self.country_indexes)
+        name_hash, check = name_key(name)
+        start = bisect_left(self.hashes, name_hash)
+        end = bisect_right(self.hashes, name_hash, start)
+        found = []
+        for i in xrange(start, end):
+            if self.checks[i] != check:
+                continue
+            if countries is not None and self.country_ids[i] not in countries:
+                continue
+            if admin1_ids is not None and self.admin1_ids[i] not in admin1_ids:
+                continue
+            found.append(self.ids[i])
+        return found
+
+
+def load_regions(cursor):
+    """
+    Returns a ``RegionMatcher`` of the countries, standing for
+    ``('country', iso_alpha2)``, and first level divisions, standing for
+    ``('admin1', id)``, by name, ASCII name and code.
+    """
+    regions = RegionMatcher()
+    cursor.execute('SELECT iso_alpha2, iso_alpha3, name FROM country')
+    for iso_alpha2, iso_alpha3, name in cursor.fetchall():
+        for key in (iso_alpha2, iso_alpha3, name):
+            regions.add(key, ('country', iso_alpha2))
+        if iso_alpha2 == 'GB':
+            regions.add('UK', ('country', iso_alpha2))
+    # Numeric codes, found in most countries, would match the numbers of
+    # addresses
+    cursor.execute('SELECT id, code, name, ascii_name FROM admin1_code')
+    for id, code, name, ascii_name in cursor.fetchall():
+        for key in (name, ascii_name):
+            regions.add(key, ('admin1', id))
+        if code.isalpha():
+            regions.add(code, ('admin1', id))
+    return regions
+
+
+_loaded = {}
+_lock = threading.Lock()
+
+
+def latest_update(cursor):
+    cursor.execute('SELECT MAX(id) FROM geonames_update')
+    return cursor.fetchone()[0]
+
+
+def cached(key, load):
+    """
+    Returns what ``load(cursor)`` returned for ``key``, calling it on first
+    use or when the data has been updated since.
+    """
+    loaded = _loaded.get(key)
+    interval = getattr(settings, 'GEONAMES_NAME_INDEX_CHECK_INTERVAL', CHECK_INTERVAL)
+    if loaded is not None and time.time() - loaded.checked < interval:
+        return loaded
+    with _lock:
+        loaded = _loaded.get(key)
+        if loaded is None or time.time() - loaded.checked >= interval:
+            cursor = connection.cursor()
+            version = latest_update(cursor)
+            if loaded is not None:
+                # Other threads keep using the old one while a new one loads
+                loaded.checked = time.time()
+            if loaded is None or loaded.version != version:
+                loaded = _loaded[key] = load(cursor)
+                loaded.version, loaded.checked = version, time.time()
+    return loaded
+
+
+def get_index():
+    """
+    Returns the name index, loading it on first use or when the data has been
+    updated since, or None if ``GEONAMES_NAME_INDEX`` isn't set.
+    """
+    if not getattr(settings, 'GEONAMES_NAME_INDEX', False):
+        return None
+    return cached('index', NameIndex)
+
+
+def get_regions():
+    """
+    Returns the ``RegionMatcher`` of the countries and first level divisions,
+    loading it on first use or when the data has been updated since.
+    """
+    return cached('regions', load_regions)
+
+
+def invalidate(**kwargs):
+    """
+    Makes the next ``get_index`` and ``get_regions`` check for a newer import.
+    """
+    for loaded in _loaded.values():
+        loaded.checked = 0
+
+post_save.connect(invalidate, sender=GeonamesUpdate)
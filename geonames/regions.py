@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Parsing of the region, a first level division or a country, that ends a
+geocoding query such as "Springfield, IL" or "Lyon France".
+
+``geocoder.geocode`` used to try three regular expressions in turn, for US
+states, Canadian provinces and any other country, which are kept here.
+``RegionMatcher`` instead holds the names and codes of the divisions and
+countries of the database, of every country, in a trie of their reversed
+letters, and finds all the regions a query ends with in one pass over its
+tail. ``nameindex.get_regions()`` keeps one for the geocoder.
+
+Running this module compares the two on queries made of the US states and
+Canadian provinces, or of all the divisions and countries of the dump files
+in a directory::
+
+    python -m geonames.regions [DIRECTORY]
+"""
+from __future__ import with_statement
+
+import re
+import unicodedata
+
+us_state_abbrs = 'AL|AK|AZ|AR|CA|CO|CT|DE|DC|FL|GA|HI|ID|IL|IN|IA|KS|KY|LA|ME|MT|NE|NV|NH|NJ|NM|NY|NC|ND|OH|OK|OR|MD|MA|MI|MN|MS|MO|PA|RI|SC|SD|TN|TX|UT|VT|VA|WA|WV|WI|WY'
+us_states = 'Alabama|Alaska|Arizona|Arkansas|California|Colorado|Connecticut|Delaware|District of Columbia|Florida|Georgia|Hawaii|Idaho|Illinois|Indiana|Iowa|Kansas|Kentucky|Louisiana|Maine|Montana|Nebraska|Nevada|New Hampshire|New Jersey|New Mexico|New York|North Carolina|North Dakota|Ohio|Oklahoma|Oregon|Maryland|Massachusetts|Michigan|Minnesota|Mississippi|Missouri|Pennsylvania|Rhode Island|South Carolina|South Dakota|Tennessee|Texas|Utah|Vermont|Virginia|Washington|West Virginia|Wisconsin|Wyoming'
+us_address_re = re.compile(r'(?:(?P<number>\d+)\s+(?P<street>[\w\s]+),?\s+)?(?P<city>[\w\s]+),?\s+(?P<state>%s|%s)' % (us_states, us_state_abbrs), re.I)
+
+can_prov_abbrs = 'AB|BC|MB|NB|NL|NT|NS|NU|ON|PE|QC|SK|YT'
+can_provinces = 'Alberta|British Columbia|Manitoba|New Brunswick|Newfoundland and Labrador|Northwest Territories|Nova Scotia|Nunavut|Ontario|Prince Edward Island|Quebec|Québec|Saskatchewan|Yukon'
+can_city_prov_re = re.compile(r'(?P<city>[\w\s]+),?\s+(?P<province>%s|%s)' % (can_provinces, can_prov_abbrs), re.I)
+
+city_country_re = re.compile(r'(?P<city>[\w\s]+?),?\s+(?P<country>[\w\s]+)', re.I)
+
+SEPARATORS = u' \t,'
+
+_folded = {}
+
+
+def fold(char):
+    """
+    Returns ``char`` lower case and without accents, which may be no
+    characters at all for a combining accent, or several for a ligature.
+    """
+    try:
+        return _folded[char]
+    except KeyError:
+        folded = unicodedata.normalize('NFKD', char.lower())
+        folded = _folded[char] = u''.join(c for c in folded if not unicodedata.combining(c))
+        return folded
+
+
+class RegionMatcher(object):
+    """
+    The names and codes of regions, each standing for any number of values,
+    such as the ids of the first level divisions of that name.
+    """
+
+    def __init__(self):
+        self.trie = {}
+
+    def add(self, name, value):
+        if isinstance(name, str):
+            name = name.decode('utf-8')
+        key = u''.join(fold(c) for c in name.strip())
+        if not key:
+            return
+        node = self.trie
+        for c in reversed(key):
+            node = node.setdefault(c, {})
+        values = node.setdefault(None, [])
+        if value not in values:
+            values.append(value)
+
+    def match(self, query):
+        """
+        Returns the ways ``query`` splits into a city and a region it ends
+        with, as ``(city, values)`` pairs, the longest region first. The
+        region is separated from the city by a space or a comma, and the city
+        is what follows the last comma before it, if any, so that the street
+        of an address is left out.
+        """
+        if isinstance(query, str):
+            query = query.decode('utf-8')
+        end = len(query)
+        while end and query[end - 1] in SEPARATORS:
+            end -= 1
+        matches = []
+        node = self.trie
+        folded = _folded
+        i = end
+        while i:
+            i -= 1
+            char = query[i]
+            chars = folded.get(char) or fold(char)
+            if len(chars) == 1:
+                node = node.get(chars)
+            else:
+                for c in reversed(chars):
+                    node = node and node.get(c)
+            if node is None:
+                return matches[::-1]
+            if None in node and i and query[i - 1] in SEPARATORS:
+                city = query[:i].rstrip(SEPARATORS).rsplit(',', 1)[-1].strip()
+                if city:
+                    matches.append((city, node[None]))
+        return matches[::-1]
+
+
+def cascade(query):
+    """
+    Parses ``query`` with the regular expressions ``geocode`` used, returning
+    the city and region of the first that matches.
+    """
+    match = us_address_re.match(query)
+    if match and match.group('city') and match.group('state'):
+        return match.group('city'), match.group('state')
+    match = can_city_prov_re.match(query)
+    if match and match.group('city') and match.group('province'):
+        return match.group('city'), match.group('province')
+    match = city_country_re.match(query)
+    if match and match.group('city') and match.group('country'):
+        return match.group('city'), match.group('country')
+    return None
+
+
+def benchmark(matcher, queries, repeat=5):
+    """
+    Prints the time per query of the regular expression cascade and of
+    ``matcher``, the best of ``repeat`` runs over ``queries``.
+    """
+    import time
+    for label, parse in (('Regex cascade', cascade), ('Region matcher', matcher.match)):
+        best = None
+        for i in range(repeat):
+            started = time.time()
+            for query in queries:
+                parse(query)
+            elapsed = time.time() - started
+            best = best is None and elapsed or min(best, elapsed)
+        print '%s: %.1f us per query' % (label, best * 1e6 / len(queries))
+
+
+if __name__ == '__main__':
+    import os
+    import sys
+    from geonames import dumps
+    matcher = RegionMatcher()
+    regions = []
+    for names in (us_states, us_state_abbrs, can_provinces, can_prov_abbrs):
+        for name in names.split('|'):
+            matcher.add(name, name)
+            regions.append(name.decode('utf-8'))
+    if len(sys.argv) > 1:
+        with open(os.path.join(sys.argv[1], 'admin1CodesASCII.txt')) as fd:
+            for batch in dumps.read_batches(fd, dumps.ADMIN_CODE):
+                for code, name, ascii_name in batch.rows('code', 'name', 'ascii_name'):
+                    matcher.add(name, code)
+                    matcher.add(ascii_name, code)
+                    if code.split('.')[1].isalpha():
+                        matcher.add(code.split('.')[1], code)
+                    regions.append(name)
+        with open(os.path.join(sys.argv[1], 'countryInfo.txt')) as fd:
+            for batch in dumps.read_batches(fd, dumps.COUNTRY_INFO):
+                for code, iso3, name in batch.rows('iso_alpha2', 'iso_alpha3', 'name'):
+                    for key in (code, iso3, name):
+                        matcher.add(key, code)
+                    regions.append(name)
+    queries = []
+    for i, region in enumerate(regions):
+        queries.append(u'%s, %s' % (('Springfield', 'Saint Louis', '12 Main Street, Paris')[i % 3], region))
+        queries.append(u'Nowhere in particular %d' % i)
+    print '%d regions, %d queries' % (len(regions), len(queries))
+    benchmark(matcher, queries)
@@ -0,0 +1,52 @@
+"""
+Helpers of the substring search of geoname names, shared by the importer,
+which indexes the names, and the model managers, which query them.
+
+PostgreSQL indexes the names itself, with the pg_trgm GIN index created by
+``sql/geoname.postgis.sql``. MySQL has no such index, so the importer keeps
+the trigrams of each name in the ``geoname_trigram`` table instead, and a
+search looks up the geonames having all the trigrams of the query.
+
+Names are also looked up whole, in any language, in the ``search_name``
+table the importer fills with the normalized names, ASCII names and
+alternate names of the geonames.
+"""
+from geonames.snapshot import normalize
+
+TRIGRAM_TABLE = 'geoname_trigram'
+TRIGRAM_COLUMNS = ('trigram', 'geoname_id')
+
+SEARCH_NAME_TABLE = 'search_name'
+SEARCH_NAME_COLUMNS = ('id', 'geoname_id', 'name', 'language', 'preferred')
+SEARCH_NAME_LENGTH = 200
+
+# The languages of alternateNames.txt that are links and codes, not names
+NOT_NAMES = frozenset(['link', 'wkdt', 'post', 'unlc', 'tcid'])
+
+# The most results returned by a search
+SEARCH_LIMIT = 100
+
+
+def trigrams(name):
+    """
+    Returns the set of three letter substrings of ``name``, lower case and
+    without accents, as matched by the case and accent insensitive
+    collations of MySQL.
+    """
+    name = normalize(name)
+    return set(name[i:i + 3] for i in xrange(len(name) - 2))
+
+
+def search_key(name):
+    """
+    Returns the form of ``name`` kept in the ``search_name`` table: lower
+    case, without accents, and cut to the length of the column.
+    """
+    return u' '.join(normalize(name).split())[:SEARCH_NAME_LENGTH]
+
+
+def like_pattern(query):
+    """
+    Returns the LIKE pattern matching the names containing ``query``.
+    """
+    return '%%%s%%' % query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
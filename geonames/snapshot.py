@@ -0,0 +1,518 @@
+"""
+Read-only binary snapshot of the geonames table, answering geocoding, reverse
+geocoding and hierarchy lookups without Django or a database.
+
+The importer writes the snapshot with ``geonames_import --snapshot FILE``, and
+``Snapshot`` maps it into memory, so opening it costs next to nothing and the
+processes reading the same file share its pages. The file is made of:
+
+  * a header, with the format version and the offset of each section
+  * a JSON section of metadata: countries, first level divisions, feature
+    codes and the date the snapshot was made
+  * one little endian column per geoname field: ids, coordinates, population,
+    feature class and code, country, admin division ids and the id of the
+    parent geoname in the hierarchy of ``Geoname.parent``
+  * a string table of the UTF-8 names, with the offset of each name
+  * the rows sorted by id and by normalized name, for lookups by id and by
+    name
+  * a grid of one degree cells, the rows being stored cell by cell, for the
+    nearest neighbour search
+
+Only the standard library is used, so the module can be used from processes
+that don't load Django at all.
+"""
+from __future__ import with_statement
+
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import time
+import unicodedata
+from array import array
+from collections import namedtuple
+
+MAGIC = 'GNSNAP'
+VERSION = 2
+HEADER = struct.Struct('<6sHI')
+SECTION = struct.Struct('<16sQQ')
+ALIGNMENT = 8
+
+GLOBE_GEONAME_ID = 6295630
+POLITICAL_FCODES = frozenset(['PCLI', 'PCL', 'PCLD', 'CONT'])
+NO_INDEX = 0xffff
+EARTH_RADIUS = 6371.0
+
+GRID_COLUMNS = 360
+GRID_ROWS = 180
+
+# The columns of the snapshot, and the typecodes of their arrays. Populations
+# are doubles, the only 64 bit type arrays have on every platform, since the
+# Earth's doesn't fit in 32 bits
+COLUMNS = (
+    ('ids', 'i'), ('latitudes', 'f'), ('longitudes', 'f'), ('populations', 'd'),
+    ('fclasses', 'c'), ('fcodes', 'H'), ('countries', 'H'), ('admin1_ids', 'i'),
+    ('admin2_ids', 'i'), ('admin3_ids', 'i'), ('admin4_ids', 'i'), ('parent_ids', 'i'),
+)
+
+Place = namedtuple('Place', 'id name latitude longitude fclass fcode country admin1_id '
+                            'admin2_id admin3_id admin4_id population parent_id')
+
+
+def normalize(name):
+    """
+    Returns the form of ``name`` the name index is sorted by: lower case,
+    without accents.
+    """
+    if isinstance(name, str):
+        name = name.decode('utf-8')
+    name = unicodedata.normalize('NFKD', name.lower())
+    return u''.join(c for c in name if not unicodedata.combining(c))
+
+
+def grid_cell(latitude, longitude):
+    row = min(max(int(math.floor(latitude + 90)), 0), GRID_ROWS - 1)
+    column = int(math.floor(longitude + 180)) % GRID_COLUMNS
+    return row * GRID_COLUMNS + column
+
+
+def distance(lat1, lng1, lat2, lng2):
+    """
+    Returns the great circle distance in km between two points.
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def ring_distance(latitude, ring):
+    """
+    Returns the least distance in km from a point at ``latitude`` to the
+    cells ``ring`` cells away from its own, which are at least ``ring - 1``
+    degrees away either in latitude, or in longitude at a latitude no
+    further from the equator than ``ring`` degrees past the point's.
+    """
+    if ring <= 1:
+        return 0.0
+    steps = math.radians(min(ring - 1, 180))
+    edge = math.radians(min(abs(latitude) + ring, 90))
+    along_parallel = 2 * EARTH_RADIUS * math.asin(min(1.0, math.cos(edge) * math.sin(steps / 2)))
+    return min(EARTH_RADIUS * steps, along_parallel)
+
+
+class SnapshotWriter(object):
+    """
+    Collects geonames with ``add`` and writes them out as a snapshot.
+    """
+
+    def __init__(self):
+        self.columns = dict((name, array(typecode)) for name, typecode in COLUMNS)
+        self.names = []
+        self.fcodes = {}
+        self.countries = {}
+        self.meta = {'countries': [], 'admin1': [], 'fcodes': []}
+
+    def code_index(self, codes, code):
+        if not code:
+            return NO_INDEX
+        try:
+            return codes[code]
+        except KeyError:
+            index = codes[code] = len(codes)
+            return index
+
+    def add_country(self, iso_alpha2, iso_alpha3, name, geoname_id):
+        self.code_index(self.countries, iso_alpha2)
+        self.meta['countries'].append((iso_alpha2, iso_alpha3, name, geoname_id))
+
+    def add_admin1(self, id, country, code, name):
+        self.meta['admin1'].append((id, country, code, name))
+
+    def add(self, id, name, latitude, longitude, fclass, fcode, country, admin1_id, admin2_id,
+            admin3_id, admin4_id, population, parent_id):
+        columns = self.columns
+        columns['ids'].append(id)
+        columns['latitudes'].append(latitude)
+        columns['longitudes'].append(longitude)
+        columns['populations'].append(max(population or 0, 0))
+        columns['fclasses'].append(str(fclass or ' '))
+        columns['fcodes'].append(self.code_index(self.fcodes, fcode))
+        columns['countries'].append(self.code_index(self.countries, country))
+        columns['admin1_ids'].append(admin1_id or 0)
+        columns['admin2_ids'].append(admin2_id or 0)
+        columns['admin3_ids'].append(admin3_id or 0)
+        columns['admin4_ids'].append(admin4_id or 0)
+        columns['parent_ids'].append(parent_id or 0)
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        self.names.append(name)
+
+    def grid_order(self):
+        """
+        Returns the rows ordered cell by cell, with a counting sort, and the
+        index of the first row of each cell.
+        """
+        cells = array('I', map(grid_cell, self.columns['latitudes'], self.columns['longitudes']))
+        starts = array('I', [0]) * (GRID_ROWS * GRID_COLUMNS + 1)
+        for cell in cells:
+            starts[cell + 1] += 1
+        for i in xrange(1, len(starts)):
+            starts[i] += starts[i - 1]
+        order = array('i', [0]) * len(cells)
+        positions = array('I', starts)
+        for row, cell in enumerate(cells):
+            order[positions[cell]] = row
+            positions[cell] += 1
+        return order, starts
+
+    def write(self, filename):
+        """
+        Writes the snapshot to ``filename``, through a temporary file renamed
+        over it once complete, so readers never open a partial snapshot.
+        Returns the number of geonames written.
+        """
+        order, starts = self.grid_order()
+        sections = []
+        for name, typecode in COLUMNS:
+            column = self.columns[name]
+            sections.append((name, array(typecode, [column[row] for row in order])))
+        ids = sections[0][1]
+        names = [self.names[row] for row in order]
+        offsets = array('I', [0])
+        for name in names:
+            offsets.append(offsets[-1] + len(name))
+        sections.append(('name_offsets', offsets))
+        sections.append(('names', ''.join(names)))
+        sections.append(('id_index', array('i', sorted(xrange(len(ids)), key=ids.__getitem__))))
+        keys = [normalize(name) for name in names]
+        sections.append(('name_index', array('i', sorted(xrange(len(keys)), key=keys.__getitem__))))
+        del keys
+        sections.append(('grid', starts))
+        self.meta['fcodes'] = sorted(self.fcodes, key=self.fcodes.get)
+        self.meta['country_codes'] = sorted(self.countries, key=self.countries.get)
+        self.meta['created'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+        self.meta['count'] = len(ids)
+        sections.insert(0, ('meta', json.dumps(self.meta)))
+
+        temp = '%s.tmp' % filename
+        with open(temp, 'wb') as fd:
+            offset = HEADER.size + SECTION.size * len(sections)
+            table = []
+            for name, data in sections:
+                offset += -offset % ALIGNMENT
+                size = isinstance(data, array) and len(data) * data.itemsize or len(data)
+                table.append(SECTION.pack(name, offset, size))
+                offset += size
+            fd.write(HEADER.pack(MAGIC, VERSION, len(sections)))
+            fd.write(''.join(table))
+            for name, data in sections:
+                fd.write('\0' * (-fd.tell() % ALIGNMENT))
+                if isinstance(data, array):
+                    if sys.byteorder == 'big':
+                        data = array(data.typecode, data)
+                        data.byteswap()
+                    data.tofile(fd)
+                else:
+                    fd.write(data)
+        os.rename(temp, filename)
+        return len(ids)
+
+
+def fetch_rows(cursor, sql):
+    """
+    Yields the rows of ``sql``, fetched with ``cursor`` a batch at a time.
+    """
+    cursor.execute(sql)
+    while True:
+        rows = cursor.fetchmany(10000)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
+
+def build(cursor, filename, point_columns='ST_X(point), ST_Y(point)', stream=None):
+    """
+    Writes a snapshot of the geonames in the database of ``cursor`` to
+    ``filename``, and returns the number of geonames written.
+    ``point_columns`` selects the longitude and latitude of ``point``.
+    ``stream``, a function yielding the rows of a query, reads the geonames
+    if given, so that they need not all be held by the client at once.
+
+    The parent of each geoname is resolved here as in ``Geoname.parent``, so
+    that the hierarchy can be walked without the admin tables.
+    """
+    writer = SnapshotWriter()
+    cursor.execute('SELECT code, geoname_id FROM continent')
+    continents = dict(cursor.fetchall())
+    cursor.execute('SELECT iso_alpha2, iso_alpha3, name, geoname_id, continent_id FROM country')
+    countries = {}
+    for iso_alpha2, iso_alpha3, name, geoname_id, continent in cursor.fetchall():
+        writer.add_country(iso_alpha2, iso_alpha3, name, geoname_id)
+        countries[iso_alpha2] = (geoname_id, continents.get(continent))
+    admin_geonames = []
+    for table in ('admin1_code', 'admin2_code', 'admin3_code', 'admin4_code'):
+        cursor.execute('SELECT id, geoname_id FROM %s' % table)
+        admin_geonames.append(dict(cursor.fetchall()))
+    cursor.execute('SELECT id, country_id, code, name FROM admin1_code')
+    for row in cursor.fetchall():
+        writer.add_admin1(*row)
+
+    sql = ('SELECT id, name, %s, fclass, fcode, country_id, admin1_id, admin2_id, '
+           'admin3_id, admin4_id, population FROM geoname' % point_columns)
+    if stream:
+        rows = stream(sql)
+    else:
+        rows = fetch_rows(cursor, sql)
+    for id, name, longitude, latitude, fclass, fcode, country, a1, a2, a3, a4, population in rows:
+        fcode = fcode or ''
+        country_geoname, continent_geoname = countries.get(country, (None, None))
+        if fcode == 'CONT':
+            parents = [GLOBE_GEONAME_ID]
+        elif fcode.startswith('PCL'):
+            parents = [continent_geoname]
+        elif fcode in ('ADM1', 'ADMD'):
+            parents = [country_geoname, continent_geoname]
+        else:
+            # The admin divisions a geoname can belong to, closest first
+            level = {'ADM2': 1, 'ADM3': 2, 'ADM4': 3}.get(fcode, 4)
+            admins = [geonames.get(admin) for geonames, admin in
+                      zip(admin_geonames, (a1, a2, a3, a4))[:level]]
+            parents = admins[::-1] + [country_geoname, continent_geoname]
+        parent_id = None
+        if id != GLOBE_GEONAME_ID:
+            for parent in parents:
+                if parent and parent != id:
+                    parent_id = parent
+                    break
+        writer.add(id, name, float(latitude), float(longitude), fclass, fcode, country,
+                   a1, a2, a3, a4, population, parent_id)
+    return writer.write(filename)
+
+
+class Column(object):
+    """
+    A column of a snapshot, read in place from the mapped file.
+    """
+
+    def __init__(self, buffer, offset, size, typecode):
+        self.buffer = buffer
+        self.offset = offset
+        self.format = struct.Struct('<' + typecode)
+        self.length = size // self.format.size
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        return self.format.unpack_from(self.buffer, self.offset + i * self.format.size)[0]
+
+
+class Snapshot(object):
+    """
+    A snapshot mapped into memory. Geonames are returned as ``Place`` tuples,
+    with the country as its ISO code.
+    """
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as fd:
+            self.map = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise ValueError('%s is not a geonames snapshot' % filename)
+        if version != VERSION:
+            raise ValueError('%s is a version %d snapshot, version %d is supported' % \
+                (filename, version, VERSION))
+        sections = {}
+        for i in xrange(count):
+            name, offset, size = SECTION.unpack_from(self.map, HEADER.size + i * SECTION.size)
+            sections[name.rstrip('\0')] = (offset, size)
+        offset, size = sections['meta']
+        self.meta = json.loads(self.map[offset:offset + size])
+        for name, typecode in COLUMNS + (('name_offsets', 'I'), ('id_index', 'i'),
+                                         ('name_index', 'i'), ('grid', 'I')):
+            setattr(self, name, Column(self.map, sections[name][0], sections[name][1], typecode))
+        self.names_offset = sections['names'][0]
+        self.fcode_list = self.meta['fcodes']
+        self.country_list = self.meta['country_codes']
+        self.country_info = {}
+        for iso_alpha2, iso_alpha3, name, geoname_id in self.meta['countries']:
+            info = (iso_alpha2, geoname_id)
+            for key in (iso_alpha2, iso_alpha3, name):
+                if key:
+                    self.country_info[key.lower()] = info
+        self.admin1_info = {}
+        for id, country, code, name in self.meta['admin1']:
+            for key in (code, name):
+                if key:
+                    self.admin1_info.setdefault(key.lower(), []).append((id, country))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def close(self):
+        self.map.close()
+
+    def name(self, row):
+        start = self.names_offset + self.name_offsets[row]
+        end = self.names_offset + self.name_offsets[row + 1]
+        return self.map[start:end].decode('utf-8')
+
+    def place(self, row):
+        fcode = self.fcodes[row]
+        country = self.countries[row]
+        return Place(self.ids[row], self.name(row), self.latitudes[row], self.longitudes[row],
+                     self.fclasses[row], fcode != NO_INDEX and self.fcode_list[fcode] or '',
+                     country != NO_INDEX and self.country_list[country] or None,
+                     self.admin1_ids[row] or None, self.admin2_ids[row] or None,
+                     self.admin3_ids[row] or None, self.admin4_ids[row] or None,
+                     int(self.populations[row]), self.parent_ids[row] or None)
+
+    def row(self, id):
+        """
+        Returns the row of the geoname with ``id``, or None.
+        """
+        low, high = 0, len(self.id_index)
+        while low < high:
+            middle = (low + high) // 2
+            if self.ids[self.id_index[middle]] < id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.id_index) and self.ids[self.id_index[low]] == id:
+            return self.id_index[low]
+        return None
+
+    def get(self, id):
+        row = self.row(id)
+        return row is not None and self.place(row) or None
+
+    def name_rows(self, name, prefix=False):
+        """
+        Returns the rows of the geonames named ``name``, or whose name starts
+        with it with ``prefix``, compared in their normalized form.
+        """
+        key = normalize(name)
+        index = self.name_index
+        low, high = 0, len(index)
+        while low < high:
+            middle = (low + high) // 2
+            if normalize(self.name(index[middle])) < key:
+                low = middle + 1
+            else:
+                high = middle
+        rows = []
+        for i in xrange(low, len(index)):
+            found = normalize(self.name(index[i]))
+            if found != key and not (prefix and found.startswith(key)):
+                break
+            rows.append(index[i])
+        return rows
+
+    def find(self, name, country=None, admin1_ids=None, prefix=False):
+        """
+        Returns the geonames named ``name``, most populated first, optionally
+        restricted to a country code or a set of first level division ids.
+        """
+        rows = self.name_rows(name, prefix)
+        if country is not None:
+            if country not in self.country_list:
+                return []
+            code = self.country_list.index(country)
+            rows = [row for row in rows if self.countries[row] == code]
+        if admin1_ids is not None:
+            rows = [row for row in rows if self.admin1_ids[row] in admin1_ids]
+        rows.sort(key=lambda row: -self.populations[row])
+        return [self.place(row) for row in rows]
+
+    def geocode(self, query, first=True):
+        """
+        Finds the geonames matching ``query``, following ``geocoder.geocode``:
+        a country code, then 'City, Region' where the region is a first level
+        division or a country, then the name itself, most populated first.
+        The parts of the query are told apart by their commas.
+        """
+        query = query.strip()
+        results = []
+        if len(query) in (2, 3):
+            info = self.country_info.get(query.lower())
+            if info and info[1]:
+                place = self.get(info[1])
+                if place:
+                    results = [place]
+        if not results and ',' in query:
+            parts = [part.strip() for part in query.split(',')]
+            city, region = parts[0], parts[-1].lower()
+            if region == 'uk':
+                region = 'gb'
+            if region in self.admin1_info:
+                results = self.find(city, admin1_ids=set(id for id, country in
+                                                         self.admin1_info[region]))
+            if not results and region in self.country_info:
+                results = self.find(city, country=self.country_info[region][0])
+        if not results:
+            results = self.find(query, prefix=True)
+        if first:
+            return results and results[0] or None
+        return results
+
+    def reverse_geocode(self, latitude, longitude, cities=False):
+        """
+        Returns the geoname closest to a point, leaving out countries and
+        continents, and everything but populated places with ``cities``.
+
+        The cells of the grid are searched in rings around the cell of the
+        point, until no cell left can hold a closer geoname.
+        """
+        latitude, longitude = float(latitude), float(longitude)
+        if not (-90.0 <= latitude <= 90.0 and -180.0 <= longitude <= 180.0):
+            raise ValueError('The latitude must be between -90 and 90, and the longitude '
+                             'between -180 and 180')
+        center = grid_cell(latitude, longitude)
+        center_row, center_column = divmod(center, GRID_COLUMNS)
+        political = set(i for i, code in enumerate(self.fcode_list) if code in POLITICAL_FCODES)
+        best, best_distance = None, None
+        for ring in xrange(max(GRID_ROWS, GRID_COLUMNS // 2) + 1):
+            if best is not None and ring_distance(latitude, ring) > best_distance:
+                break
+            for cell in self.ring_cells(center_row, center_column, ring):
+                for row in xrange(self.grid[cell], self.grid[cell + 1]):
+                    if cities and self.fclasses[row] != 'P':
+                        continue
+                    if self.fcodes[row] in political:
+                        continue
+                    d = distance(latitude, longitude, self.latitudes[row], self.longitudes[row])
+                    if best is None or d < best_distance:
+                        best, best_distance = row, d
+        return best is not None and self.place(best) or None
+
+    def ring_cells(self, center_row, center_column, ring):
+        cells = set()
+        for row in xrange(center_row - ring, center_row + ring + 1):
+            if not 0 <= row < GRID_ROWS:
+                continue
+            if abs(row - center_row) == ring:
+                columns = xrange(center_column - ring, center_column + ring + 1)
+            else:
+                columns = (center_column - ring, center_column + ring)
+            for column in columns:
+                cells.add(row * GRID_COLUMNS + column % GRID_COLUMNS)
+        return cells
+
+    def hierarchy(self, id):
+        """
+        Returns the parents of the geoname with ``id``, closest first, up to
+        the globe, as ``Geoname.hierarchy`` does.
+        """
+        parents = []
+        place = self.get(id)
+        seen = set([id])
+        while place is not None and place.parent_id and place.parent_id not in seen:
+            seen.add(place.parent_id)
+            place = self.get(place.parent_id)
+            if place is not None:
+                parents.append(place)
+        return parents
@@ -0,0 +1,2 @@
+CREATE EXTENSION IF NOT EXISTS pg_trgm SCHEMA public;
+CREATE INDEX "geoname_name_trgm" ON "geoname" USING gin ("name" gin_trgm_ops);
@@ -0,0 +1 @@
+ALTER TABLE `search_name` MODIFY `name` VARCHAR(200) CHARACTER SET utf8 COLLATE utf8_bin NOT NULL;
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Generator of synthetic GeoNames dump files, to measure the importer offline.
+
+The files have the layout of those of download.geonames.org, and roughly the
+skew of their data, so that the importer does the same work per row:
+
+  * a few countries hold most of the geonames, and only some of them have
+    third and fourth level divisions
+  * most geonames are unpopulated, populated places follow a power law
+  * names are mostly one or two words of a few syllables, with a long tail
+    of longer ones, and some accented letters
+  * a few geonames have many alternate names, most have none or one, in a
+    spread of languages, a few of them preferred or short
+  * the file isn't sorted by division, so some geonames come before the
+    third and fourth level divisions they are in
+
+Running this module writes the files to a directory::
+
+    python geonames/synthetic.py DIRECTORY [GEONAMES]
+"""
+from __future__ import with_statement
+
+import os
+import random
+import unicodedata
+
+# A few of the continent ids of the real dump, which the importer refers to
+CONTINENTS = [
+    ('AF', 'Africa', 6255146),
+    ('AS', 'Asia', 6255147),
+    ('EU', 'Europe', 6255148),
+    ('NA', 'North America', 6255149),
+    ('OC', 'Oceania', 6255151),
+    ('SA', 'South America', 6255150),
+    ('AN', 'Antarctica', 6255152),
+]
+
+# Feature codes and their share of the geonames that aren't divisions
+FEATURES = [
+    ('P', 'PPL', 40), ('H', 'STM', 12), ('T', 'MT', 8), ('T', 'HLL', 6), ('H', 'LK', 4),
+    ('S', 'SCH', 5), ('S', 'CH', 4), ('L', 'AREA', 3), ('P', 'PPLX', 4), ('V', 'FRST', 2),
+    ('R', 'RD', 2), ('S', 'HTL', 3), ('U', 'SMU', 1), ('P', 'PPLA', 1), ('P', 'PPLC', 0),
+    ('H', 'BAY', 3), ('T', 'ISL', 2),
+]
+DIVISIONS = [('A', 'PCLI'), ('A', 'ADM1'), ('A', 'ADM2'), ('A', 'ADM3'), ('A', 'ADM4'),
+             ('L', 'CONT'), ('P', 'PPLC')]
+
+LANGUAGES = [('', 20), ('en', 14), ('de', 6), ('fr', 6), ('es', 5), ('ru', 5), ('zh', 4),
+             ('ja', 3), ('ar', 3), ('pt', 3), ('it', 3), ('nl', 2), ('pl', 2), ('link', 8),
+             ('post', 8), ('iata', 1), ('icao', 1), ('wkdt', 4), ('unlc', 2)]
+
+SYLLABLES = ['ba', 'ka', 'lo', 'mi', 'ne', 'ra', 'san', 'to', 'vi', 'wen', 'ber', 'gor',
+             'ha', 'ill', 'jo', 'kra', 'lin', 'mar', 'nor', 'os', 'pol', 'que', 'ri', 'sta',
+             'tur', 'ul', 'val', 'yor', 'zen', 'ach', 'burg', 'dorf', 'field', 'ton', 'ville']
+ACCENTS = {'a': u'á', 'e': u'é', 'i': u'í', 'o': u'ö', 'u': u'ü', 'n': u'ñ', 'c': u'ç'}
+CYRILLIC = dict(zip(u'abcdefghijklmnopqrstuvwxyz', u'абкдефгхийклмнопкрстуввхыз'))
+
+TIME_ZONES = [('Etc/GMT%+d' % -offset, offset) for offset in range(-12, 15)]
+
+
+def weighted(rng, choices):
+    total = sum(choice[-1] for choice in choices)
+    pick = rng.uniform(0, total)
+    for choice in choices:
+        pick -= choice[-1]
+        if pick <= 0:
+            return choice
+    return choices[-1]
+
+
+class DumpGenerator(object):
+
+    def __init__(self, geonames=100000, seed=0):
+        self.geonames = geonames
+        self.rng = random.Random(seed)
+        self.next_id = 1
+        self.feature_weights = [(fclass, fcode, weight) for fclass, fcode, weight in FEATURES]
+
+    def new_id(self):
+        id = self.next_id
+        self.next_id += 1
+        return id
+
+    def name(self):
+        """
+        Returns a name and its ASCII form, of one to a few words of a
+        lognormal number of syllables.
+        """
+        rng = self.rng
+        words = []
+        for i in range(weighted(rng, [(1, 70), (2, 22), (3, 6), (5, 2)])[0]):
+            syllables = 1 + min(int(rng.lognormvariate(0.6, 0.5)), 8)
+            words.append(''.join(rng.choice(SYLLABLES) for j in range(syllables)).capitalize())
+        name = u' '.join(words)
+        if rng.random() < 0.15:
+            letters = list(name)
+            i = rng.randrange(len(letters))
+            letters[i] = ACCENTS.get(letters[i], letters[i])
+            name = u''.join(letters)
+        ascii_name = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore')
+        return name, ascii_name
+
+    def population(self, fclass, fcode):
+        rng = self.rng
+        if fclass != 'P' or rng.random() < 0.6:
+            return 0
+        population = int(rng.paretovariate(1.1) * 200)
+        if fcode in ('PPLC', 'PPLA'):
+            population *= 50
+        return min(population, 30000000)
+
+    def countries(self):
+        """
+        Lays out the countries and their divisions: a Zipf-like share of the
+        geonames for each country, up to a few dozen first level divisions,
+        and third and fourth levels in only some of them. A few second level
+        codes are blank, and a few are missing from admin2Codes.txt, as in
+        the real files.
+        """
+        rng = self.rng
+        count = max(5, min(250, self.geonames // 400))
+        countries = []
+        for i in range(count):
+            code = chr(65 + i // 26) + chr(65 + i % 26)
+            continent = CONTINENTS[i % len(CONTINENTS)]
+            center = (rng.uniform(-60, 70), rng.uniform(-170, 170))
+            depth = weighted(rng, [(2, 60), (3, 25), (4, 15)])[0]
+            divisions = []
+            for a1 in range(1, 2 + int(rng.paretovariate(1.2) * 4) % 60):
+                admin2 = []
+                for a2 in range(1, 1 + int(rng.expovariate(0.15)) % 40):
+                    admin3 = []
+                    if depth >= 3:
+                        for a3 in range(1, 1 + int(rng.expovariate(0.2))):
+                            admin4 = depth == 4 and range(1, 1 + int(rng.expovariate(0.3))) or []
+                            admin3.append(('%05d' % a3, ['%03d' % a4 for a4 in admin4]))
+                    admin2_code = '%03d' % a2
+                    if depth >= 3 and a2 == 1 and rng.random() < 0.1:
+                        # Third level divisions right below the first level,
+                        # with a blank second level code
+                        admin2_code = ''
+                    admin2.append((admin2_code, admin3))
+                divisions.append(('%02d' % a1, admin2))
+            countries.append({'code': code, 'iso3': code + 'X', 'numeric': i + 1,
+                              'continent': continent, 'center': center,
+                              'weight': 1.0 / (i + 1) ** 1.1, 'divisions': divisions,
+                              'timezone': TIME_ZONES[int((center[1] + 180) / 15) % len(TIME_ZONES)][0]})
+        return countries
+
+    def geoname(self, id, name, fclass, fcode, country, codes=(), population=None):
+        rng = self.rng
+        lat = max(-89.9, min(89.9, country['center'][0] + rng.gauss(0, 3)))
+        lng = max(-179.9, min(179.9, country['center'][1] + rng.gauss(0, 4)))
+        name, ascii_name = name
+        codes = (list(codes) + [''] * 4)[:4]
+        if population is None:
+            population = self.population(fclass, fcode)
+        elevation = rng.random() < 0.2 and str(int(rng.expovariate(0.002))) or ''
+        return [str(id), name.encode('utf-8'), ascii_name, '', '%.5f' % lat, '%.5f' % lng,
+                fclass, fcode, country['code'], ''] + codes + \
+               [str(population), elevation, str(int(rng.expovariate(0.003))), country['timezone'],
+                '2012-%02d-%02d' % (rng.randint(1, 12), rng.randint(1, 28))]
+
+    def write(self, directory):
+        """
+        Writes the dump files to ``directory``, and returns the number of
+        geonames and alternate names written.
+        """
+        rng = self.rng
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        path = lambda name: os.path.join(directory, name)
+        countries = self.countries()
+
+        # The divisions first, which the other geonames are spread over
+        rows = []
+        admin1_lines, admin2_lines = [], []
+        leaves = []
+        for code, name, id in CONTINENTS:
+            rows.append(self.geoname(id, (unicode(name), name), 'L', 'CONT', countries[0], population=0))
+        for country in countries:
+            country['name'] = self.name()
+            country['geoname_id'] = self.new_id()
+            rows.append(self.geoname(country['geoname_id'], country['name'], 'A', 'PCLI', country))
+            for a1, admin2 in country['divisions']:
+                id, name = self.new_id(), self.name()
+                rows.append(self.geoname(id, name, 'A', 'ADM1', country, [a1]))
+                admin1_lines.append('%s.%s\t%s\t%s\t%d\n' % (country['code'], a1, name[0].encode('utf-8'),
+                                                          name[1], id))
+                leaves.append((country, [a1]))
+                for a2, admin3 in admin2:
+                    if a2:
+                        id, name = self.new_id(), self.name()
+                        rows.append(self.geoname(id, name, 'A', 'ADM2', country, [a1, a2]))
+                        if rng.random() >= 0.05:
+                            admin2_lines.append('%s.%s.%s\t%s\t%s\t%d\n' % (country['code'], a1, a2,
+                                                name[0].encode('utf-8'), name[1], id))
+                        leaves.append((country, [a1, a2]))
+                    for a3, admin4 in admin3:
+                        rows.append(self.geoname(self.new_id(), self.name(), 'A', 'ADM3', country,
+                                                 [a1, a2, a3]))
+                        leaves.append((country, [a1, a2, a3]))
+                        for a4 in admin4:
+                            rows.append(self.geoname(self.new_id(), self.name(), 'A', 'ADM4', country,
+                                                     [a1, a2, a3, a4]))
+                            leaves.append((country, [a1, a2, a3, a4]))
+
+        # Then the other geonames, spread over the divisions of each country
+        # by the country's share
+        by_country = {}
+        for country, codes in leaves:
+            by_country.setdefault(country['code'], []).append(codes)
+        weights = [(country, country['weight']) for country in countries]
+        while len(rows) < self.geonames:
+            country = weighted(rng, weights)[0]
+            codes = rng.choice(by_country.get(country['code']) or [[]])
+            fclass, fcode = weighted(rng, self.feature_weights)[:2]
+            rows.append(self.geoname(self.new_id(), self.name(), fclass, fcode, country, codes))
+
+        # Roughly in id order, as in the real file, with a share of the rows
+        # moved ahead of the divisions they are in
+        for i in xrange(len(rows) // 20):
+            a, b = rng.randrange(len(rows)), rng.randrange(len(rows))
+            rows[a], rows[b] = rows[b], rows[a]
+
+        alternates = 0
+        with open(path('allCountries.txt'), 'w') as fd:
+            with open(path('alternateNames.txt'), 'w') as alt:
+                for row in rows:
+                    fd.write('\t'.join(row) + '\n')
+                    count = int(rng.paretovariate(1.5)) - 1
+                    if row[7] in ('PCLI', 'ADM1', 'CONT', 'PPLC'):
+                        count += rng.randint(5, 40)
+                    for i in xrange(count):
+                        alternates += 1
+                        language = weighted(rng, LANGUAGES)[0]
+                        name = row[1].decode('utf-8')
+                        if language in ('ru', 'zh', 'ja', 'ar'):
+                            name = u''.join(CYRILLIC.get(c, c) for c in name.lower())
+                        elif language == 'link':
+                            name = u'http://en.wikipedia.org/wiki/%s' % row[2].replace(' ', '_')
+                        elif language == 'post':
+                            name = u'%05d' % rng.randint(0, 99999)
+                        preferred = rng.random() < 0.03 and '1' or ''
+                        short = rng.random() < 0.01 and '1' or ''
+                        alt.write('%d\t%s\t%s\t%s\t%s\t%s\n' % (alternates, row[0], language,
+                                                                name.encode('utf-8'), preferred, short))
+
+        with open(path('admin1CodesASCII.txt'), 'w') as fd:
+            fd.writelines(admin1_lines)
+        with open(path('admin2Codes.txt'), 'w') as fd:
+            fd.writelines(admin2_lines)
+        with open(path('countryInfo.txt'), 'w') as fd:
+            fd.write('# Synthetic country information\n')
+            fd.write('#ISO\tISO3\tISO-Numeric\tfips\tCountry\tCapital\tArea(in sq km)\tPopulation\t'
+                     'Continent\ttld\tCurrencyCode\tCurrencyName\tPhone\tPostal Code Format\t'
+                     'Postal Code Regex\tLanguages\tgeonameid\tneighbours\tEquivalentFipsCode\n')
+            for country in countries:
+                fd.write('\t'.join([country['code'], country['iso3'], str(country['numeric']),
+                                    country['code'], country['name'][1], '', str(rng.randint(1, 10 ** 7)),
+                                    '{:,}'.format(rng.randint(1000, 10 ** 9)), country['continent'][0],
+                                    '.' + country['code'].lower(), 'XXX', 'Unit', '1', '#####',
+                                    '^(\\d{5})$', 'en', str(country['geoname_id']), '', '']) + '\n')
+        with open(path('timeZones.txt'), 'w') as fd:
+            fd.write('TimeZoneId\tGMT offset 1. Jan 2012\tDST offset 1. Jul 2012\n')
+            for name, offset in TIME_ZONES:
+                fd.write('%s\t%.1f\t%.1f\n' % (name, offset, offset))
+        codes = sorted(set((fclass, fcode) for fclass, fcode, weight in FEATURES) | set(DIVISIONS))
+        with open(path('featureCodes_en.txt'), 'w') as fd:
+            for fclass, fcode in codes:
+                fd.write('%s.%s\t%s\t%s feature\n' % (fclass, fcode, fcode.lower(), fcode.lower()))
+            fd.write('null\t\t\n')
+        with open(path('iso-languagecodes.txt'), 'w') as fd:
+            fd.write('ISO 639-3\tISO 639-2\tISO 639-1\tLanguage Name\n')
+            for code, weight in LANGUAGES:
+                if len(code) == 2:
+                    fd.write('%sx\t%sx\t%s\tLanguage %s\n' % (code, code, code, code))
+        return len(rows), alternates
+
+
+if __name__ == '__main__':
+    import sys
+    geonames = len(sys.argv) > 2 and int(sys.argv[2]) or 100000
+    print '%d geonames and %d alternate names written' % \
+        DumpGenerator(geonames).write(sys.argv[1])